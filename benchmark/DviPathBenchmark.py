@@ -0,0 +1,56 @@
+import shutil
+import sys
+import os
+import tempfile
+import time
+from datetime import datetime as dt
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.FormatCache import FormatCache
+from src.LatexConverter import LatexConverter
+from src.PdflatexWorkerPool import PdflatexWorkerPool
+from src.PreambleManager import PreambleManager
+from src.ResourceManager import ResourceManager
+
+
+def render(converter, expression, userId, sessionId):
+    # Inline queries only ever ask for the PNG
+    with converter.convertExpression(expression, userId, sessionId) as result:
+        result.get("png")
+
+
+def benchmark(converter, expressions, repetitions):
+    # The first renders dump the formats in the background, they are left out of the measurement
+    for idx, expression in enumerate(expressions):
+        render(converter, expression, 115, "warmup%d" % idx)
+    while converter._formatCache._scheduled:
+        time.sleep(0.1)
+    for idx, expression in enumerate(expressions):
+        render(converter, expression, 115, "warm%d" % idx)
+    start = dt.now()
+    for repetition in range(repetitions):
+        for idx, expression in enumerate(expressions):
+            render(converter, expression, 115, "bench%d_%d" % (repetition, idx))
+    return (dt.now() - start).total_seconds() / len(expressions) / repetitions * 1000
+
+
+if __name__ == '__main__':
+    userOptionsManager = Mock()
+    userOptionsManager.getDpiOption = Mock(return_value=300)
+    preambleManager = PreambleManager(ResourceManager())
+    expressions = ["$x^{%d}$" % idx for idx in range(10)] + [r"$\int_0^{%d} x^2\,dx$" % idx for idx in range(10)]
+
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+        formatCache = FormatCache(cacheDirectory)
+        for name, dviFastPath in (("pdf + gs", False), ("dvi + dvipng", True)):
+            workerPool = PdflatexWorkerPool(formatCache)
+            converter = LatexConverter(preambleManager, userOptionsManager, formatCache=formatCache, workerPool=workerPool)
+            converter._dviFastPath = dviFastPath
+            elapsedTime = benchmark(converter, expressions, 3)
+            workerPool.shutdown()
+            print("%-14s %.0f ms/request %s" % (name, elapsedTime, converter.getDviStats() if dviFastPath else ""))
+    finally:
+        shutil.rmtree(cacheDirectory, ignore_errors=True)
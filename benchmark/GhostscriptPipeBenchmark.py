@@ -0,0 +1,38 @@
+import sys
+import os
+from datetime import datetime as dt
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.LatexConverter import LatexConverter
+from src.PreambleManager import PreambleManager
+from src.ResourceManager import ResourceManager
+
+
+def render(converter, expression, userId, sessionId):
+    with converter.convertExpression(expression, userId, sessionId, formats=("png", "pdf")) as result:
+        result.get("png")
+        result.get("pdf")
+
+
+def benchmark(converter, expressions, repetitions):
+    render(converter, expressions[0], 115, "warmup")
+    start = dt.now()
+    for repetition in range(repetitions):
+        for idx, expression in enumerate(expressions):
+            render(converter, expression, 115, "bench%d_%d" % (repetition, idx))
+    return (dt.now() - start).total_seconds() / len(expressions) / repetitions * 1000
+
+
+if __name__ == '__main__':
+    userOptionsManager = Mock()
+    userOptionsManager.getDpiOption = Mock(return_value=300)
+    preambleManager = PreambleManager(ResourceManager())
+    expressions = ["$x^{%d}$" % idx for idx in range(10)]
+
+    for name, pipes in (("files", False), ("pipes", True)):
+        converter = LatexConverter(preambleManager, userOptionsManager)
+        converter._ghostscriptPipes = pipes
+        elapsedTime = benchmark(converter, expressions, 3)
+        print("%-6s %.0f ms/request" % (name, elapsedTime))
@@ -0,0 +1,57 @@
+import subprocess
+import sys
+import os
+from datetime import datetime as dt
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.LatexConverter import LatexConverter
+from src.PreambleManager import PreambleManager
+from src.ResourceManager import ResourceManager
+
+
+class CountingPopen(subprocess.Popen):
+
+    invocations = []
+
+    def __init__(self, args, *posargs, **kwargs):
+        CountingPopen.invocations.append(os.path.basename(args[0]))
+        super().__init__(args, *posargs, **kwargs)
+
+
+class SeparateMeasurementLatexConverter(LatexConverter):
+
+    # Reproduces the previous pipeline, where cropPdf measured the bounding box on its own
+    def cropPdf(self, sessionId, bounds=None, cancelEvent=None, directory="build"):
+        return super().cropPdf(sessionId, cancelEvent=cancelEvent, directory=directory)
+
+
+def render(converter, expression, userId, sessionId):
+    with converter.convertExpression(expression, userId, sessionId, formats=("png", "pdf")) as result:
+        result.get("png")
+        result.get("pdf")
+
+
+def benchmark(converter, expressions):
+    CountingPopen.invocations = []
+    start = dt.now()
+    for idx, expression in enumerate(expressions):
+        render(converter, expression, 115, "bench%d" % idx)
+    elapsedTime = (dt.now() - start).total_seconds() / len(expressions) * 1000
+    processes = len(CountingPopen.invocations) / len(expressions)
+    ghostscript = len([name for name in CountingPopen.invocations if name.startswith("gs")]) / len(expressions)
+    return processes, ghostscript, elapsedTime
+
+
+if __name__ == '__main__':
+    subprocess.Popen = CountingPopen
+    userOptionsManager = Mock()
+    userOptionsManager.getDpiOption = Mock(return_value=300)
+    preambleManager = PreambleManager(ResourceManager())
+    expressions = ["$x^{%d}$" % idx for idx in range(10)]
+
+    for name, converterClass in (("separate bbox passes", SeparateMeasurementLatexConverter),
+                                 ("shared bbox pass", LatexConverter)):
+        processes, ghostscript, elapsedTime = benchmark(converterClass(preambleManager, userOptionsManager), expressions)
+        print("%-22s %.1f processes/request (%.1f Ghostscript), %.0f ms/request" % (name, processes, ghostscript, elapsedTime))
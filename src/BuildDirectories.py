@@ -0,0 +1,100 @@
+from threading import Lock, Thread
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+
+
+class BuildDirectories():
+
+    logger = LoggingServer.getInstance()
+
+    namePattern = re.compile(r"^([a-z]+)_(\d+)_")
+
+    def __init__(self, rootDirectory=None, maxAge=None, janitorInterval=None):
+        if rootDirectory is None:
+            rootDirectory = BuildDirectories.getDefaultRoot()
+        if maxAge is None:
+            maxAge = Environment.getFloat("LATEXBOT_BUILD_MAX_AGE_S", 600)
+        if janitorInterval is None:
+            janitorInterval = Environment.getFloat("LATEXBOT_BUILD_JANITOR_INTERVAL_S", 60)
+        self._rootDirectory = rootDirectory
+        self._maxAge = maxAge
+        self._janitorInterval = janitorInterval
+        self._janitorLock = Lock()
+        self._janitor = None
+        os.makedirs(self._rootDirectory, exist_ok=True)
+
+    @staticmethod
+    def getDefaultRoot():
+        rootDirectory = Environment.getString("LATEXBOT_BUILD_DIR", None)
+        if rootDirectory is not None:
+            return rootDirectory
+        # RAM-backed storage spares the disk the short-lived intermediate files of every render
+        if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            return "/dev/shm/inlatexbot"
+        return "build"
+
+    def getRoot(self):
+        return self._rootDirectory
+
+    def create(self, prefix="job"):
+        self._startJanitor()
+        # The owning pid in the name lets the janitor recognise directories of processes that died
+        return tempfile.mkdtemp(prefix="%s_%d_" % (prefix, os.getpid()), dir=self._rootDirectory)
+
+    def remove(self, directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def clean(self):
+        removed = 0
+        now = time.time()
+        with os.scandir(self._rootDirectory) as it:
+            entries = list(it)
+        for entry in entries:
+            match = self.namePattern.match(entry.name)
+            if match is None or not entry.is_dir(follow_symlinks=False):
+                continue
+            prefix, pid = match.group(1), int(match.group(2))
+            try:
+                age = now - entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            # Idle workers live as long as their pool recycles them, other directories only as long as one job
+            if not self._isAlive(pid) or (prefix != "worker" and age > self._maxAge):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        if removed:
+            self.logger.debug("Removed %d orphaned build directories", removed)
+        return removed
+
+    def _isAlive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _startJanitor(self):
+        if self._janitorInterval <= 0:
+            return
+        with self._janitorLock:
+            if self._janitor is not None:
+                return
+            self._janitor = Thread(target=self._runJanitor, name="build-janitor")
+            self._janitor.daemon = True
+            self._janitor.start()
+
+    def _runJanitor(self):
+        while True:
+            try:
+                self.clean()
+            except OSError as err:
+                self.logger.warn("Could not clean build directories: %s", str(err))
+            time.sleep(self._janitorInterval)
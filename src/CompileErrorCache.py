@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from src.Environment import Environment
+
+
+class CompileErrorCache():
+
+    def __init__(self, maxEntries=None, ttl=None):
+        if maxEntries is None:
+            maxEntries = Environment.getInt("LATEXBOT_ERROR_CACHE_ENTRIES", 1024)
+        if ttl is None:
+            ttl = Environment.getFloat("LATEXBOT_ERROR_CACHE_TTL_S", 60)
+        self._maxEntries = max(1, maxEntries)
+        self._ttl = ttl
+        self._lock = Lock()
+        self._errors = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, sourceKey):
+        with self._lock:
+            try:
+                storeTime, error = self._errors[sourceKey]
+            except KeyError:
+                self._stats["misses"] += 1
+                raise
+            if time.time() - storeTime > self._ttl:
+                del self._errors[sourceKey]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                raise KeyError(sourceKey)
+            self._stats["hits"] += 1
+            return error
+
+    def put(self, sourceKey, error):
+        with self._lock:
+            self._errors[sourceKey] = (time.time(), error)
+            self._errors.move_to_end(sourceKey)
+            while len(self._errors) > self._maxEntries:
+                self._errors.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._errors)
+        return stats
@@ -0,0 +1,29 @@
+import os
+
+
+class Environment():
+
+    @staticmethod
+    def getString(name, default):
+        return os.environ.get(name) or default
+
+    @staticmethod
+    def getInt(name, default):
+        try:
+            return int(os.environ.get(name, default))
+        except ValueError:
+            return default
+
+    @staticmethod
+    def getFloat(name, default):
+        try:
+            return float(os.environ.get(name, default))
+        except ValueError:
+            return default
+
+    @staticmethod
+    def getBool(name, default=False):
+        value = os.environ.get(name)
+        if value is None:
+            return default
+        return value.lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,117 @@
+import re
+
+
+class ExpressionValidator():
+
+    # Constructs that change how the input is tokenized; nothing can be said about such expressions without TeX
+    opaquePattern = re.compile(r"\\(?:catcode|uccode|lccode|verb|Verb|lstinline|mintinline|url|href|path|string|let|"
+                               r"futurelet|scantokens|detokenize|unexpanded|input|include|lowercase|uppercase|"
+                               r"if[a-zA-Z@]*)(?![a-zA-Z@])|"
+                               r"\\begin\s*\{(?:verbatim|Verbatim|BVerbatim|lstlisting|minted|comment|filecontents|alltt)|"
+                               r"\^\^")
+    # Definitions may hide unmatched math shifts and environment delimiters inside macros
+    definitionPattern = re.compile(r"\\(?:[egx]?def(?![a-zA-Z@])|[a-zA-Z@]*(?:[cC]ommand|[eE]nviron))")
+    controlSequencePattern = re.compile(r"\\(?:[a-zA-Z]+|.?)", re.DOTALL)
+    environmentNamePattern = re.compile(r"\s*\{([^{}\\%]*)\}")
+    multilineCommentPattern = re.compile(r"\\iffalse inlatexbot\n.*?inlatexbot \\fi", re.DOTALL)
+
+    def validate(self, expression, preamble=None, checkEnvironments=True):
+        # Replace the bot's own multiline comments with blanks, keeping positions intact
+        expression = self.multilineCommentPattern.sub(lambda m: re.sub(r"[^\n]", " ", m.group(0)), expression)
+        context = expression if preamble is None else preamble + expression
+        if self.opaquePattern.search(context):
+            return
+        checkMath = not self.definitionPattern.search(context)
+        checkEnvironments = checkEnvironments and checkMath
+
+        braces = []
+        environments = []
+        math = None
+        mathPosition = None
+        idx = 0
+        while idx < len(expression):
+            char = expression[idx]
+            if char == "\\":
+                end = self.controlSequencePattern.match(expression, idx).end()
+                name = expression[idx+1:end]
+                if checkEnvironments and name in ("begin", "end"):
+                    match = self.environmentNamePattern.match(expression, end)
+                    if match is None:
+                        checkEnvironments = False
+                    else:
+                        environment = match.group(1).strip()
+                        if environment != "document":
+                            if name == "begin":
+                                environments.append((environment, idx))
+                            elif not environments:
+                                self._fail(expression, idx, "\\end{%s} without matching \\begin{%s}" % (environment, environment))
+                            else:
+                                openEnvironment, openPosition = environments.pop()
+                                if openEnvironment != environment:
+                                    self._fail(expression, idx, "\\begin{%s} on line %d ended by \\end{%s}" % (
+                                        openEnvironment, self._getLocation(expression, openPosition)[0], environment))
+                        end = match.end()
+                idx = end
+                continue
+            if char == "%":
+                newline = expression.find("\n", idx)
+                idx = len(expression) if newline == -1 else newline + 1
+                continue
+            if char == "{":
+                braces.append(idx)
+            elif char == "}":
+                if not braces:
+                    self._fail(expression, idx, "Extra }, or forgotten {")
+                braces.pop()
+            elif char == "$" and checkMath:
+                isDouble = expression.startswith("$$", idx)
+                if math is None:
+                    math = "$$" if isDouble else "$"
+                    mathPosition = idx
+                    idx += len(math)
+                    continue
+                if math == "$":
+                    math = None
+                elif isDouble:
+                    math = None
+                    idx += 2
+                    continue
+                else:
+                    # A single $ in display math is only valid in nested text, which is not tracked
+                    checkMath = False
+            elif char in "^_" and math is not None and checkMath:
+                nextChar = self._getNextSignificantChar(expression, idx + 1)
+                if nextChar is None or nextChar in "$}&":
+                    self._fail(expression, idx, "Missing argument for %s" % char)
+            idx += 1
+
+        if braces:
+            self._fail(expression, braces[-1], "Missing } for this {")
+        if math is not None and checkMath:
+            self._fail(expression, mathPosition, "Missing %s to close this %s" % (math, math))
+        if environments:
+            environment, position = environments[-1]
+            self._fail(expression, position, "\\begin{%s} is never ended" % environment)
+
+    def _getNextSignificantChar(self, expression, idx):
+        while idx < len(expression):
+            char = expression[idx]
+            if char == "%":
+                newline = expression.find("\n", idx)
+                if newline == -1:
+                    return None
+                idx = newline + 1
+            elif char.isspace():
+                idx += 1
+            else:
+                return char
+        return None
+
+    def _getLocation(self, expression, idx):
+        line = expression.count("\n", 0, idx) + 1
+        column = idx - (expression.rfind("\n", 0, idx) + 1) + 1
+        return line, column
+
+    def _fail(self, expression, idx, message):
+        line, column = self._getLocation(expression, idx)
+        raise ValueError("! %s.\nl.%d, column %d" % (message, line, column))
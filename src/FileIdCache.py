@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from threading import Lock
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+from src.SqliteStorage import SqliteStorage
+
+
+class FileIdCache():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, databaseFile="./resources/inlatexbot.sqlite", maxEntries=None):
+        if maxEntries is None:
+            maxEntries = Environment.getInt("LATEXBOT_FILE_ID_CACHE_ENTRIES", 10000)
+        self._storage = SqliteStorage(databaseFile, "file_ids")
+        self._maxEntries = max(1, maxEntries)
+        self._lock = Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self._fileIds = OrderedDict(self._storage.items())
+
+    def get(self, renderKey):
+        with self._lock:
+            fileId = self._fileIds.get(renderKey)
+            if fileId is None:
+                self._stats["misses"] += 1
+                return None
+            self._fileIds.move_to_end(renderKey)
+            self._stats["hits"] += 1
+            return fileId
+
+    def put(self, renderKey, fileId):
+        with self._lock:
+            self._fileIds[renderKey] = fileId
+            self._fileIds.move_to_end(renderKey)
+            self._storage.put(renderKey, fileId)
+            while len(self._fileIds) > self._maxEntries:
+                self._storage.delete(self._fileIds.popitem(last=False)[0])
+                self._stats["evictions"] += 1
+
+    def invalidate(self, renderKey):
+        with self._lock:
+            if self._fileIds.pop(renderKey, None) is not None:
+                self._stats["invalidations"] += 1
+                self._storage.delete(renderKey)
+                self.logger.debug("Invalidated file_id for %s", renderKey)
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._fileIds)
+        return stats
@@ -0,0 +1,172 @@
+from subprocess import CalledProcessError, TimeoutExpired
+from threading import Lock, Thread
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+from src.ProcessRunner import ProcessRunner
+
+
+class FormatCache():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, cacheDirectory=None, maxEntries=None, failureTtl=None):
+        if cacheDirectory is None:
+            cacheDirectory = Environment.getString("LATEXBOT_FORMAT_CACHE_DIR", "cache/formats")
+        if maxEntries is None:
+            maxEntries = Environment.getInt("LATEXBOT_FORMAT_CACHE_ENTRIES", 32)
+        if failureTtl is None:
+            failureTtl = Environment.getFloat("LATEXBOT_FORMAT_FAILURE_TTL_S", 3600)
+        self._cacheDirectory = os.path.abspath(cacheDirectory)
+        self._maxEntries = max(1, maxEntries)
+        self._failureTtl = failureTtl
+        self._buildLock = Lock()
+        self._scheduleLock = Lock()
+        self._scheduled = set()
+        self._engineVersion = None
+        self._processRunner = ProcessRunner()
+        os.makedirs(self._cacheDirectory, exist_ok=True)
+
+    def getFormatName(self, preamble, outputFormat="pdf"):
+        digest = hashlib.sha256()
+        digest.update(self._getEngineVersion().encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(preamble.encode("utf-8"))
+        if outputFormat != "pdf":
+            # Packages pick their driver while the preamble is loaded, a DVI format is dumped in DVI mode of its own
+            digest.update(b"\0" + outputFormat.encode("utf-8"))
+        return "preamble_" + digest.hexdigest()[:32]
+
+    def getEnvironment(self):
+        # An empty trailing path element makes kpathsea append the default format search path
+        environment = ProcessRunner.getTexEnvironment()
+        environment["TEXFORMATS"] = self._cacheDirectory + os.pathsep
+        return environment
+
+    def getFormat(self, preamble, outputFormat="pdf"):
+        formatName = self.getFormatName(preamble, outputFormat)
+        path = self._getPath(formatName, ".fmt")
+        try:
+            # Touch the format so that eviction drops the least recently used ones
+            os.utime(path)
+            return formatName
+        except FileNotFoundError:
+            return None
+
+    def getOrBuildFormat(self, preamble, outputFormat="pdf"):
+        formatName = self.getFormat(preamble, outputFormat)
+        if formatName is not None:
+            return formatName
+        with self._buildLock:
+            formatName = self.getFormat(preamble, outputFormat)
+            if formatName is not None:
+                return formatName
+            return self.buildFormat(preamble, outputFormat)
+
+    def getOrScheduleFormat(self, preamble, outputFormat="pdf"):
+        # Renders never wait for a dump: they compile the preamble from source until the format is there
+        formatName = self.getFormat(preamble, outputFormat)
+        if formatName is not None:
+            return formatName
+        formatName = self.getFormatName(preamble, outputFormat)
+        with self._scheduleLock:
+            if formatName in self._scheduled:
+                return None
+            self._scheduled.add(formatName)
+        Thread(target=self._buildScheduled, args=(formatName, preamble, outputFormat), name="format-dump", daemon=True).start()
+        return None
+
+    def buildFormat(self, preamble, outputFormat="pdf"):
+        formatName = self.getFormatName(preamble, outputFormat)
+        if self._hasFailed(formatName):
+            return None
+
+        buildDirectory = tempfile.mkdtemp(prefix=formatName + "_", dir=self._cacheDirectory)
+        try:
+            with open(os.path.join(buildDirectory, formatName + ".tex"), "w") as f:
+                f.write(preamble + "\n\\dump\n")
+            try:
+                self._processRunner.run(["pdflatex", "-ini", "-interaction=nonstopmode", "-output-format=" + outputFormat,
+                                         "-jobname=" + formatName, "&pdflatex", formatName + ".tex"],
+                                        timeout=30, cwd=buildDirectory, env=ProcessRunner.getTexEnvironment())
+            except CalledProcessError as err:
+                self.logger.warn("Could not dump format for preamble %s: %s", formatName, str(err))
+                if err.returncode > 0:
+                    # TeX rejected the preamble, no other process needs to try again for a while; a killed dump may
+                    # just have met a busy machine
+                    open(self._getPath(formatName, ".failed"), "w").close()
+                return None
+            except TimeoutExpired as err:
+                self.logger.warn("Could not dump format for preamble %s: %s", formatName, str(err))
+                return None
+            except FileNotFoundError:
+                return None
+            os.replace(os.path.join(buildDirectory, formatName + ".fmt"), self._getPath(formatName, ".fmt"))
+            self.logger.debug("Dumped format %s", formatName)
+        finally:
+            shutil.rmtree(buildDirectory, ignore_errors=True)
+
+        self._evict()
+        return formatName
+
+    def invalidate(self, formatName):
+        try:
+            os.remove(self._getPath(formatName, ".fmt"))
+            self.logger.debug("Invalidated format %s", formatName)
+        except FileNotFoundError:
+            pass
+
+    def _buildScheduled(self, formatName, preamble, outputFormat):
+        try:
+            self.getOrBuildFormat(preamble, outputFormat)
+        except OSError as err:
+            self.logger.warn("Could not dump format for preamble %s: %s", formatName, str(err))
+        finally:
+            with self._scheduleLock:
+                self._scheduled.discard(formatName)
+
+    def _hasFailed(self, formatName):
+        path = self._getPath(formatName, ".failed")
+        try:
+            if time.time() - os.path.getmtime(path) < self._failureTtl:
+                return True
+            # Packages may have been installed since, the dump is tried again
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _getPath(self, formatName, extension):
+        return os.path.join(self._cacheDirectory, formatName + extension)
+
+    def _evict(self):
+        formats = []
+        with os.scandir(self._cacheDirectory) as it:
+            for entry in it:
+                if entry.name.endswith(".fmt"):
+                    try:
+                        formats.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+        formats.sort()
+        for _, path in formats[:max(0, len(formats) - self._maxEntries)]:
+            try:
+                os.remove(path)
+                self.logger.debug("Evicted format %s", path)
+            except FileNotFoundError:
+                pass
+
+    def _getEngineVersion(self):
+        # Formats are only loadable by the exact engine build that dumped them
+        if self._engineVersion is None:
+            try:
+                self._engineVersion = self._processRunner.run(["pdflatex", "--version"],
+                                                              timeout=10).decode("utf-8", "replace").split("\n")[0]
+            except (CalledProcessError, TimeoutExpired, FileNotFoundError):
+                self._engineVersion = ""
+        return self._engineVersion
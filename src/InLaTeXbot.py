@@ -5,16 +5,21 @@ from time import sleep
 from telegram import InlineQueryResultArticle, InputTextMessageContent, \
     InlineQueryResultCachedPhoto, InlineQueryResult, TelegramError
 from telegram.ext import Updater, CommandHandler, InlineQueryHandler, \
-    MessageHandler, Filters, DispatcherHandlerStop
+    MessageHandler, Filters, DispatcherHandlerStop, ChosenInlineResultHandler
 import html
 
 from tqdm.notebook import tqdm
 
 from src.LatexConverter import LatexConverter
 from src.PreambleManager import PreambleManager
+from src.RenderCache import RenderCache
+from src.FormatCache import FormatCache
+from src.PdflatexWorkerPool import PdflatexWorkerPool
+from src.BuildDirectories import BuildDirectories
 from src.ResourceManager import ResourceManager
 from src.InlineQueryResponseDispatcher import InlineQueryResponseDispatcher
 from src.MessageQueryResponseDispatcher import MessageQueryResponseDispatcher
+from src.RenderScheduler import RenderScheduler
 from src.LoggingServer import LoggingServer
 from src.UserOptionsManager import UserOptionsManager
 from src.UsersManager import UsersManager
@@ -27,12 +32,19 @@ class InLaTeXbot():
 
         self._updater = updater
         self._resourceManager = ResourceManager()
+        self._resourceManager.validate()
         self._userOptionsManager = UserOptionsManager()
         self._usersManager = UsersManager()
-        self._preambleManager = PreambleManager(self._resourceManager)
-        self._latexConverter = LatexConverter(self._preambleManager, self._userOptionsManager)
-        self._inlineQueryResponseDispatcher = InlineQueryResponseDispatcher(updater.bot, self._latexConverter, self._resourceManager, self._userOptionsManager, devnullChatId)
-        self._messageQueryResponseDispatcher = MessageQueryResponseDispatcher(updater.bot, self._latexConverter, self._resourceManager)
+        self._formatCache = FormatCache()
+        self._buildDirectories = BuildDirectories()
+        self._preambleManager = PreambleManager(self._resourceManager, formatCache=self._formatCache, buildDirectories=self._buildDirectories)
+        self._renderCache = RenderCache()
+        self._latexConverter = LatexConverter(self._preambleManager, self._userOptionsManager, self._renderCache, self._formatCache,
+                                              PdflatexWorkerPool(self._formatCache, workingDirectory=self._buildDirectories.getRoot()),
+                                              buildDirectories=self._buildDirectories)
+        self._renderScheduler = RenderScheduler()
+        self._inlineQueryResponseDispatcher = InlineQueryResponseDispatcher(updater.bot, self._latexConverter, self._resourceManager, self._userOptionsManager, devnullChatId, self._renderScheduler)
+        self._messageQueryResponseDispatcher = MessageQueryResponseDispatcher(updater.bot, self._latexConverter, self._resourceManager, self._renderScheduler, self._userOptionsManager)
         self._devnullChatId = devnullChatId
         self._messageFilters = []
 
@@ -45,6 +57,8 @@ class InLaTeXbot():
         self._updater.dispatcher.add_handler(CommandHandler('setcodeincaptionon', self.onSetCodeInCaptionOn))
         self._updater.dispatcher.add_handler(CommandHandler('setcodeincaptionoff', self.onSetCodeInCaptionOff))
         self._updater.dispatcher.add_handler(CommandHandler("setdpi", self.onSetDpi))
+        self._updater.dispatcher.add_handler(CommandHandler('setformatpng', self.onSetFormatPng))
+        self._updater.dispatcher.add_handler(CommandHandler('setformatsvg', self.onSetFormatSvg))
         self._updater.dispatcher.add_handler(MessageHandler(Filters.text, self.dispatchTextMessage), 1)
         
         self._messageFilters.append(self.filterPreamble)
@@ -52,6 +66,7 @@ class InLaTeXbot():
         
         inline_handler = InlineQueryHandler(self.onInlineQuery)
         self._updater.dispatcher.add_handler(inline_handler)
+        self._updater.dispatcher.add_handler(ChosenInlineResultHandler(self.onChosenInlineResult))
         
         self._usersRequestedCustomPreambleRegistration = set()
 
@@ -66,7 +81,7 @@ class InLaTeXbot():
     
     def onStart(self, update, context):
         senderId = update.message.from_user.id 
-        if not senderId in self._usersManager.getKnownUsers():
+        if not self._usersManager.isKnownUser(senderId):
             self._usersManager.setUser(senderId, {})
             self.logger.debug("Added a new user to database")
             
@@ -176,6 +191,20 @@ class InLaTeXbot():
 
         raise DispatcherHandlerStop
         
+    def onSetFormatPng(self, update, context):
+        userId = update.message.from_user.id
+        self._userOptionsManager.setOutputFormatOption(userId, "png")
+        update.message.reply_text(self._resourceManager.getString("format_set_png"))
+
+        raise DispatcherHandlerStop
+
+    def onSetFormatSvg(self, update, context):
+        userId = update.message.from_user.id
+        self._userOptionsManager.setOutputFormatOption(userId, "svg")
+        update.message.reply_text(self._resourceManager.getString("format_set_svg"))
+
+        raise DispatcherHandlerStop
+
     def onInlineQuery(self, update, context):
         if not update.inline_query.query:
             return
@@ -184,6 +213,13 @@ class InLaTeXbot():
         self._inlineQueryResponseDispatcher.dispatchInlineQueryResponse(update.inline_query)
 
         raise DispatcherHandlerStop
+
+    def onChosenInlineResult(self, update, context):
+        update.chosen_inline_result.query = html.unescape(update.chosen_inline_result.query)
+        update.chosen_inline_result.query = update.chosen_inline_result.query.replace("<br/>", "\n")
+        self._inlineQueryResponseDispatcher.dispatchChosenInlineResult(update.chosen_inline_result)
+
+        raise DispatcherHandlerStop
         
     def broadcastHTMLMessage(self, message, userIds, parse_mode="HTML", force = False):
         if not force:
@@ -0,0 +1,61 @@
+from threading import Lock
+import time
+
+from src.Environment import Environment
+
+
+class InlineQueryDebouncer():
+
+    def __init__(self, minDelay=None, maxDelay=None, idleGap=None):
+        if minDelay is None:
+            minDelay = Environment.getInt("LATEXBOT_DEBOUNCE_MIN_MS", 100) / 1000
+        if maxDelay is None:
+            maxDelay = Environment.getInt("LATEXBOT_DEBOUNCE_MAX_MS", 800) / 1000
+        if idleGap is None:
+            idleGap = Environment.getInt("LATEXBOT_DEBOUNCE_IDLE_MS", 1500) / 1000
+        self._minDelay = max(0.0, minDelay)
+        self._maxDelay = max(self._minDelay, maxDelay)
+        self._idleGap = idleGap
+        self._lock = Lock()
+        self._lastArrivals = {}
+        self._typingIntervals = {}
+        self._stats = {"immediate": 0, "delayed": 0, "debounced": 0}
+
+    def getDelay(self, userId, load=0.0, now=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            lastArrival = self._lastArrivals.get(userId)
+            self._lastArrivals[userId] = now
+            if lastArrival is None or now - lastArrival > self._idleGap:
+                # First query after a pause, most likely a pasted expression: render right away
+                self._typingIntervals.pop(userId, None)
+                self._stats["immediate"] += 1
+                self._prune(now)
+                return 0.0
+
+            interval = now - lastArrival
+            typingInterval = self._typingIntervals.get(userId, interval)
+            typingInterval = 0.7 * typingInterval + 0.3 * interval
+            self._typingIntervals[userId] = typingInterval
+            self._stats["delayed"] += 1
+
+        # Wait a bit longer than the user's usual pause between keystrokes, and longer still under load
+        delay = 1.5 * typingInterval * (1 + min(1.0, max(0.0, load)))
+        return min(self._maxDelay, max(self._minDelay, delay))
+
+    def recordDebounced(self):
+        with self._lock:
+            self._stats["debounced"] += 1
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _prune(self, now):
+        if len(self._lastArrivals) < 10000:
+            return
+        for userId, lastArrival in list(self._lastArrivals.items()):
+            if now - lastArrival > self._idleGap:
+                del self._lastArrivals[userId]
+                self._typingIntervals.pop(userId, None)
@@ -1,23 +1,35 @@
-from multiprocessing import Process, Lock, Event
-from threading import Thread
+from threading import Event, Timer
 import re
+import uuid
 
 from telegram import InlineQueryResultArticle, InputTextMessageContent, \
-    InlineQueryResultCachedPhoto, TelegramError, ParseMode
+    InlineQueryResultCachedPhoto, TelegramError, ParseMode, InlineKeyboardMarkup, \
+    InlineKeyboardButton, InputMediaPhoto
+from telegram.error import BadRequest
 
+from src.Environment import Environment
 from src.LoggingServer import LoggingServer
+from src.RenderScheduler import RenderScheduler
+from src.ProcessRunner import RenderCancelledError
+from src.InlineQueryDebouncer import InlineQueryDebouncer
+from src.FileIdCache import FileIdCache
 
 
 class InlineQueryResponseDispatcher():
     logger = LoggingServer.getInstance()
 
-    def __init__(self, bot, latexConverter, resourceManager, userOptionsManager, devnullChatId):
+    def __init__(self, bot, latexConverter, resourceManager, userOptionsManager, devnullChatId, renderScheduler=None,
+                 debouncer=None, fileIdCache=None):
         self._bot = bot
         self._latexConverter = latexConverter
         self._resourceManager = resourceManager
         self._userOptionsManager = userOptionsManager
         self._devnullChatId = devnullChatId
         self._nextQueryArrivedEvents = {}
+        self._renderScheduler = renderScheduler if renderScheduler is not None else RenderScheduler()
+        self._debouncer = debouncer if debouncer is not None else InlineQueryDebouncer()
+        self._fileIdCache = fileIdCache if fileIdCache is not None else FileIdCache()
+        self._previewDpi = Environment.getInt("LATEXBOT_INLINE_PREVIEW_DPI", 0)
 
     def dispatchInlineQueryResponse(self, inline_query):
 
@@ -30,33 +42,70 @@ class InlineQueryResponseDispatcher():
         except KeyError:
             self._nextQueryArrivedEvents[inline_query.from_user.id] = Event()
 
-        responder = Process(target=self.respondToInlineQuery, args=[inline_query,
-                                                                    self._nextQueryArrivedEvents[
-                                                                        inline_query.from_user.id]])
-        responder.start()
-        Thread(target=self.joinProcess, args=[responder]).start()
+        nextQueryArrivedEvent = self._nextQueryArrivedEvents[inline_query.from_user.id]
+        delay = self._debouncer.getDelay(inline_query.from_user.id, self._renderScheduler.getLoad())
+        if delay > 0:
+            # Only render the query if it stays the latest one for the whole debounce window
+            timer = Timer(delay, self.submitInlineQuery, [inline_query, nextQueryArrivedEvent])
+            timer.daemon = True
+            timer.start()
+        else:
+            self.submitInlineQuery(inline_query, nextQueryArrivedEvent)
 
-    def joinProcess(self, process):
-        process.join()
+    def submitInlineQuery(self, inline_query, nextQueryArrivedEvent):
+        if nextQueryArrivedEvent.is_set():
+            self._debouncer.recordDebounced()
+            return
+        # Queued renders of the user's older queries are dropped, only the newest one is ever answered
+        if not self._renderScheduler.submit(inline_query.from_user.id, self.respondToInlineQuery, inline_query,
+                                            nextQueryArrivedEvent, replaceKey="inline_query"):
+            self.answerBusy(inline_query)
+
+    def answerBusy(self, inline_query):
+        busyMessage = self._resourceManager.getString("server_busy")
+        try:
+            self._bot.answerInlineQuery(inline_query.id, [InlineQueryResultArticle(0, busyMessage,
+                                                            InputTextMessageContent(inline_query.query))], cache_time=0)
+        except TelegramError as err:
+            self.logger.warn(self._resourceManager.getString("telegram_error") + str(err))
 
     def respondToInlineQuery(self, inline_query, nextQueryArrivedEvent):
         senderId = inline_query.from_user.id
         queryId = inline_query.id
         expression = inline_query.query
 
+        if self.skipForNewerQuery(nextQueryArrivedEvent, senderId, expression):
+            return
+
         expression = self.processMultilineComments(senderId, expression)
 
         caption = self.generateCaption(senderId, expression)
 
+        codeInCaption = self._userOptionsManager.getCodeInCaptionOption(senderId)
+
+        previewDpi = self.getPreviewDpi(senderId)
+        # A preview needs an inline keyboard, otherwise Telegram won't let us edit the sent message later
+        replyMarkup = self.getPreviewMarkup(inline_query.query) if previewDpi is not None else None
+
+        renderKey = self._latexConverter.getRenderKeyForExpression(expression, senderId, previewDpi)
+        if self.answerFromFileIdCache(queryId, renderKey, caption, codeInCaption, replyMarkup):
+            self.logger.debug("Answered to inline query from %d from file_id cache, expression: %s", senderId,
+                              expression)
+            return
+
         result = None
         try:
-            expressionPngFileStream = self._latexConverter.convertExpression(expression, senderId,
-                                                                             str(queryId) + "_" + str(senderId))
-            if not nextQueryArrivedEvent.is_set():
-                result = self.uploadImage(expressionPngFileStream, expression, caption,
-                                          self._userOptionsManager.getCodeInCaptionOption(senderId))
+            # Only the PNG is ever sent inline, the PDF is never produced for it
+            with self._latexConverter.convertExpression(expression, senderId, str(queryId) + "_" + str(senderId),
+                                                        cancelEvent=nextQueryArrivedEvent, dpi=previewDpi) as render:
+                if not nextQueryArrivedEvent.is_set():
+                    result = self.uploadImage(render.open("png"), expression, caption, codeInCaption, replyMarkup,
+                                              renderKey)
         except ValueError as err:
             result = self.getWrongSyntaxResult(expression, err.args[0])
+        except RenderCancelledError:
+            # A newer query from the same user killed the render, nothing to answer
+            pass
         except TelegramError as err:
             errorMessage = self._resourceManager.getString("telegram_error") + str(err)
             self.logger.warn(errorMessage)
@@ -66,6 +115,74 @@ class InlineQueryResponseDispatcher():
                 self._bot.answerInlineQuery(queryId, [result], cache_time=0)
                 self.logger.debug("Answered to inline query from %d, expression: %s", senderId, expression)
 
+    def dispatchChosenInlineResult(self, chosen_inline_result):
+        if chosen_inline_result.inline_message_id is None or \
+                self.getPreviewDpi(chosen_inline_result.from_user.id) is None:
+            return
+        self.logger.debug("Inline result chosen for query: %s, from user: %d", chosen_inline_result.query,
+                          chosen_inline_result.from_user.id)
+        if not self._renderScheduler.submit(chosen_inline_result.from_user.id, self.respondToChosenInlineResult,
+                                            chosen_inline_result):
+            self.logger.warn("Could not schedule full quality render for %s", chosen_inline_result.query)
+
+    def respondToChosenInlineResult(self, chosen_inline_result):
+        senderId = chosen_inline_result.from_user.id
+        expression = self.processMultilineComments(senderId, chosen_inline_result.query)
+        caption = self.generateCaption(senderId, expression)
+        codeInCaption = self._userOptionsManager.getCodeInCaptionOption(senderId)
+
+        renderKey = self._latexConverter.getRenderKeyForExpression(expression, senderId)
+        latex_picture_id = self._fileIdCache.get(renderKey)
+        try:
+            if latex_picture_id is None:
+                with self._latexConverter.convertExpression(expression, senderId,
+                                                            uuid.uuid4().hex + "_" + str(senderId)) as render:
+                    latex_picture_id = self._bot.sendPhoto(self._devnullChatId, render.open("png")).photo[0].file_id
+                self._fileIdCache.put(renderKey, latex_picture_id)
+            self._bot.editMessageMedia(inline_message_id=chosen_inline_result.inline_message_id,
+                                       media=InputMediaPhoto(latex_picture_id, caption=caption,
+                                                             parse_mode=ParseMode.MARKDOWN if not codeInCaption else None))
+            self.logger.debug("Replaced preview with full quality image for %s", expression)
+        except ValueError as err:
+            self.logger.warn("Full quality render failed for %s: %s", expression, str(err))
+        except TelegramError as err:
+            self.logger.warn(self._resourceManager.getString("telegram_error") + str(err))
+            if self.isFileIdRejected(err):
+                self._fileIdCache.invalidate(renderKey)
+
+    def answerFromFileIdCache(self, queryId, renderKey, caption, codeInCaption, replyMarkup=None):
+        latex_picture_id = self._fileIdCache.get(renderKey)
+        if latex_picture_id is None:
+            return False
+        try:
+            self._bot.answerInlineQuery(queryId, [self.getCachedPhotoResult(latex_picture_id, caption, codeInCaption,
+                                                                            replyMarkup)], cache_time=0)
+            return True
+        except TelegramError as err:
+            # Telegram may reject ids it no longer knows, upload the image again in that case
+            self.logger.warn("Cached file_id for %s was rejected: %s", renderKey, str(err))
+            self._fileIdCache.invalidate(renderKey)
+            return False
+
+    def isFileIdRejected(self, err):
+        # Timeouts, network errors or an unchanged message say nothing about the file_id, keep it for the next request
+        return isinstance(err, BadRequest) and re.search(r"file.?id|file identifier", str(err), re.IGNORECASE) is not None
+
+    def getCachedPhotoResult(self, latex_picture_id, caption, code_in_caption, reply_markup=None):
+        return InlineQueryResultCachedPhoto(0, photo_file_id=latex_picture_id,
+                                            caption=caption,
+                                            parse_mode=ParseMode.MARKDOWN if not code_in_caption else None,
+                                            reply_markup=reply_markup)
+
+    def getPreviewDpi(self, senderId):
+        if self._previewDpi <= 0 or self._previewDpi >= self._userOptionsManager.getDpiOption(senderId):
+            return None
+        return self._previewDpi
+
+    def getPreviewMarkup(self, query):
+        return InlineKeyboardMarkup([[InlineKeyboardButton(self._resourceManager.getString("edit_expression"),
+                                                           switch_inline_query_current_chat=query)]])
+
     def skipForNewerQuery(self, nextQueryArrivedEvent, senderId, expression):
         if nextQueryArrivedEvent.is_set():
             self.logger.debug("Skipped answering query from %d, expression: %s; newer query arrived", senderId,
@@ -82,7 +199,7 @@ class InlineQueryResponseDispatcher():
             errorMessage = self._resourceManager.getString("latex_syntax_error")
         return InlineQueryResultArticle(0, errorMessage, InputTextMessageContent(query), description=latexError)
 
-    def uploadImage(self, image, expression, caption, code_in_caption):
+    def uploadImage(self, image, expression, caption, code_in_caption, reply_markup=None, renderKey=None):
         attempts = 0
         errorMessage = None
 
@@ -90,10 +207,10 @@ class InlineQueryResponseDispatcher():
             try:
                 latex_picture_id = self._bot.sendPhoto(self._devnullChatId, image).photo[0].file_id
                 self.logger.debug("Image successfully uploaded for %s", expression)
+                if renderKey is not None:
+                    self._fileIdCache.put(renderKey, latex_picture_id)
 
-                return InlineQueryResultCachedPhoto(0, photo_file_id=latex_picture_id,
-                                                    caption=caption,
-                                                    parse_mode=ParseMode.MARKDOWN if not code_in_caption else None)
+                return self.getCachedPhotoResult(latex_picture_id, caption, code_in_caption, reply_markup)
             except TelegramError as err:
                 errorMessage = self._resourceManager.getString("telegram_error") + str(err)
                 self.logger.warn(errorMessage)
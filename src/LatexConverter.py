@@ -1,27 +1,70 @@
-from subprocess import check_output, CalledProcessError, STDOUT, TimeoutExpired
+from subprocess import CalledProcessError, TimeoutExpired, PIPE
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
 
 from src.PreambleManager import PreambleManager
 from src.LoggingServer import LoggingServer
-import io
+from src.RenderCache import RenderCache
+from src.CompileErrorCache import CompileErrorCache
+from src.ExpressionValidator import ExpressionValidator
+from src.PreambleTiers import PreambleTiers
+from src.BuildDirectories import BuildDirectories
+from src.PngImage import PngImage
+from src.SingleFlight import SingleFlight
+from src.StageGraph import StageGraph
+from src.RenderResult import RenderResult
+from src.RenderWorkspace import RenderWorkspaces
+from src.Environment import Environment
+from src.ProcessRunner import ProcessRunner, RenderCancelledError
+import asyncio
+import math
 import re
 import shutil
 import os
-import glob
+import time
 
 
 class LatexConverter():
 
     logger = LoggingServer.getInstance()
+    # Resolution of the pass that measures a DVI before it is rasterised at the requested one
+    dviProbeDpi = 30
     
-    def __init__(self, preambleManager, userOptionsManager):
+    def __init__(self, preambleManager, userOptionsManager, renderCache=None, formatCache=None, workerPool=None,
+                 errorCache=None, preambleTiers=None, buildDirectories=None):
          self._preambleManager = preambleManager
          self._userOptionsManager = userOptionsManager
+         self._renderCache = renderCache
+         self._formatCache = formatCache
+         self._workerPool = workerPool
+         self._errorCache = errorCache if errorCache is not None else CompileErrorCache()
+         self._expressionValidator = ExpressionValidator()
+         self._preambleTiers = preambleTiers if preambleTiers is not None else PreambleTiers(preambleManager)
+         self._buildDirectories = buildDirectories if buildDirectories is not None else BuildDirectories()
+         self._ghostscriptPipes = Environment.getBool("LATEXBOT_GS_PIPES", True)
+         # Off until benchmark/DviPathBenchmark.py shows that dvipng beats Ghostscript on the host
+         self._dviFastPath = Environment.getBool("LATEXBOT_DVI_FAST_PATH", False)
+         self._singleFlight = SingleFlight()
+         self._workspaces = RenderWorkspaces(self._buildDirectories, self._singleFlight)
+         self._executor = None
+         self._executorLock = Lock()
+         self._processRunner = ProcessRunner()
+         self._statsLock = Lock()
+         self._stageDurations = {}
+         self._cancellationStats = {"cancelled": 0, "stages_skipped": 0, "seconds_saved": 0.0}
+         self._dviStats = {"renders": 0, "fallbacks": 0}
+         # Bounds on the rasterised output, whatever DPI the user chose; 0 disables a bound
+         self._maxPixels = max(0, Environment.getInt("LATEXBOT_MAX_PIXELS", 16000000))
+         self._maxPngBytes = max(0, Environment.getInt("LATEXBOT_MAX_PNG_BYTES", 10 * 1024 * 1024))
+         self._pixelBudgetStats = {"pixel_capped": 0, "byte_capped": 0, "pixels_saved": 0}
 
-    def extractBoundingBox(self, dpi, pathToPdf):
+    def measureBoundingBox(self, pathToPdf, cancelEvent=None):
         try:
             gs = self._get_gs_executable()
-            bbox = check_output([gs, "-q", "-dBATCH", "-dNOPAUSE", "-sDEVICE=bbox", pathToPdf],
-                                stderr=STDOUT).decode("ascii")
+            bbox = self._processRunner.run([gs, "-q", "-dBATCH", "-dNOPAUSE", "-sDEVICE=bbox", pathToPdf],
+                                           cancelEvent=cancelEvent).decode("ascii")
         except CalledProcessError:
             raise ValueError("Could not extract bounding box! Empty expression?")
         except FileNotFoundError:
@@ -34,13 +77,18 @@ class LatexConverter():
         if bounds[0] == bounds[2] or bounds[1] == bounds[3]:
             self.logger.warn("Expression had zero width/height bbox!")
             raise ValueError("Empty expression!")
+        return bounds
+
+    def extractBoundingBox(self, dpi, pathToPdf, bounds=None):
+        if bounds is None:
+            bounds = self.measureBoundingBox(pathToPdf)
 
         hpad = 0.25 * 72  # 72 postscript points = 1 inch
         vpad = .1 * 72
-        llc = bounds[:2]
+        llc = list(bounds[:2])
         llc[0] -= hpad
         llc[1] -= vpad
-        ruc = bounds[2:]
+        ruc = list(bounds[2:])
         ruc[0] += hpad
         ruc[1] += vpad
         size_factor = dpi/72
@@ -66,80 +114,218 @@ class LatexConverter():
             if line[:2]=="! ":
                 return "".join(log[idx:idx+2])
         
-    def pdflatex(self, fileName):
+    def pdflatex(self, fileName, formatName=None, cancelEvent=None, outputDirectory="build", outputFormat="pdf"):
+        args = ['pdflatex', '-interaction=nonstopmode', '-output-directory', outputDirectory]
+        if outputFormat != "pdf":
+            args.append('-output-format=' + outputFormat)
+        environment = ProcessRunner.getTexEnvironment()
+        if formatName is not None:
+            args.append('-fmt=' + formatName)
+            environment = self._formatCache.getEnvironment()
+        args.append(fileName)
         try:
-            check_output([
-                'pdflatex',
-                '-interaction=nonstopmode',
-                '-output-directory', 'build',
-                fileName
-            ], stderr=STDOUT, timeout=5)
-        except CalledProcessError:
-            with open(fileName[:-3] + "log", "r") as f:
-                msg = self.getError(f.readlines())
-                self.logger.debug(msg)
+            self._processRunner.run(args, timeout=5, cancelEvent=cancelEvent, env=environment)
+        except CalledProcessError as err:
+            if err.returncode < 0:
+                # Killed by a signal (CPU, memory or output limit), whatever the log says is incomplete
+                raise ValueError("Pdflatex exceeded its resource limits and had to be killed.")
+            try:
+                with open(fileName[:-3] + "log", "r") as f:
+                    msg = self.getError(f.readlines())
+                    self.logger.debug(msg)
+            except FileNotFoundError:
+                msg = None
             raise ValueError(msg)
         except TimeoutExpired:
             msg = "Pdflatex has likely hung up and had to be killed. Congratulations!"
             raise ValueError(msg)
     
-    def cropPdf(self, sessionId): # TODO: this is intersecting with the png part
+    def compile(self, fileName, fileString, formatName=None, documentString=None, cancelEvent=None, outputFormat="pdf"):
         try:
-            gs = self._get_gs_executable()
-            bbox = check_output([gs, "-q", "-dBATCH", "-dNOPAUSE", "-sDEVICE=bbox", f"build/expression_file_{sessionId}.pdf"], 
-                                stderr=STDOUT).decode("ascii")
-        except FileNotFoundError:
-            raise ValueError("Ghostscript not found. Please install Ghostscript and ensure it is on PATH.")
-        llx, lly, urx, ury = tuple([int(_) for _ in bbox[bbox.index(":")+2:bbox.index("\n")].split(" ")])
-        # Add configurable margin (points). Default 24pt (~1/3 inch) for comfortable whitespace.
-        try:
-            margin = float(os.environ.get("LATEXBOT_PDF_MARGIN_PT", "24"))
-        except ValueError:
-            margin = 24.0
-        margin = max(0.0, margin)
+            if formatName is None or not self._compileWithWorker(fileName, formatName, documentString, cancelEvent):
+                self.pdflatex(fileName, formatName, cancelEvent, os.path.dirname(fileName) or ".", outputFormat)
+        except ValueError as err:
+            # A compilation error is always reported in the log; a missing one means the format could not be loaded
+            if formatName is None or err.args[0] is not None:
+                raise
+            self.logger.warn("Format %s could not be loaded, compiling with the full preamble", formatName)
+            self._formatCache.invalidate(formatName)
+            with open(fileName, "w+") as f:
+                f.write(fileString)
+            self.pdflatex(fileName, cancelEvent=cancelEvent, outputDirectory=os.path.dirname(fileName) or ".", outputFormat=outputFormat)
+
+    def _compileTiers(self, directory, sessionId, tiers, fileString, documentString, cancelEvent=None, outputFormat="pdf"):
+        for idx, (tier, preamble) in enumerate(tiers):
+            startTime = time.time()
+            try:
+                self._compileWithPreamble(directory, sessionId, preamble, fileString if preamble is None else preamble + documentString,
+                                          documentString, warm=tier in ("minimal", "default"), cancelEvent=cancelEvent,
+                                          outputFormat=outputFormat)
+            except ValueError as err:
+                if idx + 1 == len(tiers) or not self._preambleTiers.isMissingDefinition(err.args[0]):
+                    raise
+                self.logger.debug("Escalating from the %s preamble: %s", tier, err.args[0])
+                self._preambleTiers.learn(err.args[0])
+                continue
+            if tier is not None:
+                self._preambleTiers.recordCompile(tier, time.time() - startTime, idx > 0)
+            return
+
+    def _compileWithPreamble(self, directory, sessionId, preamble, fileString, documentString, warm=False, cancelEvent=None,
+                             outputFormat="pdf"):
+        formatName = None
+        if preamble is not None and self._formatCache is not None:
+            formatName = self._formatCache.getOrScheduleFormat(preamble, outputFormat)
+        if formatName is not None and warm and self._workerPool is not None:
+            # Keep workers with the common preambles already loaded for the next requests
+            self._workerPool.warm(formatName)
+
+        fileName = os.path.join(directory, "expression_file_%s.tex"%sessionId)
+        with open(fileName, "w+") as f:
+            f.write(fileString if formatName is None else documentString)
+        self.compile(fileName, fileString, formatName, documentString, cancelEvent, outputFormat)
+
+    def _compileWithWorker(self, fileName, formatName, documentString, cancelEvent=None):
+        if self._workerPool is None:
+            return False
+        return self._workerPool.compile(formatName, documentString, fileName[:-4], cancelEvent=cancelEvent)
+
+    def cropPdf(self, sessionId, bounds=None, cancelEvent=None, directory="build"):
+        gs = self._get_gs_executable()
+        if bounds is None:
+            bounds = self.measureBoundingBox(os.path.join(directory, f"expression_file_{sessionId}.pdf"), cancelEvent)
+        llx, lly, urx, ury = bounds
+        margin = self._getPdfMargin()
         # Expand bbox by margin on all sides
         width_pts = (urx - llx) + int(2 * margin)
         height_pts = (ury - lly) + int(2 * margin)
         # Translate content so that original lower-left is at (margin, margin)
         offset_x = -llx + int(margin)
         offset_y = -lly + int(margin)
-        out_pdf = f"build/expression_file_cropped_{sessionId}.pdf"
-        in_pdf = f"build/expression_file_{sessionId}.pdf"
+        out_pdf = os.path.join(directory, f"expression_file_cropped_{sessionId}.pdf")
+        in_pdf = os.path.join(directory, f"expression_file_{sessionId}.pdf")
         # Set exact page size and translate content so the expression sits at origin
+        args = [gs, "-sDEVICE=pdfwrite",
+                f"-dDEVICEWIDTHPOINTS={width_pts}", f"-dDEVICEHEIGHTPOINTS={height_pts}", "-dFIXEDMEDIA",
+                "-c", f"<</PageOffset [{offset_x} {offset_y}]>> setpagedevice",
+                "-f", in_pdf]
         try:
-            check_output([gs, "-o", out_pdf, "-sDEVICE=pdfwrite",
-                          f"-dDEVICEWIDTHPOINTS={width_pts}", f"-dDEVICEHEIGHTPOINTS={height_pts}", "-dFIXEDMEDIA",
-                          "-c", f"<</PageOffset [{offset_x} {offset_y}]>> setpagedevice",
-                          "-f", in_pdf], stderr=STDOUT)
+            return self._runGhostscript(args, out_pdf, cancelEvent)
         except FileNotFoundError:
             raise ValueError("Ghostscript not found. Please install Ghostscript and ensure it is on PATH.")
             
-    def convertPdfToPng(self, dpi, sessionId, bbox):
+    def convertPdfToPng(self, dpi, sessionId, bbox, cancelEvent=None, directory="build"):
         gs = self._get_gs_executable()
-        out_png = f"build/expression_{sessionId}.png"
-        in_pdf = f"build/expression_file_{sessionId}.pdf"
+        out_png = os.path.join(directory, f"expression_{sessionId}_{dpi}.png")
+        in_pdf = os.path.join(directory, f"expression_file_{sessionId}.pdf")
         width, height, tx, ty = bbox
-        # Default to white background to avoid black/transparent appearance in some viewers.
-        transparent = os.environ.get("LATEXBOT_TRANSPARENT", "").lower() in ("1", "true", "yes", "on")
+        transparent = self._isTransparent()
         device = "pngalpha" if transparent else "png16m"
-        args = [gs, "-o", out_png, f"-r{dpi}", f"-g{int(width)}x{int(height)}", "-dLastPage=1",
+        args = [gs, f"-r{dpi}", f"-g{int(width)}x{int(height)}", "-dLastPage=1",
                 "-sDEVICE=" + device,
                 "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4",
                 "-c", f"<</Install {{{int(tx)} {int(ty)} translate}}>> setpagedevice",
                 "-f", in_pdf]
         if not transparent:
             # White background for non-alpha device
-            args.insert(6, "-dBackgroundColor=16#FFFFFF")
+            args.insert(5, "-dBackgroundColor=16#FFFFFF")
         try:
-            check_output(args, stderr=STDOUT)
+            return self._runGhostscript(args, out_png, cancelEvent)
         except FileNotFoundError:
             raise ValueError("Ghostscript not found. Please install Ghostscript and ensure it is on PATH.")
 
-    def convertExpression(self, expression, userId, sessionId, returnPdf = False):
+    def convertDviToPng(self, dpi, sessionId, cancelEvent=None, directory="build"):
+        out_png = os.path.join(directory, f"expression_{sessionId}_{dpi}.png")
+        transparent = self._isTransparent()
+        # dvipng crops to the inked pixels itself, so no separate bounding box pass is needed
+        with open(self._runDvipng(dpi, sessionId, out_png, cancelEvent, directory), "rb") as f:
+            image = PngImage.decode(f.read())
+        if image.width <= 1 or image.height <= 1:
+            raise ValueError("Empty expression!")
+
+        width, height, left, bottom = self._getDviCanvas(dpi, image.width, image.height)
+        right = max(0, width - image.width - left)
+        top = max(0, height - image.height - bottom)
+        return image.pad(left, top, right, bottom, transparent).encode()
+
+    def measureDviCanvas(self, dpi, sessionId, cancelEvent=None, directory="build"):
+        # The tight box grows linearly with the resolution, a coarse pass is enough to know the full one
+        probeDpi = min(dpi, self.dviProbeDpi)
+        with open(self._runDvipng(probeDpi, sessionId, os.path.join(directory, f"probe_{sessionId}_{dpi}.png"),
+                                  cancelEvent, directory), "rb") as f:
+            width, height = PngImage.getSize(f.read(24))
+        width, height, _, _ = self._getDviCanvas(dpi, width * dpi / probeDpi, height * dpi / probeDpi)
+        return width, height
+
+    def _runDvipng(self, dpi, sessionId, out_png, cancelEvent=None, directory="build"):
+        in_dvi = os.path.join(directory, f"expression_file_{sessionId}.dvi")
+        try:
+            self._processRunner.run(["dvipng", "-q", "-T", "tight", "-D", str(dpi), "-pp", "1",
+                                     "-bg", "Transparent" if self._isTransparent() else "rgb 1 1 1", "-o", out_png, in_dvi],
+                                    cancelEvent=cancelEvent)
+        except CalledProcessError:
+            raise ValueError("Could not convert DVI to PNG!")
+        except FileNotFoundError:
+            raise ValueError("dvipng not found.")
+        return out_png
+
+    def _getDviCanvas(self, dpi, imageWidth, imageHeight):
+        # Same padding and aspect ratio as the canvas extractBoundingBox computes for the PDF path
+        hpad = 0.25 * dpi
+        vpad = .1 * dpi
+        width, height, translation_x, translation_y = self.correctBoundingBoxAspectRaito(
+            dpi, (imageWidth + 2*hpad, imageHeight + 2*vpad, 0, 0))
+        left = int(hpad + translation_x*dpi/72)
+        bottom = int(vpad + translation_y*dpi/72)
+        return int(width), int(height), left, bottom
+
+    def convertDviToSvg(self, sessionId, fullDocument=False, cancelEvent=None, directory="build"):
+        in_dvi = os.path.join(directory, f"expression_file_{sessionId}.dvi")
+        # Glyphs become paths so that the SVG looks the same everywhere; expressions get the same margin as the cropped PDF
+        bbox = "papersize" if fullDocument else "%gpt" % self._getPdfMargin()
+        try:
+            svg = self._processRunner.run(["dvisvgm", "--no-fonts", "--exact-bbox", "--bbox=" + bbox, "--page=1",
+                                           "--stdout", in_dvi], cancelEvent=cancelEvent, stderr=PIPE)
+        except CalledProcessError:
+            raise ValueError("Could not convert DVI to SVG!")
+        except FileNotFoundError:
+            raise ValueError("dvisvgm not found. Please install it (it ships with TeX Live) and ensure it is on PATH.")
+        if b"<path" not in svg and b"<rect" not in svg:
+            raise ValueError("Empty expression!")
+        return svg
 
+    def _renderDvi(self, result, progress, directory, sessionId, tiers, fileString, documentString, dpi, cancelEvent=None):
+        # The same compilation as the SVG's, with the preamble tiers, formats and workers of the PDF path
+        self._ensureCompiled(result, progress, directory, sessionId, tiers, fileString, documentString, cancelEvent, "dvi")
+        sessionId = self._getStem(sessionId, "dvi")
+        # dvipng only finds the size while rasterising, so the budget is checked on a coarse pass first
+        if self._maxPixels and dpi > self.dviProbeDpi:
+            dpi = self._fitPixelBudget(dpi, *self.measureDviCanvas(dpi, sessionId, cancelEvent, directory))
+        png = self.convertDviToPng(dpi, sessionId, cancelEvent, directory)
+        byteBudgetDpi = self._fitByteBudget(dpi, len(png))
+        if byteBudgetDpi < dpi:
+            png = self.convertDviToPng(byteBudgetDpi, sessionId, cancelEvent, directory)
+        return png
 
+    def _isDviFastPathAvailable(self):
+        return self._dviFastPath and shutil.which("pdflatex") is not None and shutil.which("dvipng") is not None
 
+    def _runGhostscript(self, args, outputFile, cancelEvent=None):
+        if not self._ghostscriptPipes:
+            self._processRunner.run(args[:1] + ["-o", outputFile] + args[1:], cancelEvent=cancelEvent)
+            with open(outputFile, "rb") as f:
+                return f.read()
+        # Only the output goes to stdout, Ghostscript's own messages are kept apart on stderr
+        output = self._processRunner.run(args[:1] + ["-q", "-sstdout=%stderr", "-o", "-"] + args[1:],
+                                         cancelEvent=cancelEvent, stderr=PIPE)
+        if not output:
+            raise ValueError("Ghostscript produced no output!")
+        return output
 
+    def getSource(self, expression, userId):
+        preamble = None
+        isDefaultPreamble = False
+        documentString = None
         if r"\documentclass" in expression:
             fileString = expression
         else:
@@ -149,54 +335,318 @@ class LatexConverter():
             except KeyError:
                 self.logger.debug("Preamble for userId %d not found, using default preamble", userId)
                 preamble = self._preambleManager.getDefaultPreamble()
+                isDefaultPreamble = True
             finally:
-                fileString = preamble+"\n\\begin{document}\n"+expression+"\n\\end{document}"
+                documentString = "\n\\begin{document}\n"+expression+"\n\\end{document}"
+                fileString = preamble+documentString
+        return preamble, isDefaultPreamble, documentString, fileString
 
-        os.makedirs("build", exist_ok=True)
-        with open("build/expression_file_%s.tex"%sessionId, "w+") as f:
-            f.write(fileString)
-        
-        dpi = self._userOptionsManager.getDpiOption(userId)
-        
+    def getRenderKeyForExpression(self, expression, userId, dpi = None):
+        # Lets callers look up artifacts derived from a render (e.g. uploaded file ids) without rendering
+        _, _, _, fileString = self.getSource(expression, userId)
+        if dpi is None:
+            dpi = self._userOptionsManager.getDpiOption(userId)
+        return self.getRenderKey(fileString, dpi)
+
+    def convertExpression(self, expression, userId, sessionId, formats = ("png",), cancelEvent = None, dpi = None):
+        # The result produces each artifact on first access; formats names the ones the caller is going to use
+        preamble, isDefaultPreamble, documentString, fileString = self.getSource(expression, userId)
+
+        if dpi is None:
+            dpi = self._userOptionsManager.getDpiOption(userId)
+
+        renderKey = self.getRenderKey(fileString, dpi)
+        cacheKeys = {"png": renderKey + ".png", "pdf": renderKey + ".pdf", "svg": self.getRenderKey(fileString, "svg") + ".svg"}
+        job = (expression, preamble, isDefaultPreamble, documentString, fileString, dpi, formats, cancelEvent)
+        # Requests for the same source share its compilation and bounding box, whichever artifacts each one asks for
+        sourceKey = RenderCache.makeKey(fileString)
+        workspace = self._workspaces.acquire(sourceKey, sessionId)
+        graph = None
+        if "png" in formats and "pdf" in formats and r"\documentclass" not in expression:
+            # Stages still running in the background after the result is closed keep the workspace until they finish
+            graph = StageGraph(onStart=partial(self._workspaces.retain, sourceKey, workspace),
+                               onDone=partial(self._workspaces.release, sourceKey, workspace))
+        result = RenderResult(partial(self._produceArtifact, *job, graph), cacheKeys, self._renderCache, workspace,
+                              partial(self._workspaces.release, sourceKey, workspace), self._singleFlight, cancelEvent)
+        missing = [artifact for artifact in formats if not result.isAvailable(artifact)]
+        if not missing:
+            self.logger.debug("Render cache hit for %s", expression)
+            return result
+
+        try:
+            # Environments are only checked against the default preamble, custom ones may define shortcuts for them
+            self._expressionValidator.validate(expression, None if isDefaultPreamble else preamble,
+                                               checkEnvironments=isDefaultPreamble)
+
+            # Inputs that failed to compile a moment ago fail the same way, don't spend a pdflatex run on them
+            for outputFormat in set(self._getOutputFormat(artifact) for artifact in formats):
+                try:
+                    error = self._errorCache.get(self._getSourceKey(fileString, outputFormat))
+                    self.logger.debug("Compile error cache hit for %s", expression)
+                    raise ValueError(error)
+                except KeyError:
+                    pass
+        except BaseException:
+            result.close()
+            raise
+        # Only artifacts that still have to be rendered get a stage, a single one is rendered directly when asked for
+        if graph is not None and "png" in missing and "pdf" in missing:
+            self._addStages(graph, *job, result)
+        return result
+
+    def _addStages(self, graph, expression, preamble, isDefaultPreamble, documentString, fileString, dpi,
+                   formats, cancelEvent, result):
+        # After the shared compilation and bounding box, rasterising and cropping don't depend on each other: the first
+        # of them asked for starts the graph, the other one keeps running in the background until it is asked for too
+        progress = {}
+        def compileStage():
+            try:
+                tiers = self._getTiers(result, expression, isDefaultPreamble, preamble)
+                return self._ensureCompiled(result, progress, result.getDirectory(), result.getSessionId(), tiers, fileString,
+                                            documentString, cancelEvent)
+            except RenderCancelledError:
+                self._recordCancellation(["compile", "bbox", "png", "crop"], progress, expression)
+                raise
+        def bboxStage():
+            try:
+                self._getBounds(result, progress, compileStage(), cancelEvent)
+                self._startStage(progress, None)
+            except RenderCancelledError:
+                self._recordCancellation(["compile", "bbox", "png", "crop"], progress, expression)
+                raise
+        graph.add("compile", compileStage)
+        graph.add("bbox", bboxStage, ["compile"])
+        def artifactStage(artifact):
+            data = self._renderArtifact(expression, preamble, isDefaultPreamble, documentString, fileString, dpi,
+                                        formats, cancelEvent, result, artifact)
+            result.store(artifact, data)
+            return data
+        for artifact in ("png", "pdf"):
+            graph.add(artifact, partial(artifactStage, artifact), ["bbox"])
+
+    def _produceArtifact(self, expression, preamble, isDefaultPreamble, documentString, fileString, dpi,
+                         formats, cancelEvent, graph, result, artifact):
+        if graph is not None and graph.hasStage(artifact):
+            return graph.wait(artifact)
+        return self._renderArtifact(expression, preamble, isDefaultPreamble, documentString, fileString, dpi,
+                                    formats, cancelEvent, result, artifact)
+
+    def _renderArtifact(self, expression, preamble, isDefaultPreamble, documentString, fileString, dpi,
+                        formats, cancelEvent, result, artifact):
+        tiers = self._getTiers(result, expression, isDefaultPreamble, preamble)
+        # Every source gets its own directory, so cleaning up never has to look at other renders' files
+        directory = result.getDirectory()
+        sessionId = result.getSessionId()
+        is_full_document = (r"\documentclass" in expression)
+
+        stages = {"png": ["compile", "bbox", "png"], "pdf": ["compile", "bbox", "crop"], "svg": ["compile", "svg"]}[artifact]
+        progress = {}
         try:
+            if artifact == "svg":
+                self._ensureCompiled(result, progress, directory, sessionId, tiers, fileString, documentString, cancelEvent, "dvi")
+                self._startStage(progress, "svg", cancelEvent)
+                svg = self.convertDviToSvg(self._getStem(sessionId, "dvi"), is_full_document, cancelEvent, directory)
+                self.logger.debug("Generated SVG for %s", expression)
+                self._startStage(progress, None)
+                return svg
+
+            # Plain expressions skip both Ghostscript passes unless the PDF is needed anyway, the PDF path is the fallback
+            if artifact == "png" and "pdf" not in formats and not result.hasIntermediate("pdf") \
+                    and not is_full_document and self._isDviFastPathAvailable():
+                self._startStage(progress, "dvi", cancelEvent)
+                try:
+                    png = self._renderDvi(result, progress, directory, sessionId, tiers, fileString, documentString, dpi,
+                                          cancelEvent)
+                    with self._statsLock:
+                        self._dviStats["renders"] += 1
+                    self._startStage(progress, None)
+                    return png
+                except ValueError as err:
+                    self.logger.debug("DVI rendering failed, falling back to PDF: %s", err.args[0])
+                    with self._statsLock:
+                        self._dviStats["fallbacks"] += 1
+
+            pdfPath = self._ensureCompiled(result, progress, directory, sessionId, tiers, fileString, documentString, cancelEvent)
+            if artifact == "pdf" and is_full_document:
+                # Preserve full document layout and margins
+                with open(pdfPath, "rb") as f:
+                    pdf = f.read()
+                self._startStage(progress, None)
+                return pdf
+
+            bounds = self._getBounds(result, progress, pdfPath, cancelEvent)
+            if artifact == "pdf":
+                self._startStage(progress, "crop", cancelEvent)
+                pdf = self.cropPdf(sessionId, bounds, cancelEvent, directory)
+                self._startStage(progress, None)
+                return pdf
+
+            # The canvas is known before rasterising, so the pixel budget costs nothing
+            bbox = self.correctBoundingBoxAspectRaito(dpi, self.extractBoundingBox(dpi, pdfPath, bounds))
+            budgetDpi = self._fitPixelBudget(dpi, bbox[0], bbox[1])
+            if budgetDpi < dpi:
+                bbox = self.correctBoundingBoxAspectRaito(budgetDpi, self.extractBoundingBox(budgetDpi, pdfPath, bounds))
+            self._startStage(progress, "png", cancelEvent)
+            png = self.convertPdfToPng(budgetDpi, sessionId, bbox, cancelEvent, directory)
+            # The compressed size depends on the content and is only known afterwards
+            byteBudgetDpi = self._fitByteBudget(budgetDpi, len(png))
+            if byteBudgetDpi < budgetDpi:
+                bbox = self.correctBoundingBoxAspectRaito(byteBudgetDpi, self.extractBoundingBox(byteBudgetDpi, pdfPath, bounds))
+                png = self.convertPdfToPng(byteBudgetDpi, sessionId, bbox, cancelEvent, directory)
+            self.logger.debug("Generated image for %s", expression)
+            self._startStage(progress, None)
+            return png
+
+        except RenderCancelledError:
+            self._recordCancellation(stages, progress, expression)
+            raise
+
+    def _fitPixelBudget(self, dpi, width, height):
+        pixels = int(width) * int(height)
+        if self._maxPixels == 0 or pixels <= self._maxPixels:
+            return dpi
+        # The canvas grows with the square of the resolution
+        budgetDpi = max(1, int(dpi * math.sqrt(self._maxPixels / pixels)))
+        with self._statsLock:
+            self._pixelBudgetStats["pixel_capped"] += 1
+            self._pixelBudgetStats["pixels_saved"] += pixels - int(pixels * (budgetDpi / dpi) ** 2)
+        self.logger.debug("Canvas of %d pixels exceeds the budget, lowering the resolution from %d to %d dpi",
+                          pixels, dpi, budgetDpi)
+        return budgetDpi
+
+    def _fitByteBudget(self, dpi, size):
+        if self._maxPngBytes == 0 or size <= self._maxPngBytes:
+            return dpi
+        # Some headroom, the size doesn't shrink exactly with the number of pixels
+        budgetDpi = max(1, int(0.9 * dpi * math.sqrt(self._maxPngBytes / size)))
+        with self._statsLock:
+            self._pixelBudgetStats["byte_capped"] += 1
+        self.logger.debug("Image of %d bytes exceeds the budget, rendering again at %d dpi", size, budgetDpi)
+        return budgetDpi
+
+    def _getTiers(self, result, expression, isDefaultPreamble, preamble):
+        # The default preamble is tried in its lean variant first, the render key stays that of the default preamble
+        return result.getIntermediate("tiers", lambda: self._preambleTiers.getTiers(expression) if isDefaultPreamble
+                                      else [(None, preamble)])
+
+    def _ensureCompiled(self, result, progress, directory, sessionId, tiers, fileString, documentString, cancelEvent=None,
+                        outputFormat="pdf"):
+        # PNG and cropped PDF share one pdflatex run, the SVG and the DVI fast path share another one
+        stem = self._getStem(sessionId, outputFormat)
+        def compile():
+            self._startStage(progress, "compile", cancelEvent)
             try:
-                self.pdflatex("build/expression_file_%s.tex"%sessionId)
+                self._compileTiers(directory, stem, tiers, fileString, documentString, cancelEvent, outputFormat)
+            except ValueError as err:
+                # Only errors TeX itself reported are bound to happen again; timeouts and killed runs may be load
+                if err.args[0] is not None and err.args[0].startswith("! "):
+                    self._errorCache.put(self._getSourceKey(fileString, outputFormat), err.args[0])
+                raise
             except FileNotFoundError:
                 raise ValueError("pdflatex not found. Please install a LaTeX distribution (TeX Live or MiKTeX) and ensure 'pdflatex' is on PATH.")
-                
-            bbox = self.extractBoundingBox(dpi, "build/expression_file_%s.pdf"%sessionId)
-            bbox = self.correctBoundingBoxAspectRaito(dpi, bbox)
-            self.convertPdfToPng(dpi, sessionId, bbox)
-            
-            self.logger.debug("Generated image for %s", expression)
-            
-            with open("build/expression_%s.png"%sessionId, "rb") as f:
-                imageBinaryStream = io.BytesIO(f.read())
-
-            if returnPdf:
-                is_full_document = (r"\documentclass" in expression)
-                if is_full_document:
-                    # Preserve full document layout and margins
-                    with open("build/expression_file_%s.pdf"%sessionId, "rb") as f:
-                        pdfBinaryStream = io.BytesIO(f.read())
-                else:
-                    self.cropPdf(sessionId)
-                    with open("build/expression_file_cropped_%s.pdf"%sessionId, "rb") as f:
-                        pdfBinaryStream = io.BytesIO(f.read())
-                return imageBinaryStream, pdfBinaryStream
-            else:
-                return imageBinaryStream
-                
-        finally:
-            # Cross-platform cleanup
-            try:
-                for f in glob.glob(os.path.join("build", f"*_{sessionId}.*")):
-                    try:
-                        os.remove(f)
-                    except FileNotFoundError:
-                        pass
-            except Exception:
-                pass
+            return os.path.join(directory, "expression_file_%s.%s"%(stem, outputFormat))
+        return result.getIntermediate(outputFormat, compile)
+
+    def _getStem(self, sessionId, outputFormat):
+        # Both runs may write into the same directory at the same time, so their files are named apart
+        return sessionId if outputFormat == "pdf" else "%s_%s" % (sessionId, outputFormat)
+
+    def _getBounds(self, result, progress, pdfPath, cancelEvent=None):
+        # The same measurement serves both the PNG canvas and the cropped PDF
+        def measure():
+            self._startStage(progress, "bbox", cancelEvent)
+            return self.measureBoundingBox(pdfPath, cancelEvent)
+        return result.getIntermediate("bounds", measure)
+
+    def _getOutputFormat(self, artifact):
+        return "dvi" if artifact == "svg" else "pdf"
+
+    def _getSourceKey(self, fileString, outputFormat):
+        # DVI output can fail where PDF output doesn't (e.g. PDF-only packages), so its errors are cached separately
+        if outputFormat == "pdf":
+            return RenderCache.makeKey(fileString)
+        return RenderCache.makeKey(fileString, outputFormat)
+
+    def getCoalescingStats(self):
+        return self._singleFlight.getStats()
+
+    def getPreambleTierStats(self):
+        return self._preambleTiers.getStats()
+
+    def getErrorCacheStats(self):
+        return self._errorCache.getStats()
+
+    def getDviStats(self):
+        with self._statsLock:
+            return dict(self._dviStats)
+
+    def getPixelBudgetStats(self):
+        with self._statsLock:
+            return dict(self._pixelBudgetStats)
+
+    def getCancellationStats(self):
+        with self._statsLock:
+            return dict(self._cancellationStats)
+
+    def _startStage(self, progress, stage, cancelEvent=None):
+        now = time.time()
+        with self._statsLock:
+            if progress.get("stage") is not None:
+                # Exponentially weighted average duration of each stage, used to estimate saved work
+                duration = now - progress["start"]
+                previous = self._stageDurations.get(progress["stage"], duration)
+                self._stageDurations[progress["stage"]] = 0.8 * previous + 0.2 * duration
+        progress["stage"] = stage
+        progress["start"] = now
+        if cancelEvent is not None and cancelEvent.is_set():
+            raise RenderCancelledError(stage)
+
+    def _recordCancellation(self, stages, progress, expression):
+        stage = progress.get("stage")
+        remainingStages = stages[stages.index(stage)+1:] if stage in stages else []
+        with self._statsLock:
+            secondsSaved = sum(self._stageDurations.get(name, 0.0) for name in remainingStages)
+            if stage in self._stageDurations:
+                secondsSaved += max(0.0, self._stageDurations[stage] - (time.time() - progress["start"]))
+            self._cancellationStats["cancelled"] += 1
+            self._cancellationStats["stages_skipped"] += len(remainingStages)
+            self._cancellationStats["seconds_saved"] += secondsSaved
+        self.logger.debug("Cancelled render of %s during %s, saved about %.3f s", expression, stage, secondsSaved)
+
+    async def convertExpressionAsync(self, expression, userId, sessionId, formats = ("png",)):
+        # Renders run on a bounded thread pool so that the event loop keeps serving other requests; the event loop must
+        # not produce anything itself, so the requested artifacts are ready when the result is returned
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._getExecutor(),
+                                          partial(self._convertAndProduce, expression, userId, sessionId, formats))
+
+    def _convertAndProduce(self, expression, userId, sessionId, formats):
+        result = self.convertExpression(expression, userId, sessionId, formats)
+        try:
+            for artifact in formats:
+                result.get(artifact)
+        except BaseException:
+            result.close()
+            raise
+        return result
+
+    def _getExecutor(self):
+        with self._executorLock:
+            if self._executor is None:
+                maxWorkers = max(1, Environment.getInt("LATEXBOT_RENDER_CONCURRENCY", os.cpu_count() or 2))
+                self._executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="render")
+            return self._executor
+
+    def getRenderKey(self, fileString, dpi):
+        return RenderCache.makeKey(fileString, dpi, self._isTransparent(), self._getPdfMargin())
+
+    def _isTransparent(self):
+        # Default to white background to avoid black/transparent appearance in some viewers.
+        return Environment.getBool("LATEXBOT_TRANSPARENT")
+
+    def _getPdfMargin(self):
+        # Configurable margin (points). Default 24pt (~1/3 inch) for comfortable whitespace.
+        return max(0.0, Environment.getFloat("LATEXBOT_PDF_MARGIN_PT", 24.0))
 
     def _get_gs_executable(self):
         # Try common Ghostscript executables across platforms
@@ -1,31 +1,31 @@
-from multiprocessing import Process, Lock, Event
-from threading import Thread
-
 from telegram import TelegramError
 from telegram.error import NetworkError
 
 from src.LoggingServer import LoggingServer
+from src.RenderScheduler import RenderScheduler
+from src.UserOptionsManager import UserOptionsManager
 
 class MessageQueryResponseDispatcher():
 
     logger = LoggingServer.getInstance()
         
-    def __init__(self, bot, latexConverter, resourceManager):
+    def __init__(self, bot, latexConverter, resourceManager, renderScheduler=None, userOptionsManager=None):
         self._bot = bot
         self._latexConverter = latexConverter
         self._resourceManager = resourceManager
+        self._renderScheduler = renderScheduler if renderScheduler is not None else RenderScheduler()
+        self._userOptionsManager = userOptionsManager if userOptionsManager is not None else UserOptionsManager()
             
     def dispatchMessageQueryResponse(self, message):
         
         self.logger.debug("Received message: "+message.text+\
                    ", id: "+str(message.message_id)+", from: "+str(message.chat.id))
                                 
-        responder = Process(target = self.respondToMessageQuery, args=[message])
-        responder.start()
-        Thread(target=self.joinProcess, args=[responder]).start()
-            
-    def joinProcess(self, process):
-        process.join()
+        if not self._renderScheduler.submit(message.from_user.id, self.respondToMessageQuery, message):
+            try:
+                self._bot.sendMessage(message.chat.id, self._resourceManager.getString("server_busy"))
+            except TelegramError as err:
+                self.logger.warn(self._resourceManager.getString("telegram_error")+str(err))
 
     def respondToMessageQuery(self, message):
         senderId = message.from_user.id
@@ -35,9 +35,16 @@ class MessageQueryResponseDispatcher():
         
         errorMessage = None
         try:
-            imageStream, pdfStream = self._latexConverter.convertExpression(expression, senderId, str(messageId) + str(senderId), returnPdf=True)
-            self._bot.sendDocument(chatId, pdfStream, filename="expression.pdf")
-            self._bot.sendPhoto(chatId, imageStream)
+            if self._userOptionsManager.getOutputFormatOption(senderId) == "svg":
+                # Telegram can't preview SVG, it is sent on its own in place of the PDF and the preview image
+                with self._latexConverter.convertExpression(expression, senderId, str(messageId) + str(senderId),
+                                                            formats=("svg",)) as result:
+                    self._bot.sendDocument(chatId, result.open("svg"), filename="expression.svg")
+            else:
+                with self._latexConverter.convertExpression(expression, senderId, str(messageId) + str(senderId),
+                                                            formats=("png", "pdf")) as result:
+                    self._bot.sendDocument(chatId, result.open("pdf"), filename="expression.pdf")
+                    self._bot.sendPhoto(chatId, result.open("png"))
         except ValueError as err:
             errorMessage = self.getWrongSyntaxResult(expression, err.args[0])
         except TelegramError as err:
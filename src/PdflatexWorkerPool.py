@@ -0,0 +1,197 @@
+from subprocess import DEVNULL, TimeoutExpired
+from threading import Lock
+import atexit
+import errno
+import os
+import shutil
+import time
+import uuid
+
+from src.BuildDirectories import BuildDirectories
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+from src.ProcessRunner import ProcessRunner
+
+
+class PdflatexWorker():
+
+    # The driver blocks on the signal FIFO after the format has been loaded, then compiles the body
+    driver = "\\newread\\inlatexbotsignal\n" \
+             "\\openin\\inlatexbotsignal=signal.tex\n" \
+             "\\read\\inlatexbotsignal to \\inlatexbotline\n" \
+             "\\closein\\inlatexbotsignal\n" \
+             "\\input{body.tex}\n"
+
+    def __init__(self, formatName, formatEnvironment, workingDirectory, processRunner):
+        self.formatName = formatName
+        self._processRunner = processRunner
+        # Named like the BuildDirectories so that directories left behind by a dead process are cleaned up
+        self.directory = os.path.join(workingDirectory, "worker_%d_%s" % (os.getpid(), uuid.uuid4().hex))
+        self.startTime = time.time()
+        os.makedirs(self.directory)
+        os.mkfifo(os.path.join(self.directory, "signal.tex"))
+        with open(os.path.join(self.directory, "worker.tex"), "w") as f:
+            f.write(self.driver)
+        # Workers live for many jobs, only each job's wall-clock time is limited, not the accumulated CPU time
+        self.process = processRunner.start(['pdflatex', '-interaction=nonstopmode', '-fmt=' + formatName, '-jobname=job',
+                                            'worker.tex'], cpuLimit=False, cwd=self.directory, env=formatEnvironment,
+                                           stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+    def isHealthy(self, maxAge):
+        return self.process.poll() is None and time.time() - self.startTime < maxAge
+
+    def signal(self, readyTimeout):
+        # Opening the FIFO for writing only succeeds once pdflatex has opened it for reading
+        deadline = time.time() + readyTimeout
+        while True:
+            try:
+                fd = os.open(os.path.join(self.directory, "signal.tex"), os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as err:
+                if err.errno != errno.ENXIO or time.time() > deadline or self.process.poll() is not None:
+                    return False
+                time.sleep(0.005)
+        try:
+            os.write(fd, b"go\n")
+        finally:
+            os.close(fd)
+        return True
+
+    def getPath(self, fileName):
+        return os.path.join(self.directory, fileName)
+
+    def kill(self):
+        if self.process.poll() is None:
+            self._processRunner.kill(self.process)
+
+    def dispose(self):
+        self.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class PdflatexWorkerPool():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, formatCache, size=None, maxAge=None, workingDirectory=None):
+        if size is None:
+            size = Environment.getInt("LATEXBOT_PDFLATEX_WORKERS", 2)
+        if maxAge is None:
+            maxAge = Environment.getFloat("LATEXBOT_PDFLATEX_WORKER_MAX_AGE_S", 600)
+        if workingDirectory is None:
+            workingDirectory = BuildDirectories.getDefaultRoot()
+        self._formatCache = formatCache
+        self._size = max(0, size)
+        self._maxAge = maxAge
+        self._workingDirectory = workingDirectory
+        self._ownerPid = os.getpid()
+        self._processRunner = ProcessRunner()
+        self._lock = Lock()
+        self._idleWorkers = {}
+        # Workers being spawned count towards the pool size, so that concurrent fills don't overshoot it
+        self._spawning = {}
+        self._stats = {"jobs": 0, "spawned": 0, "recycled": 0, "fallbacks": 0}
+        atexit.register(self.shutdown)
+
+    def isAvailable(self):
+        # Workers are children of the process that spawned them and communicate over a FIFO
+        return self._size > 0 and hasattr(os, "mkfifo") and os.getpid() == self._ownerPid
+
+    def warm(self, formatName):
+        if not self.isAvailable():
+            return
+        with self._lock:
+            self._idleWorkers.setdefault(formatName, [])
+        self._fill(formatName)
+
+    def compile(self, formatName, documentString, outputPrefix, timeout=5, cancelEvent=None):
+        worker = self._acquire(formatName)
+        if worker is None:
+            with self._lock:
+                self._stats["fallbacks"] += 1
+            return False
+        self._fill(formatName)
+
+        try:
+            with open(worker.getPath("body.tex"), "w") as f:
+                f.write(documentString)
+            if not worker.signal(readyTimeout=1):
+                self.logger.warn("pdflatex worker for %s did not become ready, falling back", formatName)
+                with self._lock:
+                    self._stats["fallbacks"] += 1
+                return False
+            try:
+                returnCode = self._processRunner.wait(worker.process, timeout, cancelEvent)
+            except TimeoutExpired:
+                raise ValueError("Pdflatex has likely hung up and had to be killed. Congratulations!")
+            # The output is a PDF or a DVI, depending on the mode the format was dumped in
+            for extension in ("log", "pdf", "dvi"):
+                if os.path.exists(worker.getPath("job." + extension)):
+                    shutil.move(worker.getPath("job." + extension), outputPrefix + "." + extension)
+            if returnCode != 0:
+                try:
+                    with open(outputPrefix + ".log", "r") as f:
+                        log = f.readlines()
+                except FileNotFoundError:
+                    log = []
+                for idx, line in enumerate(log):
+                    if line[:2] == "! ":
+                        raise ValueError("".join(log[idx:idx+2]))
+                raise ValueError(None)
+            with self._lock:
+                self._stats["jobs"] += 1
+            return True
+        finally:
+            # pdfTeX writes a single PDF per run, so every worker serves exactly one job and is replaced
+            worker.dispose()
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = sum(len(workers) for workers in self._idleWorkers.values())
+        return stats
+
+    def shutdown(self):
+        if os.getpid() != self._ownerPid:
+            return
+        with self._lock:
+            workers = [worker for workers in self._idleWorkers.values() for worker in workers]
+            self._idleWorkers = {}
+        for worker in workers:
+            worker.dispose()
+
+    def _acquire(self, formatName):
+        if not self.isAvailable():
+            return None
+        while True:
+            with self._lock:
+                workers = self._idleWorkers.get(formatName)
+                if not workers:
+                    return None
+                worker = workers.pop(0)
+            if worker.isHealthy(self._maxAge):
+                return worker
+            self.logger.debug("Recycling pdflatex worker %s", worker.directory)
+            with self._lock:
+                self._stats["recycled"] += 1
+            worker.dispose()
+
+    def _fill(self, formatName):
+        while True:
+            with self._lock:
+                workers = self._idleWorkers.get(formatName)
+                if workers is None or len(workers) + self._spawning.get(formatName, 0) >= self._size:
+                    return
+                self._spawning[formatName] = self._spawning.get(formatName, 0) + 1
+            try:
+                worker = PdflatexWorker(formatName, self._formatCache.getEnvironment(), self._workingDirectory,
+                                        self._processRunner)
+            except (OSError, ValueError) as err:
+                self.logger.warn("Could not spawn pdflatex worker: %s", str(err))
+                return
+            finally:
+                with self._lock:
+                    self._spawning[formatName] -= 1
+            with self._lock:
+                self._idleWorkers[formatName].append(worker)
+                self._stats["spawned"] += 1
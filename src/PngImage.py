@@ -0,0 +1,147 @@
+import struct
+import zlib
+
+
+class PngImage():
+
+    signature = b"\x89PNG\r\n\x1a\n"
+    # Bytes per pixel of the supported 8-bit colour types: greyscale, RGB, palette, greyscale with alpha, RGBA
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    def __init__(self, width, height, colorType, rows, palette=None, transparency=None):
+        self.width = width
+        self.height = height
+        self.colorType = colorType
+        self.rows = rows
+        self.palette = palette
+        self.transparency = transparency
+
+    @staticmethod
+    def getSize(data):
+        if data[:8] != PngImage.signature or data[12:16] != b"IHDR":
+            raise ValueError("Not a PNG image!")
+        return struct.unpack(">II", data[16:24])
+
+    @staticmethod
+    def decode(data):
+        width, height = PngImage.getSize(data)
+        bitDepth, colorType, _, _, interlace = struct.unpack(">BBBBB", data[24:29])
+        if colorType not in PngImage.channels or interlace != 0 or \
+                bitDepth > 8 or (bitDepth < 8 and colorType != 3):
+            raise ValueError("Unsupported PNG format!")
+        palette = None
+        transparency = None
+        compressed = []
+        position = 8
+        while position < len(data):
+            length, chunkType = struct.unpack(">I4s", data[position:position+8])
+            chunk = data[position+8:position+8+length]
+            if chunkType == b"IDAT":
+                compressed.append(chunk)
+            elif chunkType == b"PLTE":
+                palette = chunk
+            elif chunkType == b"tRNS":
+                transparency = chunk
+            elif chunkType == b"IEND":
+                break
+            position += length + 12
+
+        bitsPerPixel = bitDepth * PngImage.channels[colorType]
+        stride = (width * bitsPerPixel + 7) // 8
+        rows = PngImage._unfilter(zlib.decompress(b"".join(compressed)), height, stride, max(1, bitsPerPixel // 8))
+        if bitDepth < 8:
+            rows = [PngImage._unpack(row, width, bitDepth) for row in rows]
+        return PngImage(width, height, colorType, rows, palette, transparency)
+
+    def encode(self):
+        # Rows are stored unfiltered, the images are small and mostly a flat background that compresses well anyway
+        raw = b"".join(b"\x00" + bytes(row) for row in self.rows)
+        chunks = [(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, self.colorType, 0, 0, 0))]
+        if self.palette is not None:
+            chunks.append((b"PLTE", self.palette))
+        if self.transparency is not None:
+            chunks.append((b"tRNS", self.transparency))
+        chunks.append((b"IDAT", zlib.compress(raw, 6)))
+        chunks.append((b"IEND", b""))
+        return self.signature + b"".join(struct.pack(">I", len(chunk)) + chunkType + chunk +
+                                         struct.pack(">I", zlib.crc32(chunkType + chunk))
+                                         for chunkType, chunk in chunks)
+
+    def pad(self, left, top, right, bottom, transparent=False):
+        pixel = self._getBackground(transparent)
+        width = self.width + left + right
+        rows = [pixel * width] * top
+        for row in self.rows:
+            rows.append(pixel * left + bytes(row) + pixel * right)
+        rows.extend([pixel * width] * bottom)
+        return PngImage(width, self.height + top + bottom, self.colorType, rows, self.palette, self.transparency)
+
+    def _getBackground(self, transparent):
+        if self.colorType == 0:
+            return b"\xff"
+        if self.colorType == 2:
+            return b"\xff\xff\xff"
+        if self.colorType == 4:
+            return b"\x00\x00" if transparent else b"\xff\xff"
+        if self.colorType == 6:
+            return b"\x00\x00\x00\x00" if transparent else b"\xff\xff\xff\xff"
+        colors = [self.palette[idx:idx+3] for idx in range(0, len(self.palette), 3)]
+        alphas = list(self.transparency or b"") + [255] * (len(colors) - len(self.transparency or b""))
+        for idx, (color, alpha) in enumerate(zip(colors, alphas)):
+            if (transparent and alpha == 0) or (not transparent and color == b"\xff\xff\xff" and alpha == 255):
+                return bytes([idx])
+        if len(colors) == 256:
+            raise ValueError("No free palette entry for the background!")
+        self.palette = self.palette + (b"\x00\x00\x00" if transparent else b"\xff\xff\xff")
+        if transparent or self.transparency is not None:
+            self.transparency = bytes(alphas) + (b"\x00" if transparent else b"\xff")
+        return bytes([len(colors)])
+
+    @staticmethod
+    def _unfilter(data, height, stride, bpp):
+        rows = []
+        previous = bytearray(stride)
+        position = 0
+        for _ in range(height):
+            filterType = data[position]
+            row = bytearray(data[position+1:position+1+stride])
+            position += stride + 1
+            if filterType == 1:
+                for idx in range(bpp, stride):
+                    row[idx] = (row[idx] + row[idx-bpp]) & 0xff
+            elif filterType == 2:
+                for idx in range(stride):
+                    row[idx] = (row[idx] + previous[idx]) & 0xff
+            elif filterType == 3:
+                for idx in range(stride):
+                    left = row[idx-bpp] if idx >= bpp else 0
+                    row[idx] = (row[idx] + ((left + previous[idx]) >> 1)) & 0xff
+            elif filterType == 4:
+                for idx in range(stride):
+                    left = row[idx-bpp] if idx >= bpp else 0
+                    upperLeft = previous[idx-bpp] if idx >= bpp else 0
+                    up = previous[idx]
+                    estimate = left + up - upperLeft
+                    distanceLeft, distanceUp, distanceUpperLeft = abs(estimate - left), abs(estimate - up), abs(estimate - upperLeft)
+                    if distanceLeft <= distanceUp and distanceLeft <= distanceUpperLeft:
+                        predictor = left
+                    elif distanceUp <= distanceUpperLeft:
+                        predictor = up
+                    else:
+                        predictor = upperLeft
+                    row[idx] = (row[idx] + predictor) & 0xff
+            elif filterType != 0:
+                raise ValueError("Invalid PNG filter type %d!" % filterType)
+            rows.append(row)
+            previous = row
+        return rows
+
+    @staticmethod
+    def _unpack(row, width, bitDepth):
+        # Palette indices narrower than a byte are widened so that rows can be padded byte by byte
+        mask = (1 << bitDepth) - 1
+        indices = bytearray()
+        for byte in row:
+            for shift in range(8 - bitDepth, -1, -bitDepth):
+                indices.append((byte >> shift) & mask)
+        return indices[:width] if len(indices) >= width else indices + bytes(width - len(indices))
@@ -1,25 +1,23 @@
-from subprocess import check_output, CalledProcessError, STDOUT
-from multiprocessing import Lock
-import pickle as pkl
+from subprocess import CalledProcessError, TimeoutExpired
 from src.ResourceManager import ResourceManager
+from src.BuildDirectories import BuildDirectories
 from src.LoggingServer import LoggingServer
-import glob
+from src.ProcessRunner import ProcessRunner
+from src.SqliteStorage import SqliteStorage
 import os
 
 class PreambleManager():
     
     logger = LoggingServer.getInstance()
 
-    def __init__(self, resourceManager, preamblesFile = "./resources/preambles.pkl"):
+    def __init__(self, resourceManager, preamblesFile = "./resources/preambles.pkl", formatCache = None,
+                 buildDirectories = None, databaseFile = "./resources/inlatexbot.sqlite"):
         self._resourceManager = resourceManager
-        self._preamblesFile = preamblesFile
+        self._formatCache = formatCache
+        self._buildDirectories = buildDirectories if buildDirectories is not None else BuildDirectories()
+        self._processRunner = ProcessRunner()
 #        self._defaultPreamble = self.readDefaultPreamble()
-        self._lock = Lock()
-        # Ensure pickle exists
-        os.makedirs(os.path.dirname(self._preamblesFile), exist_ok=True)
-        if not os.path.exists(self._preamblesFile):
-            with open(self._preamblesFile, "wb") as f:
-                pkl.dump({}, f)
+        self._storage = SqliteStorage(databaseFile, "preambles", preamblesFile)
         
 #    def getDefaultPreamble(self):
 #        return self._defaultPreamble
@@ -28,19 +26,15 @@ class PreambleManager():
         with open("./resources/default_preamble.txt", "r") as f:
             return f.read()
     
+    def getMinimalPreamble(self):
+        with open("./resources/minimal_preamble.txt", "r") as f:
+            return f.read()
+    
     def getPreambleFromDatabase(self, preambleId):
-        with self._lock:
-            with open(self._preamblesFile, "rb") as f:
-                preambles = pkl.load(f)
-            return preambles[preambleId]
+        return self._storage.get(preambleId)
     
     def putPreambleToDatabase(self, preambleId, preamble):
-        with self._lock:
-            with open(self._preamblesFile, "rb") as f:
-                preambles = pkl.load(f)
-            preambles[preambleId] = preamble
-            with open(self._preamblesFile, "wb") as f:
-                pkl.dump(preambles, f)
+        self._storage.put(preambleId, preamble)
 
     def getError(self, log):
         for idx, line in enumerate(log):
@@ -52,24 +46,32 @@ class PreambleManager():
             return False, self._resourceManager.getString("preamble_too_long")%self._resourceManager.getNumber("max_preamble_length")
             
         document = preamble+"\n\\begin{document}TEST PREAMBLE\\end{document}"
-        with open("./build/validate_preamble.tex", "w+") as f:
-            f.write(document)
+        # Concurrent validations each get their own directory instead of sharing one validate_preamble.tex
+        directory = self._buildDirectories.create("validate")
         try:
-            check_output(['pdflatex', "-interaction=nonstopmode","-draftmode", "-output-directory", "./build", "./build/validate_preamble.tex"], stderr=STDOUT)
+            with open(os.path.join(directory, "validate_preamble.tex"), "w+") as f:
+                f.write(document)
+            self._processRunner.run(['pdflatex', "-interaction=nonstopmode","-draftmode", "-output-directory", directory,
+                                     os.path.join(directory, "validate_preamble.tex")],
+                                    timeout=10, env=ProcessRunner.getTexEnvironment())
+            if self._formatCache is not None:
+                # Dump the format right away so that the first render with this preamble is already fast
+                self._formatCache.getOrScheduleFormat(preamble)
             return True, ""
         except CalledProcessError as inst:
-            with open("./build/validate_preamble.log", "r") as f:
-                msg = self.getError(f.readlines())[:-1]
-                self.logger.debug(msg)
+            killedMessage = "Pdflatex was killed for exceeding its resource limits."
+            if inst.returncode < 0:
+                # Killed by a signal (CPU, memory or output limit), the log may be incomplete or missing
+                return False, self._resourceManager.getString("preamble_invalid")+"\n"+killedMessage
+            try:
+                with open(os.path.join(directory, "validate_preamble.log"), "r") as f:
+                    msg = (self.getError(f.readlines()) or killedMessage+"\n")[:-1]
+                    self.logger.debug(msg)
+            except FileNotFoundError:
+                msg = killedMessage
             return False, self._resourceManager.getString("preamble_invalid")+"\n"+msg
+        except TimeoutExpired:
+            return False, self._resourceManager.getString("preamble_invalid")+"\n"+"Pdflatex has likely hung up and had to be killed."
         finally:
-            # Cross-platform cleanup for temporary files
-            try:
-                for f in glob.glob(os.path.join("./build", "validate_preamble.*")):
-                    try:
-                        os.remove(f)
-                    except FileNotFoundError:
-                        pass
-            except Exception as _:
-                pass
+            self._buildDirectories.remove(directory)
     
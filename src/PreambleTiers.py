@@ -0,0 +1,172 @@
+from subprocess import CalledProcessError, TimeoutExpired
+from threading import Lock
+import re
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+from src.ProcessRunner import ProcessRunner
+
+
+class PreambleTiers():
+
+    logger = LoggingServer.getInstance()
+
+    packagePattern = re.compile(r"^\\usepackage\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}", re.MULTILINE)
+    definitionPattern = re.compile(r"\\(?:(?:Declare|New|Renew|Provide)DocumentCommand|(?:re)?newcommand\*?|"
+                                   r"providecommand\*?|DeclareRobustCommand\*?|DeclareMathOperator\*?|"
+                                   r"DeclareTextSymbol|DeclareTextCommand(?:Default)?|[egx]?def|let)"
+                                   r"\s*\{?\s*\\([A-Za-z]+)|"
+                                   r"\\(?:@namedef|csname)\s*\{?\s*([A-Za-z]+)")
+    environmentPattern = re.compile(r"\\(?:(?:re)?newenvironment\*?|(?:Declare|New|Renew|Provide)DocumentEnvironment)"
+                                    r"\s*\{([A-Za-z*]+)\}")
+    namePattern = re.compile(r"\\([A-Za-z]+)|\\begin\s*\{([A-Za-z*]+)\}")
+    # Some packages are needed for labels rather than commands, and a missing label is not an error
+    packageTriggers = {"lastpage": ("LastPage",)}
+    undefinedCommandPattern = re.compile(r"Undefined control sequence\.\n.*\\([A-Za-z]+)\s*$")
+    undefinedEnvironmentPattern = re.compile(r"Environment (\S+) undefined")
+
+    def __init__(self, preambleManager, enabled=None, maxLearned=10000):
+        if enabled is None:
+            enabled = Environment.getBool("LATEXBOT_LEAN_PREAMBLE", True)
+        self._preambleManager = preambleManager
+        self._enabled = enabled
+        self._maxLearned = maxLearned
+        self._processRunner = ProcessRunner()
+        self._lock = Lock()
+        self._packages = {}
+        self._learned = {}
+        self._stats = {}
+
+    def getTiers(self, expression):
+        defaultPreamble = self._preambleManager.getDefaultPreamble()
+        defaultTier = ("default", defaultPreamble)
+        if not self._enabled:
+            return [defaultTier]
+        packages = self._getPackages(defaultPreamble)
+        if packages is None:
+            return [defaultTier]
+
+        names = self._getNames(expression)
+        needed = set()
+        for package, (_, definitions) in packages.items():
+            # Packages that define or redefine a used name are loaded, even if the kernel knows the name too
+            if definitions & names or any(trigger in expression for trigger in self.packageTriggers.get(package, ())):
+                needed.add(package)
+        with self._lock:
+            for name in names:
+                if name in self._learned:
+                    needed.add(self._learned[name])
+
+        if len(needed) == len(packages):
+            return [defaultTier]
+        minimalPreamble = self._preambleManager.getMinimalPreamble()
+        if not needed:
+            return [("minimal", minimalPreamble), defaultTier]
+        lines = dict.fromkeys(line for package, (line, _) in packages.items() if package in needed)
+        return [("packages", minimalPreamble + "\n".join(lines) + "\n"), defaultTier]
+
+    def isMissingDefinition(self, error):
+        # Only a name that one of the left out packages defines is worth a second compilation; a typo or a command no
+        # package provides fails the same way with the default preamble
+        return self._getDefiningPackage(error) is not None
+
+    def learn(self, error):
+        package = self._getDefiningPackage(error)
+        if package is None:
+            return
+        name = self._getMissingName(error)
+        with self._lock:
+            if len(self._learned) >= self._maxLearned:
+                self._learned.clear()
+            self._learned[name] = package
+        self.logger.debug("Learned that %s needs %s", name, package)
+
+    def recordCompile(self, tier, seconds, escalated):
+        with self._lock:
+            stats = self._stats.setdefault(tier, {"compiles": 0, "escalations": 0, "seconds": 0.0})
+            stats["compiles"] += 1
+            stats["seconds"] += seconds
+            if escalated:
+                stats["escalations"] += 1
+
+    def getStats(self):
+        with self._lock:
+            stats = {}
+            for tier, tierStats in self._stats.items():
+                stats[tier] = dict(tierStats)
+                stats[tier]["avg_seconds"] = tierStats["seconds"] / tierStats["compiles"]
+        return stats
+
+    def _getMissingName(self, error):
+        if error is None:
+            return None
+        commandMatch = self.undefinedCommandPattern.search(error)
+        if commandMatch is not None:
+            return "\\" + commandMatch.group(1)
+        environmentMatch = self.undefinedEnvironmentPattern.search(error)
+        if environmentMatch is not None:
+            return "{" + environmentMatch.group(1) + "}"
+        return None
+
+    def _getDefiningPackage(self, error):
+        name = self._getMissingName(error)
+        if name is None:
+            return None
+        packages = self._getPackages(self._preambleManager.getDefaultPreamble()) or {}
+        return next((package for package, (_, definitions) in packages.items() if name in definitions), None)
+
+    def _getNames(self, expression):
+        names = set()
+        for command, environment in self.namePattern.findall(expression):
+            names.add("\\" + command if command else "{" + environment + "}")
+        return names
+
+    def _getPackages(self, defaultPreamble):
+        # Maps every package that the default preamble loads on top of the minimal one to its line and definitions
+        with self._lock:
+            if defaultPreamble in self._packages:
+                return self._packages[defaultPreamble]
+        minimalPackages = set()
+        for names in self.packagePattern.findall(self._preambleManager.getMinimalPreamble()):
+            minimalPackages.update(name.strip() for name in names.split(","))
+
+        packages = {}
+        for match in self.packagePattern.finditer(defaultPreamble):
+            for package in (name.strip() for name in match.group(1).split(",")):
+                if package in minimalPackages:
+                    continue
+                definitions = self._getDefinitions(package)
+                if definitions is None:
+                    # Without the package source a lean preamble could silently render differently
+                    self.logger.warn("Could not read package %s, always using the default preamble", package)
+                    packages = None
+                    break
+                packages[package] = (match.group(0), definitions)
+            if packages is None:
+                break
+        with self._lock:
+            self._packages[defaultPreamble] = packages
+        return packages
+
+    def _getDefinitions(self, package):
+        path = self._findPackageFile(package)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="latin-1") as f:
+                source = f.read()
+        except OSError:
+            return None
+        definitions = set()
+        for command, namedCommand in self.definitionPattern.findall(source):
+            definitions.add("\\" + (command or namedCommand))
+        for environment in self.environmentPattern.findall(source):
+            definitions.add("{" + environment + "}")
+        return definitions
+
+    def _findPackageFile(self, package):
+        try:
+            path = self._processRunner.run(["kpsewhich", package + ".sty"], timeout=10).decode("utf-8").strip()
+        except (CalledProcessError, TimeoutExpired, FileNotFoundError):
+            return None
+        return path or None
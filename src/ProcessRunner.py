@@ -0,0 +1,148 @@
+from subprocess import PIPE, STDOUT, CalledProcessError, TimeoutExpired
+import subprocess
+from threading import Thread
+import os
+import signal
+import time
+
+from src.Environment import Environment
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class RenderCancelledError(Exception):
+    pass
+
+
+class OutputLimitExceeded(CalledProcessError):
+
+    def __str__(self):
+        return "Command '%s' exceeded the output limit" % (self.cmd,)
+
+
+class ProcessRunner():
+
+    def __init__(self, pollInterval=0.02, timeout=None, cpuSeconds=None, memoryBytes=None, maxOutputBytes=None):
+        if timeout is None:
+            timeout = Environment.getFloat("LATEXBOT_PROCESS_TIMEOUT_S", 30)
+        if cpuSeconds is None:
+            cpuSeconds = Environment.getInt("LATEXBOT_PROCESS_CPU_S", 20)
+        if memoryBytes is None:
+            memoryBytes = Environment.getInt("LATEXBOT_PROCESS_MEMORY_MB", 1024) * 1024 * 1024
+        if maxOutputBytes is None:
+            maxOutputBytes = Environment.getInt("LATEXBOT_PROCESS_MAX_OUTPUT_MB", 64) * 1024 * 1024
+        self._pollInterval = pollInterval
+        # A limit of 0 disables it
+        self._timeout = timeout if timeout > 0 else None
+        self._cpuSeconds = max(0, cpuSeconds)
+        self._memoryBytes = max(0, memoryBytes)
+        self._maxOutputBytes = max(0, maxOutputBytes)
+
+    @staticmethod
+    def getTexEnvironment(env=None):
+        # texmf.cnf settings can be overridden from the environment; pinning them keeps a host's configuration from
+        # granting TeX more memory than intended
+        environment = dict(os.environ if env is None else env)
+        environment["main_memory"] = str(Environment.getInt("LATEXBOT_TEX_MAIN_MEMORY", 5000000))
+        environment["extra_mem_top"] = "0"
+        environment["extra_mem_bot"] = "0"
+        environment["pool_size"] = str(Environment.getInt("LATEXBOT_TEX_POOL_SIZE", 6250000))
+        return environment
+
+    def start(self, args, cpuLimit=True, **kwargs):
+        # Every tool runs in a session of its own, so that killing it also kills whatever it spawned;
+        # Popen is looked up on each call so that benchmarks can count the processes
+        process = subprocess.Popen(args, start_new_session=os.name == "posix", **kwargs)
+        self._setLimits(process, cpuLimit)
+        return process
+
+    def run(self, args, timeout=None, cancelEvent=None, cwd=None, env=None, input=None, stderr=STDOUT):
+        if timeout is None:
+            timeout = self._timeout
+        with self.start(args, stdin=None if input is None else PIPE, stdout=PIPE, stderr=stderr, cwd=cwd,
+                        env=env) as process:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            # Output is read as it comes, so that a tool flooding its pipe is stopped before memory runs out
+            outputs = [[] for _ in range(2)]
+            readers = [Thread(target=self._read, args=(pipe, chunks), daemon=True)
+                       for pipe, chunks in zip((process.stdout, process.stderr), outputs) if pipe is not None]
+            if input is not None:
+                readers.append(Thread(target=self._write, args=(process.stdin, input), daemon=True))
+            for reader in readers:
+                reader.start()
+            try:
+                while True:
+                    try:
+                        process.wait(timeout=self._pollInterval)
+                        break
+                    except TimeoutExpired:
+                        self._checkBreach(process, args, timeout, deadline, cancelEvent)
+                        if self._maxOutputBytes and sum(map(len, outputs[0] + outputs[1])) > self._maxOutputBytes:
+                            self.kill(process)
+                            raise OutputLimitExceeded(-signal.SIGKILL, args)
+            finally:
+                # Leftover children of the tool would keep the pipes open forever
+                self._killGroup(process)
+                for reader in readers:
+                    reader.join()
+        output = b"".join(outputs[0])
+        errors = b"".join(outputs[1]) if stderr == PIPE else None
+        if process.returncode:
+            raise CalledProcessError(process.returncode, args, output, errors)
+        return output
+
+    def wait(self, process, timeout=None, cancelEvent=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return process.wait(timeout=self._pollInterval)
+            except TimeoutExpired:
+                self._checkBreach(process, process.args, timeout, deadline, cancelEvent)
+
+    def kill(self, process):
+        self._killGroup(process)
+        process.kill()
+        process.wait()
+
+    def _checkBreach(self, process, args, timeout, deadline, cancelEvent):
+        if cancelEvent is not None and cancelEvent.is_set():
+            self.kill(process)
+            raise RenderCancelledError(args[0])
+        if deadline is not None and time.monotonic() > deadline:
+            self.kill(process)
+            raise TimeoutExpired(args, timeout)
+
+    def _killGroup(self, process):
+        if os.name != "posix":
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _setLimits(self, process, cpuLimit):
+        # prlimit applies the limits right after the start; unlike preexec_fn it is safe with threads around
+        if resource is None or not hasattr(resource, "prlimit"):
+            return
+        try:
+            if cpuLimit and self._cpuSeconds:
+                resource.prlimit(process.pid, resource.RLIMIT_CPU, (self._cpuSeconds, self._cpuSeconds + 1))
+            if self._memoryBytes:
+                resource.prlimit(process.pid, resource.RLIMIT_AS, (self._memoryBytes, self._memoryBytes))
+        except (ProcessLookupError, ValueError, PermissionError):
+            # The process is already gone, or the limit is above what this process may grant
+            pass
+
+    def _read(self, pipe, chunks):
+        for chunk in iter(lambda: pipe.read1(65536), b""):
+            chunks.append(chunk)
+
+    def _write(self, pipe, input):
+        try:
+            pipe.write(input)
+            pipe.close()
+        except (BrokenPipeError, OSError):
+            pass
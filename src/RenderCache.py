@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import os
+import time
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+
+
+class RenderCache():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, cacheDirectory=None, maxMemoryBytes=None, maxDiskBytes=None, maxAge=None):
+        if cacheDirectory is None:
+            cacheDirectory = Environment.getString("LATEXBOT_CACHE_DIR", "cache/renders")
+        if maxMemoryBytes is None:
+            maxMemoryBytes = Environment.getInt("LATEXBOT_CACHE_MEMORY_MB", 64) * 1024 * 1024
+        if maxDiskBytes is None:
+            maxDiskBytes = Environment.getInt("LATEXBOT_CACHE_DISK_MB", 256) * 1024 * 1024
+        if maxAge is None:
+            maxAge = Environment.getFloat("LATEXBOT_CACHE_MAX_AGE_S", 7 * 24 * 3600)
+        self._cacheDirectory = cacheDirectory
+        self._maxMemoryBytes = max(0, maxMemoryBytes)
+        self._maxDiskBytes = max(0, maxDiskBytes)
+        self._maxAge = maxAge
+
+        self._lock = Lock()
+        self._memory = OrderedDict()
+        self._memoryBytes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                       "memory_evictions": 0, "disk_evictions": 0, "expirations": 0}
+
+        if self._maxDiskBytes > 0:
+            os.makedirs(self._cacheDirectory, exist_ok=True)
+            self._diskBytes = sum(size for _, size, _ in self._listDiskEntries())
+        else:
+            self._diskBytes = 0
+
+    @staticmethod
+    def makeKey(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return data
+
+        data = self._readFromDisk(key)
+        with self._lock:
+            if data is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._putToMemory(key, data)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._putToMemory(key, data)
+        self._writeToDisk(key, data)
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memoryBytes
+            stats["disk_bytes"] = self._diskBytes
+        return stats
+
+    def _putToMemory(self, key, data):
+        if len(data) > self._maxMemoryBytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memoryBytes -= len(previous)
+        self._memory[key] = data
+        self._memoryBytes += len(data)
+        while self._memoryBytes > self._maxMemoryBytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memoryBytes -= len(evicted)
+            self._stats["memory_evictions"] += 1
+
+    def _getPath(self, key):
+        return os.path.join(self._cacheDirectory, key)
+
+    def _readFromDisk(self, key):
+        if self._maxDiskBytes == 0:
+            return None
+        path = self._getPath(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self._maxAge:
+                self._removeFromDisk(path)
+                with self._lock:
+                    self._stats["expirations"] += 1
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # Refresh the modification time so that disk eviction is least-recently-used
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _writeToDisk(self, key, data):
+        if self._maxDiskBytes == 0 or len(data) > self._maxDiskBytes:
+            return
+        path = self._getPath(key)
+        temporaryPath = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temporaryPath, "wb") as f:
+                f.write(data)
+            # An entry written again replaces the old file, only the difference in size is added
+            with self._lock:
+                try:
+                    previousSize = os.path.getsize(path)
+                except FileNotFoundError:
+                    previousSize = 0
+                os.replace(temporaryPath, path)
+                self._diskBytes += len(data) - previousSize
+                overBudget = self._diskBytes > self._maxDiskBytes
+        except OSError as err:
+            self.logger.warn("Could not write render cache entry %s: %s", key, str(err))
+            return
+        if overBudget:
+            self._evictFromDisk()
+
+    def _listDiskEntries(self):
+        entries = []
+        try:
+            with os.scandir(self._cacheDirectory) as it:
+                for entry in it:
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _removeFromDisk(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evictFromDisk(self):
+        # The running total is only an estimate when several processes share the directory,
+        # so recount before evicting the oldest entries down to 90% of the budget
+        entries = self._listDiskEntries()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        evictions = 0
+        expirations = 0
+        for path, size, mtime in sorted(entries, key=lambda entry: entry[2]):
+            expired = now - mtime > self._maxAge
+            if not expired and total <= 0.9 * self._maxDiskBytes:
+                break
+            self._removeFromDisk(path)
+            total -= size
+            if expired:
+                expirations += 1
+            else:
+                evictions += 1
+        with self._lock:
+            self._diskBytes = total
+            self._stats["disk_evictions"] += evictions
+            self._stats["expirations"] += expirations
+        self.logger.debug("Render cache evicted %d entries, %d expired, %d bytes left on disk",
+                          evictions, expirations, total)
@@ -0,0 +1,122 @@
+from functools import partial
+import io
+import time
+import weakref
+from threading import Lock
+
+from src.LoggingServer import LoggingServer
+
+
+class RenderResult():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, produce, cacheKeys, renderCache=None, workspace=None, release=None, singleFlight=None,
+                 cancelEvent=None):
+        # produce(result, artifact) returns the bytes of an artifact, using the intermediates kept in the workspace;
+        # nothing is produced before somebody asks for it
+        self._produce = produce
+        self._cacheKeys = cacheKeys
+        self._renderCache = renderCache
+        self._workspace = workspace
+        self._singleFlight = singleFlight
+        self._cancelEvent = cancelEvent
+        self._lock = Lock()
+        # Different artifacts may be produced at the same time, each one only once
+        self._locks = {}
+        self._artifacts = {}
+        self._stored = set()
+        self._timings = {}
+        # Results that are dropped without close() still give their workspace back
+        self._finalizer = weakref.finalize(self, release) if release is not None else None
+
+    def get(self, artifact):
+        # Views share the buffer with the result, nothing is copied however often it is read
+        return memoryview(self._get(artifact))
+
+    def open(self, artifact):
+        # A BytesIO created from bytes shares the buffer until somebody writes to it
+        return io.BytesIO(self._get(artifact))
+
+    def isAvailable(self, artifact):
+        with self._lock:
+            if artifact in self._artifacts:
+                return True
+            data = self._getFromCache(artifact)
+            if data is not None:
+                self._artifacts[artifact] = data
+                self._timings[artifact] = 0.0
+            return data is not None
+
+    def store(self, artifact, data):
+        # Artifacts produced in the background are cached as soon as they are done, even if the result is closed before
+        # anybody asks for them
+        if self._renderCache is not None:
+            self._renderCache.put(self._cacheKeys[artifact], data)
+        with self._lock:
+            self._stored.add(artifact)
+
+    def getIntermediate(self, name, function):
+        return self._workspace.getIntermediate(name, function, self._cancelEvent)
+
+    def hasIntermediate(self, name):
+        return self._workspace.hasIntermediate(name)
+
+    def getSessionId(self):
+        return self._workspace.getSessionId()
+
+    def getTimings(self):
+        with self._lock:
+            return dict(self._timings)
+
+    def getDirectory(self):
+        return self._workspace.getDirectory()
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def _get(self, artifact):
+        if artifact not in self._cacheKeys:
+            raise ValueError("Unknown artifact: %s" % artifact)
+        with self._getLock(("artifact", artifact)):
+            with self._lock:
+                if artifact in self._artifacts:
+                    return self._artifacts[artifact]
+            startTime = time.time()
+            data = self._getFromCache(artifact)
+            if data is None:
+                if self._singleFlight is None:
+                    data = self._produceAndCache(artifact)
+                else:
+                    # Other results asking for the same artifact at the same time wait for this one instead of producing it again
+                    data = self._singleFlight.do(self._cacheKeys[artifact], partial(self._produceAndCache, artifact),
+                                                 self._cancelEvent)
+            with self._lock:
+                self._timings[artifact] = time.time() - startTime
+                self._artifacts[artifact] = data
+            self.logger.debug("Produced %s in %.3f s", artifact, time.time() - startTime)
+            return data
+
+    def _produceAndCache(self, artifact):
+        data = self._produce(self, artifact)
+        with self._lock:
+            stored = artifact in self._stored
+        if self._renderCache is not None and not stored:
+            self._renderCache.put(self._cacheKeys[artifact], data)
+        return data
+
+    def _getLock(self, name):
+        with self._lock:
+            return self._locks.setdefault(name, Lock())
+
+    def _getFromCache(self, artifact):
+        if self._renderCache is None:
+            return None
+        return self._renderCache.get(self._cacheKeys[artifact])
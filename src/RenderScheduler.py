@@ -0,0 +1,107 @@
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+import os
+import time
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+
+
+class RenderScheduler():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, workers=None, maxQueueSize=None, maxQueuedPerUser=None):
+        if workers is None:
+            workers = Environment.getInt("LATEXBOT_RENDER_WORKERS", os.cpu_count() or 2)
+        if maxQueueSize is None:
+            maxQueueSize = Environment.getInt("LATEXBOT_RENDER_QUEUE_SIZE", 64)
+        if maxQueuedPerUser is None:
+            maxQueuedPerUser = Environment.getInt("LATEXBOT_RENDER_QUEUE_PER_USER", 8)
+        self._maxQueueSize = max(1, maxQueueSize)
+        self._maxQueuedPerUser = max(1, maxQueuedPerUser)
+
+        self._condition = Condition()
+        self._userQueues = OrderedDict()
+        self._queued = 0
+        self._busyWorkers = 0
+        self._stats = {"submitted": 0, "rejected": 0, "superseded": 0, "completed": 0, "failed": 0,
+                       "wait_time_total": 0.0, "wait_time_max": 0.0, "max_queue_depth": 0}
+
+        self._workers = []
+        for idx in range(max(1, workers)):
+            worker = Thread(target=self._work, name="render-worker-%d" % idx)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, userId, function, *args, replaceKey=None):
+        with self._condition:
+            userQueue = self._userQueues.get(userId)
+            if replaceKey is not None and userQueue:
+                # A newer job of the same kind makes the queued ones pointless, they must not take its place in the queue
+                kept = deque(job for job in userQueue if job[3] != replaceKey)
+                self._queued -= len(userQueue) - len(kept)
+                self._stats["superseded"] += len(userQueue) - len(kept)
+                userQueue.clear()
+                userQueue.extend(kept)
+            if self._queued >= self._maxQueueSize or \
+                    (userQueue is not None and len(userQueue) >= self._maxQueuedPerUser):
+                self._stats["rejected"] += 1
+                self.logger.warn("Render queue full (%d queued), rejected job from %s", self._queued, str(userId))
+                return False
+            if userQueue is None:
+                userQueue = self._userQueues[userId] = deque()
+            userQueue.append((time.time(), function, args, replaceKey))
+            self._queued += 1
+            self._stats["submitted"] += 1
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queued)
+            self._condition.notify()
+        return True
+
+    def getLoad(self):
+        with self._condition:
+            return (self._queued + self._busyWorkers) / len(self._workers)
+
+    def getStats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._queued
+            stats["busy_workers"] = self._busyWorkers
+            stats["workers"] = len(self._workers)
+            started = stats["completed"] + stats["failed"] + self._busyWorkers
+        stats["wait_time_avg"] = stats["wait_time_total"] / started if started else 0.0
+        return stats
+
+    def _takeNextJob(self):
+        # Round-robin over users so that one user's burst cannot starve the others
+        userId, userQueue = next(iter(self._userQueues.items()))
+        job = userQueue.popleft()
+        if userQueue:
+            self._userQueues.move_to_end(userId)
+        else:
+            del self._userQueues[userId]
+        self._queued -= 1
+        return job
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._queued == 0:
+                    self._condition.wait()
+                enqueueTime, function, args, _ = self._takeNextJob()
+                waitTime = time.time() - enqueueTime
+                self._busyWorkers += 1
+                self._stats["wait_time_total"] += waitTime
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waitTime)
+
+            failed = False
+            try:
+                function(*args)
+            except Exception as err:
+                failed = True
+                self.logger.warn("Uncaught exception in render worker: %s", str(err))
+            finally:
+                with self._condition:
+                    self._busyWorkers -= 1
+                    self._stats["failed" if failed else "completed"] += 1
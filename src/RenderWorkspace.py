@@ -0,0 +1,103 @@
+from threading import Lock
+import uuid
+
+from src.LoggingServer import LoggingServer
+
+
+class RenderWorkspace():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, sessionId, buildDirectories, singleFlight):
+        # Files and intermediates of one TeX source; results rendering it at the same time share them
+        self._id = uuid.uuid4().hex
+        self._sessionId = sessionId
+        self._buildDirectories = buildDirectories
+        self._singleFlight = singleFlight
+        self._lock = Lock()
+        self._intermediates = {}
+        self._directory = None
+        self._disposed = False
+
+    def getSessionId(self):
+        return self._sessionId
+
+    def getDirectory(self):
+        with self._lock:
+            if self._disposed:
+                raise ValueError("The render has already been closed.")
+            if self._directory is None:
+                self._directory = self._buildDirectories.create()
+            return self._directory
+
+    def getIntermediate(self, name, function, cancelEvent=None):
+        # Work shared by several artifacts, like the compiled PDF or its bounding box, is done by the first one needing it
+        with self._lock:
+            if name in self._intermediates:
+                return self._intermediates[name]
+        return self._singleFlight.do((self._id, name), lambda: self._compute(name, function), cancelEvent)
+
+    def hasIntermediate(self, name):
+        with self._lock:
+            return name in self._intermediates
+
+    def dispose(self):
+        with self._lock:
+            directory = self._directory
+            self._directory = None
+            self._disposed = True
+            self._intermediates = {}
+        if directory is not None:
+            self._buildDirectories.remove(directory)
+
+    def _compute(self, name, function):
+        with self._lock:
+            if name in self._intermediates:
+                return self._intermediates[name]
+        value = function()
+        with self._lock:
+            self._intermediates[name] = value
+        return value
+
+
+class RenderWorkspaces():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, buildDirectories, singleFlight):
+        self._buildDirectories = buildDirectories
+        self._singleFlight = singleFlight
+        self._lock = Lock()
+        self._workspaces = {}
+
+    def acquire(self, sourceKey, sessionId):
+        with self._lock:
+            if sourceKey not in self._workspaces:
+                self._workspaces[sourceKey] = [RenderWorkspace(sessionId, self._buildDirectories, self._singleFlight), 0]
+            entry = self._workspaces[sourceKey]
+            entry[1] += 1
+            return entry[0]
+
+    def retain(self, sourceKey, workspace):
+        # Another holder of a workspace that is still acquired, like the stages of a render running in the background
+        with self._lock:
+            entry = self._workspaces.get(sourceKey)
+            if entry is None or entry[0] is not workspace:
+                return False
+            entry[1] += 1
+            return True
+
+    def release(self, sourceKey, workspace):
+        with self._lock:
+            entry = self._workspaces.get(sourceKey)
+            if entry is None or entry[0] is not workspace:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._workspaces[sourceKey]
+        workspace.dispose()
+
+    def getActiveCount(self):
+        with self._lock:
+            return len(self._workspaces)
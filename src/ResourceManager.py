@@ -1,15 +1,77 @@
+from threading import Lock
 import json
+import glob
+import os
+import re
+import time
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
 
 class ResourceManager():
-    
-    def __init__(self, stringsFile = "resources/strings.json", numbersFile = "resources/numbers.json"):
+
+    logger = LoggingServer.getInstance()
+
+    referencePattern = re.compile(r"get(String|Number)\(\s*[\"']([A-Za-z0-9_]+)[\"']\s*\)")
+    sourceDirectory = os.path.dirname(os.path.abspath(__file__))
+
+    def __init__(self, stringsFile = "resources/strings.json", numbersFile = "resources/numbers.json",
+                 hotReload = None, sourceDirectory = None):
+        if hotReload is None:
+            hotReload = Environment.getBool("LATEXBOT_RESOURCES_HOT_RELOAD")
         self._stringsFile = stringsFile
         self._numbersFile = numbersFile
-        
+        self._hotReload = hotReload
+        self._reloadInterval = 1
+        self._lastReloadCheck = time.time()
+        self._lock = Lock()
+        self._resources = {}
+        for resourceFile in (self._stringsFile, self._numbersFile):
+            self._resources[resourceFile] = self._load(resourceFile)
+        if sourceDirectory is not None:
+            self.validate(sourceDirectory)
+
     def getString(self, stringId):
-        with open(self._stringsFile, "r") as f:
-            return json.load(f)[stringId]
-    
+        return self._getResources(self._stringsFile)[stringId]
+
     def getNumber(self, numberId):
-        with open(self._numbersFile, "r") as f:
-            return json.load(f)[numberId]
+        return self._getResources(self._numbersFile)[numberId]
+
+    def validate(self, sourceDirectory = None):
+        # Called once when a bot starts, so that it fails then rather than on the request that first needs a missing
+        # resource; reading every source file is too slow to happen whenever a manager is created
+        if sourceDirectory is None:
+            sourceDirectory = ResourceManager.sourceDirectory
+        missing = set()
+        for sourceFile in glob.glob(os.path.join(sourceDirectory, "*.py")):
+            with open(sourceFile, "r", encoding="utf-8") as f:
+                source = f.read()
+            for kind, resourceId in self.referencePattern.findall(source):
+                resourceFile = self._stringsFile if kind == "String" else self._numbersFile
+                if resourceId not in self._resources[resourceFile][1]:
+                    missing.add("%s (%s)" % (resourceId, resourceFile))
+        if missing:
+            raise ValueError("Missing resources: " + ", ".join(sorted(missing)))
+
+    def _getResources(self, resourceFile):
+        if self._hotReload and time.time() - self._lastReloadCheck > self._reloadInterval:
+            self._reload()
+        return self._resources[resourceFile][1]
+
+    def _reload(self):
+        with self._lock:
+            self._lastReloadCheck = time.time()
+            for resourceFile, (mtime, _) in list(self._resources.items()):
+                try:
+                    if os.stat(resourceFile).st_mtime == mtime:
+                        continue
+                    self._resources[resourceFile] = self._load(resourceFile)
+                    self.logger.debug("Reloaded %s", resourceFile)
+                except (OSError, ValueError) as err:
+                    # Keep serving the last good version while the file is being edited
+                    self.logger.warn("Could not reload %s: %s", resourceFile, str(err))
+
+    def _load(self, resourceFile):
+        mtime = os.stat(resourceFile).st_mtime
+        with open(resourceFile, "r") as f:
+            return mtime, json.load(f)
@@ -0,0 +1,74 @@
+from threading import Event, Lock
+
+from src.LoggingServer import LoggingServer
+from src.ProcessRunner import RenderCancelledError
+
+
+class InFlightCall():
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, pollInterval=0.02):
+        self._pollInterval = pollInterval
+        self._lock = Lock()
+        self._calls = {}
+        self._stats = {"leaders": 0, "followers": 0, "retries": 0}
+
+    def do(self, key, function, cancelEvent=None):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = InFlightCall()
+                    self._stats["leaders"] += 1
+                else:
+                    self._stats["followers"] += 1
+            if leader:
+                return self._lead(key, call, function)
+
+            self._wait(call, cancelEvent)
+            if isinstance(call.error, RenderCancelledError):
+                # The leader's own request was cancelled, not ours: run it again, possibly as the new leader
+                with self._lock:
+                    self._stats["retries"] += 1
+                self.logger.debug("Leader of %s was cancelled, retrying", key)
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+    def _lead(self, key, call, function):
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _wait(self, call, cancelEvent):
+        if cancelEvent is None:
+            call.done.wait()
+            return
+        # A follower that is cancelled stops waiting, the leader keeps running for the others
+        while not call.done.wait(self._pollInterval):
+            if cancelEvent.is_set():
+                raise RenderCancelledError("coalesced render")
@@ -0,0 +1,115 @@
+from threading import local, Lock
+import pickle
+import sqlite3
+import os
+import re
+
+from src.LoggingServer import LoggingServer
+
+
+class SqliteStorage():
+
+    logger = LoggingServer.getInstance()
+
+    def __init__(self, databaseFile, table, pickleFile=None):
+        if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", table):
+            raise ValueError("Invalid table name: " + table)
+        self._databaseFile = databaseFile
+        self._table = table
+        self._connections = local()
+        self._versionLock = Lock()
+        self._versionConnection = None
+        self._dataVersion = None
+        self._version = None
+        directory = os.path.dirname(self._databaseFile)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        connection = self._getConnection()
+        # The key column has no declared type so that int and str keys are stored and returned as they were given
+        connection.execute("CREATE TABLE IF NOT EXISTS %s (key PRIMARY KEY, value BLOB NOT NULL)" % self._table)
+        connection.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)")
+        connection.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        connection.execute("INSERT OR IGNORE INTO versions (name, version) VALUES (?, 0)", (self._table,))
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            # Every process sees the same counter, so caches can tell when another process changed the table
+            connection.execute("CREATE TRIGGER IF NOT EXISTS %s_%s_version AFTER %s ON %s BEGIN "
+                               "UPDATE versions SET version = version + 1 WHERE name = '%s'; END"
+                               % (self._table, operation.lower(), operation, self._table, self._table))
+        if pickleFile is not None:
+            self._migrate(pickleFile)
+
+    def get(self, key):
+        row = self._getConnection().execute("SELECT value FROM %s WHERE key = ?" % self._table, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def contains(self, key):
+        return self._getConnection().execute("SELECT 1 FROM %s WHERE key = ?" % self._table,
+                                             (key,)).fetchone() is not None
+
+    def put(self, key, value):
+        self._getConnection().execute("INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)" % self._table,
+                                      (key, pickle.dumps(value)))
+
+    def delete(self, key):
+        self._getConnection().execute("DELETE FROM %s WHERE key = ?" % self._table, (key,))
+
+    def keys(self):
+        return [row[0] for row in self._getConnection().execute("SELECT key FROM %s" % self._table)]
+
+    def items(self):
+        return [(row[0], pickle.loads(row[1])) for row in
+                self._getConnection().execute("SELECT key, value FROM %s" % self._table)]
+
+    def getVersion(self):
+        with self._versionLock:
+            if self._versionConnection is None or self._versionConnection[1] != os.getpid():
+                self._versionConnection = (self._connect(check_same_thread=False), os.getpid())
+                self._dataVersion = None
+            connection = self._versionConnection[0]
+            # data_version only changes after commits by other connections, reading it touches no table pages
+            dataVersion = connection.execute("PRAGMA data_version").fetchone()[0]
+            if dataVersion != self._dataVersion:
+                self._version = connection.execute("SELECT version FROM versions WHERE name = ?",
+                                                   (self._table,)).fetchone()[0]
+                self._dataVersion = dataVersion
+            return self._version
+
+    def _getConnection(self):
+        # sqlite3 connections must not be shared between threads, nor inherited by forked processes
+        connection = getattr(self._connections, "connection", None)
+        if connection is None or self._connections.pid != os.getpid():
+            connection = self._connect()
+            self._connections.connection = connection
+            self._connections.pid = os.getpid()
+        return connection
+
+    def _connect(self, check_same_thread=True):
+        connection = sqlite3.connect(self._databaseFile, timeout=10, isolation_level=None,
+                                     check_same_thread=check_same_thread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _migrate(self, pickleFile):
+        name = self._table + ":" + os.path.abspath(pickleFile)
+        connection = self._getConnection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone() is None:
+                try:
+                    with open(pickleFile, "rb") as f:
+                        entries = pickle.load(f)
+                except (FileNotFoundError, EOFError):
+                    entries = {}
+                # Rows written through the database take precedence over the old pickle contents
+                connection.executemany("INSERT OR IGNORE INTO %s (key, value) VALUES (?, ?)" % self._table,
+                                       [(key, pickle.dumps(value)) for key, value in entries.items()])
+                connection.execute("INSERT INTO migrations (name) VALUES (?)", (name,))
+                self.logger.debug("Migrated %d entries from %s to %s", len(entries), pickleFile, self._table)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
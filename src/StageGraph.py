@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+import os
+
+from src.Environment import Environment
+from src.LoggingServer import LoggingServer
+
+
+class StageGraph():
+
+    logger = LoggingServer.getInstance()
+
+    # Stages of all renders share one pool, its size is the number of stages allowed to run at once
+    _executor = None
+    _executorLock = Lock()
+
+    def __init__(self, executor=None, onStart=None, onDone=None):
+        # onStart runs before the first stage, onDone once every stage has finished, whether anybody waits for it or not
+        self._ownExecutor = executor
+        self._onStart = onStart
+        self._onDone = onDone
+        self._started = False
+        self._finished = False
+        self._lock = Lock()
+        self._stages = {}
+        self._dependents = {}
+        self._done = {}
+        self._scheduled = set()
+        self._results = {}
+        self._errors = {}
+        self._completed = []
+
+    @classmethod
+    def getCpuBudget(cls):
+        return max(1, Environment.getInt("LATEXBOT_CPU_BUDGET", os.cpu_count() or 2))
+
+    @classmethod
+    def getSharedExecutor(cls):
+        with cls._executorLock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.getCpuBudget(), thread_name_prefix="stage")
+            return cls._executor
+
+    def add(self, name, function, dependencies=()):
+        for dependency in dependencies:
+            if dependency not in self._stages:
+                raise ValueError("Unknown dependency %s of stage %s" % (dependency, name))
+        self._stages[name] = (function, tuple(dependencies))
+        self._done[name] = Event()
+        for dependency in dependencies:
+            self._dependents.setdefault(dependency, []).append(name)
+
+    def hasStage(self, name):
+        return name in self._stages
+
+    def getCompleted(self):
+        with self._lock:
+            return list(self._completed)
+
+    def start(self):
+        # Every stage starts as soon as its dependencies are done, stages nobody waits for keep running in the background
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            roots = [name for name, (_, dependencies) in self._stages.items() if not dependencies]
+            self._scheduled.update(roots)
+        if self._onStart is not None:
+            self._onStart()
+        for name in roots:
+            self._submit(name)
+
+    def wait(self, name):
+        self.start()
+        self._done[name].wait()
+        if name in self._errors:
+            raise self._errors[name]
+        return self._results[name]
+
+    def run(self):
+        results = {}
+        error = None
+        for name in self._stages:
+            try:
+                results[name] = self.wait(name)
+            except BaseException as err:
+                if error is None:
+                    error = err
+        if error is not None:
+            raise error
+        return results
+
+    def _submit(self, name):
+        executor = self._ownExecutor if self._ownExecutor is not None else self.getSharedExecutor()
+        executor.submit(self._runStage, name)
+
+    def _runStage(self, name):
+        try:
+            result = self._stages[name][0]()
+        except BaseException as err:
+            # Stages running in the background may fail without anybody waiting for them
+            self.logger.debug("Stage %s failed: %s", name, str(err))
+            self._finish(name, None, err)
+            return
+        self._finish(name, result, None)
+
+    def _finish(self, name, result, error):
+        ready = []
+        with self._lock:
+            if error is None:
+                self._results[name] = result
+                self._completed.append(name)
+            else:
+                self._errors[name] = error
+            self._done[name].set()
+            for dependent in self._dependents.get(name, []):
+                if dependent not in self._scheduled and \
+                        all(self._done[dependency].is_set() for dependency in self._stages[dependent][1]):
+                    self._scheduled.add(dependent)
+                    ready.append(dependent)
+            done = not self._finished and all(event.is_set() for event in self._done.values())
+            if done:
+                self._finished = True
+        if done and self._onDone is not None:
+            self._onDone()
+        for dependent in ready:
+            errors = [self._errors[dependency] for dependency in self._stages[dependent][1] if dependency in self._errors]
+            if errors:
+                # A stage whose input failed fails the same way without running
+                self._finish(dependent, None, errors[0])
+            else:
+                self._submit(dependent)
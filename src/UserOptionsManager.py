@@ -1,20 +1,16 @@
-import pickle
-from multiprocessing import Lock
-import os
+from threading import Lock
 
 from src.LoggingServer import LoggingServer
+from src.SqliteStorage import SqliteStorage
 
 class UserOptionsManager():
 
     
-    def __init__(self, optionsFile = "./resources/options.pkl"):
-        self._optionsFile = optionsFile
-        self._lock = Lock()
-        # Ensure file exists
-        os.makedirs(os.path.dirname(self._optionsFile), exist_ok=True)
-        if not os.path.exists(self._optionsFile):
-            with open(self._optionsFile, "wb") as f:
-                pickle.dump({}, f)
+    def __init__(self, optionsFile = "./resources/options.pkl", databaseFile = "./resources/inlatexbot.sqlite"):
+        self._storage = SqliteStorage(databaseFile, "options", optionsFile)
+        self._cacheLock = Lock()
+        self._cache = {}
+        self._cacheVersion = None
     
     def getDpiOption(self, userId):
         try:
@@ -49,19 +45,47 @@ class UserOptionsManager():
         userOptions['show_code_in_caption'] = value
         self.setUserOptions(userId, userOptions)
         
+    def getOutputFormatOption(self, userId):
+        try:
+            userOptions = self.getUserOptions(userId)
+        except KeyError:
+            userOptions = self.getDefaultUserOptions()
+        try:
+            return userOptions['output_format']
+        except KeyError:
+            return self.getDefaultUserOptions()["output_format"]
+
+    def setOutputFormatOption(self, userId, value):
+        try:
+            userOptions = self.getUserOptions(userId)
+        except KeyError:
+            userOptions = self.getDefaultUserOptions()
+        userOptions['output_format'] = value
+        self.setUserOptions(userId, userOptions)
+
     def getUserOptions(self, userId):
-        with self._lock:
-            with open(self._optionsFile, "rb") as f:
-                userOptions = pickle.load(f)[userId]
-            return userOptions
+        # The table version changes with every write from any process, which drops the whole cache
+        version = self._storage.getVersion()
+        with self._cacheLock:
+            if version != self._cacheVersion:
+                self._cache = {}
+                self._cacheVersion = version
+            found = userId in self._cache
+            userOptions = self._cache.get(userId)
+        if not found:
+            try:
+                userOptions = self._storage.get(userId)
+            except KeyError:
+                userOptions = None
+            with self._cacheLock:
+                if version == self._cacheVersion:
+                    self._cache[userId] = userOptions
+        if userOptions is None:
+            raise KeyError(userId)
+        return dict(userOptions)
     
     def setUserOptions(self, userId, userOptions):
-        with self._lock:
-            with open(self._optionsFile, "rb") as f:
-                options = pickle.load(f)
-            options[userId] = userOptions
-            with open(self._optionsFile, "wb") as f:
-                pickle.dump(options, f)
+        self._storage.put(userId, userOptions)
         
     def getDefaultUserOptions(self):
-        return {'show_code_in_caption': False, "dpi":300}
+        return {'show_code_in_caption': False, "dpi":300, "output_format":"png"}
@@ -1,33 +1,20 @@
-import pickle
-from multiprocessing import Lock
-import os
+
+from src.SqliteStorage import SqliteStorage
 
 class UsersManager():
     
-    def __init__(self, usersFile = "./resources/users.pkl"):
-        self._usersFile = usersFile
-        self._lock = Lock()
-        # Ensure file exists
-        os.makedirs(os.path.dirname(self._usersFile), exist_ok=True)
-        if not os.path.exists(self._usersFile):
-            with open(self._usersFile, "wb") as f:
-                pickle.dump({}, f)
+    def __init__(self, usersFile = "./resources/users.pkl", databaseFile = "./resources/inlatexbot.sqlite"):
+        # Users are stored in the bot's SQLite database, the old pickle is migrated into it once
+        self._storage = SqliteStorage(databaseFile, "users", usersFile)
     
     def getKnownUsers(self):
-        with self._lock:
-            with open(self._usersFile, "rb") as f:
-                return pickle.load(f).keys()
+        return self._storage.keys()
+
+    def isKnownUser(self, userId):
+        return self._storage.contains(userId)
         
     def getUser(self, userId):
-        with self._lock:
-            with open(self._usersFile, "rb") as f:
-                user = pickle.load(f)[userId]
-            return user
+        return self._storage.get(userId)
     
     def setUser(self, userId, user):
-        with self._lock:
-            with open(self._usersFile, "rb") as f:
-                options = pickle.load(f)
-            options[userId] = user
-            with open(self._usersFile, "wb") as f:
-                pickle.dump(options, f)
+        self._storage.put(userId, user)
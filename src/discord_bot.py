@@ -9,6 +9,10 @@ from discord.ext import commands
 
 from src.LatexConverter import LatexConverter
 from src.PreambleManager import PreambleManager
+from src.RenderCache import RenderCache
+from src.FormatCache import FormatCache
+from src.PdflatexWorkerPool import PdflatexWorkerPool
+from src.BuildDirectories import BuildDirectories
 from src.ResourceManager import ResourceManager
 from src.UserOptionsManager import UserOptionsManager
 from src.UsersManager import UsersManager
@@ -27,7 +31,8 @@ class PreambleModal(discord.ui.Modal, title="Set Custom LaTeX Preamble"):
 
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
-        valid, msg = self.pm.validatePreamble(str(self.preamble.value))
+        loop = asyncio.get_running_loop()
+        valid, msg = await loop.run_in_executor(None, self.pm.validatePreamble, str(self.preamble.value))
         if valid:
             self.pm.putPreambleToDatabase(self.user_id, str(self.preamble.value))
             await interaction.followup.send(self.rm.getString("preamble_registered"), ephemeral=True)
@@ -80,13 +85,7 @@ class OverleafModal(discord.ui.Modal, title="Overleaf-like LaTeX Editor"):
         try:
             user_id = interaction.user.id
             session_id = f"{interaction.id}_{user_id}"
-            image_stream, pdf_stream = bot.converter.convertExpression(str(self.code.value), user_id, session_id, returnPdf=True)
-            image_stream.seek(0)
-            pdf_stream.seek(0)
-            files = [
-                discord.File(fp=image_stream, filename="expression.png"),
-                discord.File(fp=pdf_stream, filename="expression.pdf")
-            ]
+            files = await bot.render_files(str(self.code.value), user_id, session_id)
             await interaction.followup.send(files=files)
         except ValueError as err:
             await interaction.followup.send(f"Syntax error or processing issue:\n{err}", ephemeral=True)
@@ -107,10 +106,16 @@ class InLatexDiscordBot(commands.Bot):
 
         self.logger = LoggingServer.getInstance()
         self.rm = ResourceManager()
+        self.rm.validate()
         self.uom = UserOptionsManager()
         self.um = UsersManager()
-        self.pm = PreambleManager(self.rm)
-        self.converter = LatexConverter(self.pm, self.uom)
+        self.format_cache = FormatCache()
+        self.build_directories = BuildDirectories()
+        self.pm = PreambleManager(self.rm, formatCache=self.format_cache, buildDirectories=self.build_directories)
+        self.render_cache = RenderCache()
+        self.converter = LatexConverter(self.pm, self.uom, self.render_cache, self.format_cache,
+                                        PdflatexWorkerPool(self.format_cache, workingDirectory=self.build_directories.getRoot()),
+                                        buildDirectories=self.build_directories)
 
     async def setup_hook(self) -> None:
         guild_id = os.environ.get("DISCORD_GUILD_ID")
@@ -136,10 +141,16 @@ class InLatexDiscordBot(commands.Bot):
             except Exception as e:
                 self.logger.warn("Guild command sync failed for guild %s: %s", guild_id, e)
 
+    async def render_files(self, code: str, user_id: int, session_id: str):
+        # Users who chose SVG get the vector file alone, without the PNG/PDF pair
+        formats = ("svg",) if self.uom.getOutputFormatOption(user_id) == "svg" else ("png", "pdf")
+        result = await self.converter.convertExpressionAsync(code, user_id, session_id, formats)
+        with result:
+            return [discord.File(fp=result.open(artifact), filename="expression." + artifact) for artifact in formats]
+
     async def on_ready(self):
         self.logger.debug("Discord bot logged in as %s", self.user.name)
         # Ensure dirs/files exist
-        os.makedirs("build", exist_ok=True)
         os.makedirs("log", exist_ok=True)
 
     async def on_message(self, message: discord.Message):
@@ -198,13 +209,7 @@ class InLatexDiscordBot(commands.Bot):
                         wait_msg = await message.reply("Rendering your LaTeX… please wait ⏳")
                     except Exception:
                         pass
-                    image_stream, pdf_stream = self.converter.convertExpression(content_for_render, user_id, session_id, returnPdf=True)
-                    image_stream.seek(0)
-                    pdf_stream.seek(0)
-                    files = [
-                        discord.File(fp=image_stream, filename="expression.png"),
-                        discord.File(fp=pdf_stream, filename="expression.pdf")
-                    ]
+                    files = await self.render_files(content_for_render, user_id, session_id)
                 # Send result and remove wait message if possible
                 await message.reply(files=files)
                 if wait_msg:
@@ -250,6 +255,7 @@ async def start_cmd(interaction: discord.Interaction):
         "- Code fences: ```latex ... ``` will also render.\n\n"
         "Tips:\n"
         "- Open `/settings` to change DPI and edit your preamble.\n"
+        "- Use `/setformat` to get an SVG instead of PNG + PDF.\n"
         "- `/getmypreamble` and `/setcustompreamble` manage your LaTeX preamble.\n"
         "- Need help with dependencies? Try `/diagnose`.\n"
     )
@@ -263,13 +269,7 @@ async def latex_cmd(interaction: discord.Interaction, code: str):
     user_id = interaction.user.id
     session_id = f"{interaction.id}_{user_id}"
     try:
-        image_stream, pdf_stream = bot.converter.convertExpression(code, user_id, session_id, returnPdf=True)
-        image_stream.seek(0)
-        pdf_stream.seek(0)
-        files = [
-            discord.File(fp=image_stream, filename="expression.png"),
-            discord.File(fp=pdf_stream, filename="expression.pdf")
-        ]
+        files = await bot.render_files(code, user_id, session_id)
         await interaction.followup.send(files=files)
     except ValueError as err:
         await interaction.followup.send(f"Syntax error or processing issue:\n{err}", ephemeral=True)
@@ -293,6 +293,17 @@ async def setdpi_cmd(interaction: discord.Interaction, dpi: int):
     await interaction.response.send_message(bot.rm.getString("dpi_set") % dpi, ephemeral=True)
 
 
+@bot.tree.command(name="setformat", description="Choose between PNG + PDF and SVG output")
+@app_commands.describe(output="png: image and PDF (default), svg: a single vector file")
+@app_commands.choices(output=[
+    app_commands.Choice(name="PNG + PDF", value="png"),
+    app_commands.Choice(name="SVG", value="svg"),
+])
+async def setformat_cmd(interaction: discord.Interaction, output: app_commands.Choice[str]):
+    bot.uom.setOutputFormatOption(interaction.user.id, output.value)
+    await interaction.response.send_message(bot.rm.getString("format_set_" + output.value), ephemeral=True)
+
+
 @bot.tree.command(name="getmypreamble", description="Show your current preamble")
 async def getmypreamble_cmd(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
@@ -342,6 +353,18 @@ async def diagnose_cmd(interaction: discord.Interaction):
         lines.append(f"Ghostscript: found at {gs_path}")
     else:
         lines.append("Ghostscript: NOT FOUND — install Ghostscript and ensure 'gs', 'gswin64c' or 'gswin32c' is on PATH")
+    stats = bot.render_cache.getStats()
+    lines.append("Render cache: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
+    for tier, stats in bot.converter.getPreambleTierStats().items():
+        lines.append(f"Preamble tier {tier}: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
+    stats = bot.converter.getErrorCacheStats()
+    lines.append("Compile error cache: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
+    stats = bot.converter.getCoalescingStats()
+    lines.append("Coalesced renders: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
+    stats = bot.converter.getDviStats()
+    lines.append("DVI fast path: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
+    stats = bot.converter.getPixelBudgetStats()
+    lines.append("Pixel budget: " + ", ".join(f"{name}={value}" for name, value in stats.items()))
     await interaction.followup.send("\n".join(lines), ephemeral=True)
 
 
@@ -0,0 +1,52 @@
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.BuildDirectories import BuildDirectories
+
+class BuildDirectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootDirectory = tempfile.mkdtemp()
+        self.sut = BuildDirectories(self.rootDirectory, maxAge=60, janitorInterval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDirectory, ignore_errors=True)
+
+    def testCreateAndRemove(self):
+        first = self.sut.create()
+        second = self.sut.create()
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.basename(first).startswith("job_%d_" % os.getpid()))
+        with open(os.path.join(first, "expression_file_id.tex"), "w") as f:
+            f.write("test")
+        self.sut.remove(first)
+        self.assertEqual(os.listdir(self.rootDirectory), [os.path.basename(second)])
+
+    def testCleanRemovesDirectoriesOfDeadProcesses(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        os.makedirs(os.path.join(self.rootDirectory, "job_%d_orphan" % process.pid))
+        os.makedirs(os.path.join(self.rootDirectory, "worker_%d_orphan" % process.pid))
+        alive = self.sut.create()
+        self.assertEqual(self.sut.clean(), 2)
+        self.assertEqual(os.listdir(self.rootDirectory), [os.path.basename(alive)])
+
+    def testCleanRemovesOnlyStaleJobDirectories(self):
+        job = self.sut.create()
+        worker = os.path.join(self.rootDirectory, "worker_%d_idle" % os.getpid())
+        os.makedirs(worker)
+        unrelated = os.path.join(self.rootDirectory, "unrelated")
+        os.makedirs(unrelated)
+        stale = time.time() - 120
+        for directory in (job, worker, unrelated):
+            os.utime(directory, (stale, stale))
+        self.assertEqual(self.sut.clean(), 1)
+        self.assertEqual(sorted(os.listdir(self.rootDirectory)), sorted(["unrelated", os.path.basename(worker)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import time
+
+from src.CompileErrorCache import CompileErrorCache
+
+class CompileErrorCacheTest(unittest.TestCase):
+
+    def testPutAndGet(self):
+        sut = CompileErrorCache(maxEntries=2, ttl=60)
+        sut.put("key", "! Missing $ inserted.")
+        self.assertEqual(sut.get("key"), "! Missing $ inserted.")
+        with self.assertRaises(KeyError):
+            sut.get("other")
+
+    def testUnknownErrorIsCached(self):
+        sut = CompileErrorCache(maxEntries=2, ttl=60)
+        sut.put("key", None)
+        self.assertEqual(sut.get("key"), None)
+
+    def testExpiration(self):
+        sut = CompileErrorCache(maxEntries=2, ttl=0.01)
+        sut.put("key", "error")
+        time.sleep(0.02)
+        with self.assertRaises(KeyError):
+            sut.get("key")
+        self.assertEqual(sut.getStats()["expirations"], 1)
+
+    def testEviction(self):
+        sut = CompileErrorCache(maxEntries=2, ttl=60)
+        for key in ("first", "second", "third"):
+            sut.put(key, "error")
+        with self.assertRaises(KeyError):
+            sut.get("first")
+        self.assertEqual(sut.getStats()["evictions"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from src.ExpressionValidator import ExpressionValidator
+
+class ExpressionValidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = ExpressionValidator()
+
+    def testNoFalsePositivesOnCorpus(self):
+        with open("resources/test/valid_expressions.txt", "r") as f:
+            expressions = f.read().split("\n====\n")
+        falsePositives = []
+        for expression in expressions:
+            try:
+                if r"\documentclass" in expression:
+                    self.sut.validate(expression, checkEnvironments=False)
+                else:
+                    self.sut.validate(expression)
+            except ValueError as err:
+                falsePositives.append((expression, err.args[0]))
+        self.assertEqual(falsePositives, [])
+
+    def testUnbalancedBraces(self):
+        with self.assertRaisesRegex(ValueError, "Missing } for this {.\nl.1, column 10"):
+            self.sut.validate("$\\frac{1}{2$")
+        with self.assertRaisesRegex(ValueError, "Extra }"):
+            self.sut.validate("x}")
+
+    def testUnmatchedMathShift(self):
+        with self.assertRaisesRegex(ValueError, "Missing \\$ to close this \\$.\nl.2, column 1"):
+            self.sut.validate("x\n$x^2")
+
+    def testTrailingScripts(self):
+        with self.assertRaisesRegex(ValueError, "Missing argument for \\^"):
+            self.sut.validate("$x^ $")
+        with self.assertRaisesRegex(ValueError, "Missing argument for _"):
+            self.sut.validate("$x_")
+
+    def testEnvironments(self):
+        with self.assertRaisesRegex(ValueError, "is never ended"):
+            self.sut.validate("\\begin{align}x")
+        with self.assertRaisesRegex(ValueError, "ended by"):
+            self.sut.validate("\\begin{align}x\\end{equation}")
+        self.sut.validate("\\begin{align}x", checkEnvironments=False)
+
+    def testCustomPreambleDefinitions(self):
+        self.sut.validate("\\be x \\end{equation}", preamble="\\newcommand{\\be}{\\begin{equation}}",
+                          checkEnvironments=False)
+        self.sut.validate("\\m x", preamble="\\def\\m{$}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import tempfile
+import os
+
+from src.FileIdCache import FileIdCache
+
+class FileIdCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.databaseFile = tempfile.mktemp(suffix=".sqlite")
+        self.sut = FileIdCache(self.databaseFile, maxEntries=2)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.databaseFile + suffix):
+                os.remove(self.databaseFile + suffix)
+
+    def testPutAndGet(self):
+        self.sut.put("key", "file_id")
+        self.assertEqual(self.sut.get("key"), "file_id")
+        self.assertEqual(self.sut.get("other"), None)
+        stats = self.sut.getStats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.sut.put("first", "1")
+        self.sut.put("second", "2")
+        self.sut.get("first")
+        self.sut.put("third", "3")
+        self.assertEqual(self.sut.get("second"), None)
+        self.assertEqual(self.sut.get("first"), "1")
+        self.assertEqual(self.sut.getStats()["evictions"], 1)
+
+    def testInvalidate(self):
+        self.sut.put("key", "file_id")
+        self.sut.invalidate("key")
+        self.assertEqual(self.sut.get("key"), None)
+        self.assertEqual(self.sut.getStats()["invalidations"], 1)
+
+    def testPersistsAcrossInstances(self):
+        self.sut.put("key", "file_id")
+        other = FileIdCache(self.databaseFile, maxEntries=2)
+        self.assertEqual(other.get("key"), "file_id")
+
+if __name__ == '__main__':
+    unittest.main()
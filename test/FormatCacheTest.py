@@ -0,0 +1,106 @@
+import unittest
+from unittest.mock import Mock
+from subprocess import CalledProcessError, TimeoutExpired
+from threading import Event
+import tempfile
+import shutil
+import os
+import time
+
+from src.FormatCache import FormatCache
+
+class FormatCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDirectory = tempfile.mkdtemp()
+        self.sut = FormatCache(self.cacheDirectory, maxEntries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDirectory, ignore_errors=True)
+
+    def putFakeFormat(self, preamble, age=0):
+        path = os.path.join(self.cacheDirectory, self.sut.getFormatName(preamble) + ".fmt")
+        open(path, "w").close()
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def testGetFormatName(self):
+        self.assertEqual(self.sut.getFormatName("a"), self.sut.getFormatName("a"))
+        self.assertNotEqual(self.sut.getFormatName("a"), self.sut.getFormatName("b"))
+
+    def testDviFormatsAreDumpedInDviMode(self):
+        self.assertNotEqual(self.sut.getFormatName("a"), self.sut.getFormatName("a", "dvi"))
+        self.sut._engineVersion = "pdfTeX"
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(side_effect=CalledProcessError(1, ["pdflatex"]))
+        self.assertIsNone(self.sut.buildFormat("a", "dvi"))
+        args = self.sut._processRunner.run.call_args[0][0]
+        self.assertIn("-output-format=dvi", args)
+        self.assertIn("-jobname=" + self.sut.getFormatName("a", "dvi"), args)
+
+    def testGetFormat(self):
+        self.assertIsNone(self.sut.getFormat("a"))
+        self.putFakeFormat("a")
+        self.assertEqual(self.sut.getFormat("a"), self.sut.getFormatName("a"))
+        self.sut.invalidate(self.sut.getFormatName("a"))
+        self.assertIsNone(self.sut.getFormat("a"))
+
+    def testEnvironment(self):
+        self.assertTrue(self.sut.getEnvironment()["TEXFORMATS"].startswith(os.path.abspath(self.cacheDirectory)))
+
+    def testEviction(self):
+        oldest = self.putFakeFormat("a", age=30)
+        self.putFakeFormat("b", age=20)
+        self.putFakeFormat("c", age=10)
+        self.sut._evict()
+        self.assertFalse(os.path.exists(oldest))
+        self.assertIsNotNone(self.sut.getFormat("b"))
+        self.assertIsNotNone(self.sut.getFormat("c"))
+
+    def testOnlyTexErrorsAreRemembered(self):
+        self.sut._engineVersion = "pdfTeX"
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(side_effect=TimeoutExpired(["pdflatex"], 30))
+        self.assertIsNone(self.sut.buildFormat("a"))
+        self.assertFalse(self.sut._hasFailed(self.sut.getFormatName("a")))
+        self.sut._processRunner.run = Mock(side_effect=CalledProcessError(-9, ["pdflatex"]))
+        self.assertIsNone(self.sut.buildFormat("a"))
+        self.assertFalse(self.sut._hasFailed(self.sut.getFormatName("a")))
+        self.sut._processRunner.run = Mock(side_effect=CalledProcessError(1, ["pdflatex"]))
+        self.assertIsNone(self.sut.buildFormat("a"))
+        self.assertTrue(self.sut._hasFailed(self.sut.getFormatName("a")))
+        self.sut.buildFormat("a")
+        self.assertEqual(self.sut._processRunner.run.call_count, 1)
+
+    def testFailuresExpire(self):
+        self.sut = FormatCache(self.cacheDirectory, maxEntries=2, failureTtl=60)
+        path = os.path.join(self.cacheDirectory, self.sut.getFormatName("a") + ".failed")
+        open(path, "w").close()
+        self.assertTrue(self.sut._hasFailed(self.sut.getFormatName("a")))
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        self.assertFalse(self.sut._hasFailed(self.sut.getFormatName("a")))
+        self.assertFalse(os.path.exists(path))
+
+    def testFormatsAreDumpedInBackground(self):
+        release = Event()
+        self.sut.buildFormat = Mock(side_effect=lambda preamble, outputFormat: release.wait(5) and None)
+        self.assertIsNone(self.sut.getOrScheduleFormat("a"))
+        # A render arriving during the dump compiles from source as well, without scheduling it twice
+        self.assertIsNone(self.sut.getOrScheduleFormat("a"))
+        release.set()
+        deadline = time.time() + 5
+        while self.sut._scheduled and time.time() < deadline:
+            time.sleep(0.005)
+        self.sut.buildFormat.assert_called_once_with("a", "pdf")
+        self.putFakeFormat("a")
+        self.assertEqual(self.sut.getOrScheduleFormat("a"), self.sut.getFormatName("a"))
+
+    @unittest.skipIf(shutil.which("pdflatex") is None, "pdflatex is not installed")
+    def testBuildFormat(self):
+        with open("resources/default_preamble.txt", "r") as f:
+            preamble = f.read()
+        self.assertEqual(self.sut.getOrBuildFormat(preamble), self.sut.getFormatName(preamble))
+        self.assertIsNotNone(self.sut.getFormat(preamble))
+
+if __name__ == '__main__':
+    unittest.main()
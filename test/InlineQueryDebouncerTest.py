@@ -0,0 +1,36 @@
+import unittest
+
+from src.InlineQueryDebouncer import InlineQueryDebouncer
+
+class InlineQueryDebouncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = InlineQueryDebouncer(minDelay=0.1, maxDelay=0.8, idleGap=1.5)
+
+    def testFirstQueryIsImmediate(self):
+        self.assertEqual(self.sut.getDelay(115, now=100), 0)
+        self.assertEqual(self.sut.getDelay(115, now=110), 0)
+        self.assertEqual(self.sut.getStats()["immediate"], 2)
+
+    def testDelayAdaptsToTypingCadence(self):
+        self.sut.getDelay(115, now=100)
+        fastDelay = self.sut.getDelay(115, now=100.1)
+        self.sut.getDelay(116, now=100)
+        slowDelay = self.sut.getDelay(116, now=100.4)
+        self.assertGreater(slowDelay, fastDelay)
+        self.assertAlmostEqual(slowDelay, 0.6)
+        self.assertGreaterEqual(fastDelay, 0.1)
+
+    def testDelayGrowsWithLoad(self):
+        self.sut.getDelay(115, now=100)
+        idleDelay = self.sut.getDelay(115, now=100.2, load=0)
+        self.sut.getDelay(116, now=100)
+        busyDelay = self.sut.getDelay(116, now=100.2, load=1)
+        self.assertAlmostEqual(busyDelay, 2 * idleDelay)
+
+    def testDelayIsCapped(self):
+        self.sut.getDelay(115, now=100)
+        self.assertEqual(self.sut.getDelay(115, now=101.4, load=5), 0.8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,17 +2,31 @@ import unittest
 from unittest.mock import Mock, MagicMock, ANY
 
 from time import sleep
+import tempfile
+import os
 
 from src.InlineQueryResponseDispatcher import InlineQueryResponseDispatcher
 from src.ResourceManager import ResourceManager
 from src.UserOptionsManager import UserOptionsManager
+from src.FileIdCache import FileIdCache
+from telegram import TelegramError
+from telegram.error import BadRequest, NetworkError
 
 class InlineQueryResponseDispatcherTest(unittest.TestCase):
 
     def setUp(self):
-        self.latexConverter = Mock()
+        self.latexConverter = MagicMock()
+        self.latexConverter.getRenderKeyForExpression = Mock(return_value="render_key")
         self.bot = Mock()
-        self.sut = InlineQueryResponseDispatcher(self.bot, self.latexConverter, ResourceManager(), UserOptionsManager(), -1)
+        self.databaseFile = tempfile.mktemp(suffix=".sqlite")
+        self.fileIdCache = FileIdCache(self.databaseFile)
+        self.sut = InlineQueryResponseDispatcher(self.bot, self.latexConverter, ResourceManager(), UserOptionsManager(), -1,
+                                                 fileIdCache=self.fileIdCache)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.databaseFile + suffix):
+                os.remove(self.databaseFile + suffix)
     
     def testRespondToInlineQuery(self):
         bot = Mock()
@@ -59,6 +73,100 @@ class InlineQueryResponseDispatcherTest(unittest.TestCase):
         self.sut.respondToInlineQuery(inline_query, nextQueryArrivedEvent)
         self.assertEqual(self.sut._bot.answerInlineQuery.call_count, 1)
 
+    def testRespondFromFileIdCache(self):
+        inline_query = Mock()
+        inline_query.query = "$x^2$"
+        inline_query.from_user.id = 1153
+        inline_query.id = "id"
+        nextQueryArrivedEvent = Mock()
+        nextQueryArrivedEvent.is_set = Mock(return_value=False)
+
+        self.fileIdCache.put("render_key", "photo_id")
+        self.sut.respondToInlineQuery(inline_query, nextQueryArrivedEvent)
+
+        self.latexConverter.convertExpression.assert_not_called()
+        self.bot.sendPhoto.assert_not_called()
+        self.assertEqual(self.bot.answerInlineQuery.call_count, 1)
+
+    def testStaleFileIdIsInvalidated(self):
+        returnVal = Mock()
+        photo = MagicMock()
+        photo.file_id = "new_photo_id"
+        returnVal.photo = [photo]
+        self.bot.sendPhoto = Mock(return_value=returnVal)
+        self.bot.answerInlineQuery = Mock(side_effect=[TelegramError("wrong file identifier"), None])
+
+        inline_query = Mock()
+        inline_query.query = "$x^2$"
+        inline_query.from_user.id = 1153
+        inline_query.id = "id"
+        nextQueryArrivedEvent = Mock()
+        nextQueryArrivedEvent.is_set = Mock(return_value=False)
+
+        self.fileIdCache.put("render_key", "stale_photo_id")
+        self.sut.respondToInlineQuery(inline_query, nextQueryArrivedEvent)
+
+        self.assertEqual(self.bot.sendPhoto.call_count, 1)
+        self.assertEqual(self.fileIdCache.get("render_key"), "new_photo_id")
+
+    def testChosenResultKeepsFileIdOnOtherErrors(self):
+        self.sut._userOptionsManager.getCodeInCaptionOption = MagicMock(return_value = False)
+        chosen_inline_result = Mock()
+        chosen_inline_result.query = "$x^2$"
+        chosen_inline_result.from_user.id = 1153
+        chosen_inline_result.inline_message_id = "message_id"
+        self.fileIdCache.put("render_key", "photo_id")
+        for err in (NetworkError("timed out"), BadRequest("Message is not modified")):
+            self.bot.editMessageMedia = Mock(side_effect=err)
+            self.sut.respondToChosenInlineResult(chosen_inline_result)
+            self.assertEqual(self.fileIdCache.get("render_key"), "photo_id")
+        self.bot.editMessageMedia = Mock(side_effect=BadRequest("Wrong file identifier/http url specified"))
+        self.sut.respondToChosenInlineResult(chosen_inline_result)
+        self.assertIsNone(self.fileIdCache.get("render_key"))
+
+    def testRespondToInlineQueryWithPreview(self):
+        self.sut._previewDpi = 100
+        self.sut._userOptionsManager.getDpiOption = MagicMock(return_value = 300)
+        self.sut._userOptionsManager.getCodeInCaptionOption = MagicMock(return_value = False)
+        self.latexConverter.getRenderKeyForExpression = Mock(side_effect=lambda expression, userId, dpi=None: str(dpi))
+        returnVal = Mock()
+        photo = MagicMock()
+        photo.file_id = "photo_id"
+        returnVal.photo = [photo]
+        self.bot.sendPhoto = Mock(return_value=returnVal)
+
+        inline_query = Mock()
+        inline_query.query = "$x^2$"
+        inline_query.from_user.id = 1153
+        inline_query.id = "id"
+        nextQueryArrivedEvent = Mock()
+        nextQueryArrivedEvent.is_set = Mock(return_value=False)
+
+        self.sut.respondToInlineQuery(inline_query, nextQueryArrivedEvent)
+
+        self.assertEqual(self.latexConverter.convertExpression.call_args[1]["dpi"], 100)
+
+        chosen_inline_result = Mock()
+        chosen_inline_result.query = "$x^2$"
+        chosen_inline_result.from_user.id = 1153
+        chosen_inline_result.inline_message_id = "message_id"
+
+        self.sut.respondToChosenInlineResult(chosen_inline_result)
+
+        self.assertNotIn("dpi", self.latexConverter.convertExpression.call_args[1])
+        self.bot.editMessageMedia.assert_called_with(inline_message_id="message_id", media=ANY)
+
+    def testNoPreviewAtLowUserDpi(self):
+        self.sut._previewDpi = 100
+        self.sut._userOptionsManager.getDpiOption = MagicMock(return_value = 100)
+        self.assertIsNone(self.sut.getPreviewDpi(1153))
+
+        chosen_inline_result = Mock()
+        chosen_inline_result.from_user.id = 1153
+        self.sut._renderScheduler = Mock()
+        self.sut.dispatchChosenInlineResult(chosen_inline_result)
+        self.sut._renderScheduler.submit.assert_not_called()
+
     def testProcessMultilineComments(self):
         self.sut._userOptionsManager.getCodeInCaptionOption = MagicMock(return_value = False)
 
@@ -1,12 +1,23 @@
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, ANY, patch
 
 import os
+import shutil
+import tempfile
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Event, Thread
 from datetime import datetime as dt
 from subprocess import check_output, CalledProcessError, STDOUT
 
+from src.BuildDirectories import BuildDirectories
+from src.PngImage import PngImage
 from src.LatexConverter import LatexConverter
+from src.ProcessRunner import RenderCancelledError
+from src.StageGraph import StageGraph
 from src.PreambleManager import PreambleManager
+from src.RenderCache import RenderCache
 from src.ResourceManager import ResourceManager
 from src.UserOptionsManager import UserOptionsManager
 
@@ -15,7 +26,17 @@ class LatexConverterTest(unittest.TestCase):
     def setUp(self):
         userOptionsManager = Mock()
         userOptionsManager.getDpiOption = Mock(return_value = 720)
-        self.sut = LatexConverter(PreambleManager(ResourceManager()), userOptionsManager)
+        self.buildDirectory = tempfile.mkdtemp()
+        self.sut = LatexConverter(PreambleManager(ResourceManager()), userOptionsManager,
+                                  buildDirectories=BuildDirectories(self.buildDirectory, janitorInterval=0))
+        os.makedirs("build", exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.buildDirectory, ignore_errors=True)
+
+    def render(self, expression, sessionId="id", formats=("png",), **kwargs):
+        with self.sut.convertExpression(expression, 115, sessionId, formats, **kwargs) as result:
+            return [bytes(result.get(artifact)) for artifact in formats]
 
     def testExtractBoundingBox(self):
         self.sut.logger.debug("Extracting bbox")
@@ -47,19 +68,22 @@ class LatexConverterTest(unittest.TestCase):
             check_output(["rm build/pdflatex_hanging_file*"], stderr=STDOUT, shell=True)
 
     def testConvertExpressionToPng(self):
-        binaryData = self.sut.convertExpression("$x^2$", 115, "id").read()
+        # The reference images come from the PDF path
+        self.sut._dviFastPath = False
+        binaryData = self.sut.convertExpression("$x^2$", 115, "id").open("png").read()
         with open('resources/test/xsquared.png', "rb") as f:
             correctBinaryData = f.read()
         self.assertAlmostEqual(len(binaryData), len(correctBinaryData), delta=50)
         
-        binaryData = self.sut.convertExpression("$x^2$" * 10, 115, "id").read()
+        binaryData = self.sut.convertExpression("$x^2$" * 10, 115, "id").open("png").read()
         with open('resources/test/xsquared10times.png', "rb") as f:
             correctBinaryData = f.read()
         self.assertAlmostEqual(len(binaryData), len(correctBinaryData), delta=50)
         
     def testDeleteFilesInAllCases(self):
-        self.sut.convertExpression("$x^2$", 115, "id")
-        files = os.listdir("build/")
+        with self.sut.convertExpression("$x^2$", 115, "id"):
+            pass
+        files = os.listdir(self.buildDirectory)
 
         try:
             self.assertEqual(len(files), 0)
@@ -68,30 +92,421 @@ class LatexConverterTest(unittest.TestCase):
             raise
         
         try:
-            self.sut.convertExpression("$$$$", 115, "id1").read()
+            self.render("$$$$", "id1")
         except ValueError:
-            self.assertEqual(len(os.listdir("build/")), 0)
+            self.assertEqual(len(os.listdir(self.buildDirectory)), 0)
         
         try:
-            self.sut.convertExpression(r"lo \asdasd", 115, "id2").read()
+            self.render(r"lo \asdasd", "id2")
         except ValueError:
-            self.assertEqual(len(os.listdir("build/")), 0)
+            self.assertEqual(len(os.listdir(self.buildDirectory)), 0)
     
+    def testCancelledRender(self):
+        cancelEvent = Event()
+        cancelEvent.set()
+        with self.assertRaises(RenderCancelledError):
+            self.render("$x^2$", "cancelled", cancelEvent=cancelEvent)
+        self.assertEqual(self.sut.getCancellationStats()["cancelled"], 1)
+        self.assertEqual(os.listdir(self.buildDirectory), [])
+
+    def testCompileErrorIsCached(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock(side_effect=ValueError("! Undefined control sequence.\n"))
+        for _ in range(2):
+            with self.assertRaises(ValueError) as context:
+                self.render("$\\undefinedcommand$")
+            self.assertEqual(context.exception.args[0], "! Undefined control sequence.\n")
+        self.assertEqual(self.sut.compile.call_count, 1)
+        self.assertEqual(self.sut.getErrorCacheStats()["hits"], 1)
+
+    def testTimeoutIsNotCached(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock(side_effect=ValueError("Pdflatex has likely hung up and had to be killed. Congratulations!"))
+        for _ in range(2):
+            with self.assertRaisesRegex(ValueError, "hung up"):
+                self.render("$x^2$")
+        self.assertEqual(self.sut.compile.call_count, 2)
+        self.assertEqual(self.sut.getErrorCacheStats()["hits"], 0)
+
+    def testUnbalancedBracesAreRejectedBeforeCompiling(self):
+        self.sut.compile = Mock()
+        with self.assertRaises(ValueError):
+            self.sut.convertExpression("$\\frac{1}{2$", 115, "id")
+        self.sut.compile.assert_not_called()
+
+    def testEscalatesFromLeanPreamble(self):
+        self.sut._dviFastPath = False
+        preambleTiers = Mock()
+        preambleTiers.getTiers = Mock(return_value=[("minimal", "lean preamble"), ("default", "full preamble")])
+        preambleTiers.isMissingDefinition = Mock(return_value=True)
+        self.sut._preambleTiers = preambleTiers
+        self.sut.compile = Mock(side_effect=[ValueError("! Undefined control sequence.\nl.4 $\\dv\n"), None])
+        self.sut.measureBoundingBox = Mock(side_effect=ValueError("stop"))
+        with self.assertRaisesRegex(ValueError, "stop"):
+            self.render("$\\dv{f}{x}$")
+        self.assertEqual(self.sut.compile.call_count, 2)
+        self.assertTrue(self.sut.compile.call_args[0][1].startswith("full preamble"))
+        preambleTiers.recordCompile.assert_called_with("default", ANY, True)
+
+    def testGhostscriptOutputIsPiped(self):
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(return_value=b"png")
+        self.assertEqual(self.sut.convertPdfToPng(720, "id", (100, 50, 0, 0), directory=self.buildDirectory), b"png")
+        args = self.sut._processRunner.run.call_args[0][0]
+        self.assertEqual(args[args.index("-o") + 1], "-")
+        self.assertEqual(os.listdir(self.buildDirectory), [])
+
+    def testGhostscriptOutputThroughFiles(self):
+        self.sut._ghostscriptPipes = False
+        def run(args, **kwargs):
+            with open(args[args.index("-o") + 1], "wb") as f:
+                f.write(b"pdf")
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(side_effect=run)
+        self.assertEqual(self.sut.cropPdf("id", (0, 0, 10, 10), directory=self.buildDirectory), b"pdf")
+
+    def getInk(self, image):
+        # Coverage of every pixel between 0 (background) and 1 (black), whatever the colour type of the image
+        channels = PngImage.channels[image.colorType]
+        alphas = list(image.transparency or b"")
+        ink = []
+        for row in image.rows:
+            inkRow = []
+            for idx in range(image.width):
+                pixel = row[idx*channels:(idx+1)*channels]
+                if image.colorType == 3:
+                    index = pixel[0]
+                    color = image.palette[3*index:3*index+3]
+                    alpha = alphas[index] if index < len(alphas) else 255
+                elif image.colorType in (4, 6):
+                    color, alpha = pixel[:-1], pixel[-1]
+                else:
+                    color, alpha = pixel, 255
+                inkRow.append((1 - sum(color) / (255 * len(color))) * alpha / 255)
+            ink.append(inkRow)
+        return ink
+
+    def getInkBounds(self, ink):
+        rows = [y for y, row in enumerate(ink) if max(row) > 0.5]
+        columns = [x for x in range(len(ink[0])) if max(row[x] for row in ink) > 0.5]
+        return columns[0], rows[0], columns[-1] + 1, rows[-1] + 1
+
+    def assertSameInk(self, image, reference, msg=None):
+        inks = [self.getInk(image), self.getInk(reference)]
+        (left, top, right, bottom), (referenceLeft, referenceTop, referenceRight, referenceBottom) = map(self.getInkBounds, inks)
+        # The glyphs cover the same area give or take the antialiased edge
+        width, referenceWidth = right - left, referenceRight - referenceLeft
+        height, referenceHeight = bottom - top, referenceBottom - referenceTop
+        self.assertAlmostEqual(width, referenceWidth, delta=max(2, 0.02 * referenceWidth), msg=msg)
+        self.assertAlmostEqual(height, referenceHeight, delta=max(2, 0.02 * referenceHeight), msg=msg)
+        # and, aligned at the top left corners of their bounds, differ only in the antialiasing
+        def getPixel(ink, x, y):
+            return ink[y][x] if y < len(ink) and x < len(ink[0]) else 0
+        difference = 0
+        referenceInk = 0
+        for y in range(max(height, referenceHeight)):
+            for x in range(max(width, referenceWidth)):
+                pixel = getPixel(inks[1], referenceLeft + x, referenceTop + y)
+                difference += abs(getPixel(inks[0], left + x, top + y) - pixel)
+                referenceInk += pixel
+        self.assertLess(difference, 0.25 * referenceInk, msg)
+
+    @unittest.skipUnless(shutil.which("pdflatex") and shutil.which("dvipng") and shutil.which("gs"),
+                         "needs pdflatex, dvipng and Ghostscript")
+    def testDviAndPdfPathsAreEquivalent(self):
+        # Both paths share the render key, so their images have to be interchangeable, not only of the same size
+        for expression in ("$x^2$", r"$\int_0^1 x^2\,dx$", "$x^2$" * 10, r"\[\frac{a}{b}\]"):
+            images = []
+            for sessionId, dviFastPath in (("dvi", True), ("pdf", False)):
+                self.sut._dviFastPath = dviFastPath
+                with self.sut.convertExpression(expression, 115, sessionId) as result:
+                    images.append(PngImage.decode(result.open("png").read()))
+            self.assertSameInk(*images, msg=expression)
+        self.assertEqual(self.sut.getDviStats(), {"renders": 4, "fallbacks": 0})
+
+    def testSameInkComparesPixels(self):
+        # The comparison above only runs where the tools are installed
+        glyph = PngImage(6, 4, 0, [bytearray(b"\xff\x00\x00\x00\x00\xff")] * 4)
+        self.assertSameInk(glyph.pad(3, 1, 0, 2), glyph)
+        checkered = PngImage(6, 4, 0, [bytearray(b"\xff\x00\xff\x00\xff\x00"), bytearray(b"\xff\xff\x00\xff\x00\xff")] * 2)
+        with self.assertRaises(AssertionError):
+            self.assertSameInk(checkered, glyph)
+        palette = PngImage(2, 1, 3, [bytearray(b"\x00\x01")], b"\x00\x00\x00\xff\xff\xff", b"\xff\x00")
+        self.assertEqual(self.getInk(palette), [[1.0, 0.0]])
+
+    def testDviFallsBackToPdf(self):
+        self.sut._isDviFastPathAvailable = Mock(return_value=True)
+        self.sut._renderDvi = Mock(side_effect=ValueError("! Undefined control sequence.\n"))
+        self.sut.compile = Mock(side_effect=ValueError("stop"))
+        with self.assertRaisesRegex(ValueError, "stop"):
+            self.render("$x^2$")
+        self.assertEqual(self.sut.getDviStats()["fallbacks"], 1)
+
+    def testDviFastPathSharesTheSvgCompilation(self):
+        self.sut._isDviFastPathAvailable = Mock(return_value=True)
+        self.sut._compileTiers = Mock()
+        def run(args, **kwargs):
+            if args[0] == "dvisvgm":
+                return b"<svg><path d='M0 0'/></svg>"
+            with open(args[args.index("-o") + 1], "wb") as f:
+                f.write(PngImage(40, 10, 0, [b"\x00" * 40] * 10).encode())
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(side_effect=run)
+        self.assertEqual(len(self.render("$x^2$", formats=("png", "svg"))), 2)
+        self.sut._compileTiers.assert_called_once_with(ANY, "id_dvi", ANY, ANY, ANY, None, "dvi")
+        self.assertEqual(self.sut.getDviStats()["renders"], 1)
+
+    def testDviIsCompiledAgainstFormats(self):
+        self.sut._formatCache = Mock()
+        self.sut._formatCache.getOrScheduleFormat = Mock(return_value="preamble_fmt")
+        self.sut.compile = Mock()
+        self.sut._compileWithPreamble(self.buildDirectory, "id_dvi", "preamble", "preamble document", "document",
+                                      outputFormat="dvi")
+        self.sut._formatCache.getOrScheduleFormat.assert_called_once_with("preamble", "dvi")
+        self.assertEqual(self.sut.compile.call_args[0][2], "preamble_fmt")
+        self.assertEqual(self.sut.compile.call_args[0][-1], "dvi")
+
+    def testConvertExpressionToSvg(self):
+        self.sut._compileTiers = Mock()
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(return_value=b"<svg><path d='M0 0'/></svg>")
+        with self.sut.convertExpression("$x^2$", 115, "id", formats=("svg",)) as result:
+            self.assertEqual(result.open("svg").read(), b"<svg><path d='M0 0'/></svg>")
+        self.assertEqual(self.sut._compileTiers.call_args[0][-1], "dvi")
+        args = self.sut._processRunner.run.call_args[0][0]
+        self.assertEqual(args[0], "dvisvgm")
+        self.assertIn("--bbox=24pt", args)
+        self.assertIn("--stdout", args)
+        self.assertEqual(os.listdir(self.buildDirectory), [])
+
+    @unittest.skipUnless(shutil.which("pdflatex") and shutil.which("dvisvgm"), "needs pdflatex and dvisvgm")
+    def testSvgIsSmallerThanPng(self):
+        svg = bytes(self.sut.convertExpression(r"$\int_0^1 x^2\,dx$", 115, "svg", formats=("svg",)).get("svg"))
+        self.assertTrue(svg.lstrip().startswith(b"<?xml") or svg.lstrip().startswith(b"<svg"))
+        self.sut._dviFastPath = False
+        self.assertLess(len(svg), len(self.sut.convertExpression(r"$\int_0^1 x^2\,dx$", 115, "png").get("png")))
+
+    def testIdenticalConcurrentRendersAreCoalesced(self):
+        started = Event()
+        def render(*args):
+            started.set()
+            deadline = time.time() + 5
+            while self.sut.getCoalescingStats()["followers"] == 0 and time.time() < deadline:
+                time.sleep(0.005)
+            return b"png"
+        self.sut._produceArtifact = Mock(side_effect=render)
+        results = []
+        leader = Thread(target=lambda: results.append(self.render("$x^2$", "first")))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        with self.sut.convertExpression("$x^2$", 116, "second") as follower:
+            self.assertEqual(follower.open("png").read(), b"png")
+        leader.join()
+        self.assertEqual(self.sut._produceArtifact.call_count, 1)
+        self.assertEqual(results, [[b"png"]])
+        self.assertEqual(self.sut.getCoalescingStats()["followers"], 1)
+
+    def testRendersOfOneSourceShareTheCompilation(self):
+        self.sut._dviFastPath = False
+        started = Event()
+        def compile(*args):
+            started.set()
+            deadline = time.time() + 5
+            while self.sut.getCoalescingStats()["followers"] == 0 and time.time() < deadline:
+                time.sleep(0.005)
+        self.sut.compile = Mock(side_effect=compile)
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        self.sut.cropPdf = Mock(return_value=b"pdf")
+        # An inline preview and a direct message ask for different artifacts at different resolutions
+        preview = []
+        inline = Thread(target=lambda: preview.append(self.render("$x^2$", "inline", dpi=100)))
+        inline.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(self.render("$x^2$", "message", ("png", "pdf")), [b"png", b"pdf"])
+        inline.join()
+        self.assertEqual(preview, [[b"png"]])
+        self.assertEqual(self.sut.compile.call_count, 1)
+        self.assertEqual(self.sut.measureBoundingBox.call_count, 1)
+        self.assertEqual(sorted(call[0][0] for call in self.sut.convertPdfToPng.call_args_list), [100, 720])
+        self.assertEqual(os.listdir(self.buildDirectory), [])
+
+    def testPngAndPdfAreProducedConcurrently(self):
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        # Rasterising waits for cropping and the other way round, sequential stages would break the barrier
+        barrier = Barrier(2, timeout=5)
+        def stage(output):
+            def run(*args):
+                barrier.wait()
+                return output
+            return run
+        self.sut.convertPdfToPng = Mock(side_effect=stage(b"png"))
+        self.sut.cropPdf = Mock(side_effect=stage(b"pdf"))
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            with patch.object(StageGraph, "getSharedExecutor", return_value=executor):
+                with self.sut.convertExpression("$x^2$", 115, "id", ("png", "pdf")) as result:
+                    self.assertEqual(bytes(result.get("png")), b"png")
+                    self.assertEqual(bytes(result.get("pdf")), b"pdf")
+        finally:
+            executor.shutdown()
+        self.assertFalse(barrier.broken)
+        self.assertEqual(self.sut.compile.call_count, 1)
+        self.assertEqual(self.sut.measureBoundingBox.call_count, 1)
+
+    def testBackgroundStageKeepsTheWorkspaceAfterClose(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        release = Event()
+        directories = []
+        def crop(sessionId, bounds, cancelEvent, directory):
+            release.wait(5)
+            directories.append(os.path.isdir(directory))
+            return b"pdf"
+        self.sut.cropPdf = Mock(side_effect=crop)
+        with self.sut.convertExpression("$x^2$", 115, "id", ("png", "pdf")) as result:
+            self.assertEqual(bytes(result.get("png")), b"png")
+        # Cropping is still running, its directory is only removed once it is done
+        self.assertEqual(self.sut._workspaces.getActiveCount(), 1)
+        release.set()
+        for _ in range(50):
+            if self.sut._workspaces.getActiveCount() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.sut._workspaces.getActiveCount(), 0)
+        self.assertEqual(directories, [True])
+        self.assertEqual(os.listdir(self.buildDirectory), [])
+
+    def testBackgroundStageIsCached(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        self.sut.cropPdf = Mock(return_value=b"pdf")
+        cacheDirectory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDirectory, ignore_errors=True)
+        self.sut._renderCache = RenderCache(cacheDirectory)
+        with self.sut.convertExpression("$x^2$", 115, "id", ("png", "pdf")) as result:
+            result.get("png")
+        for _ in range(50):
+            if self.sut._workspaces.getActiveCount() == 0:
+                break
+            time.sleep(0.1)
+        # The PDF nobody asked for is not rendered again
+        self.assertEqual(self.render("$x^2$", formats=("pdf",)), [b"pdf"])
+        self.assertEqual(self.sut.cropPdf.call_count, 1)
+
+    def testCachedArtifactGetsNoStage(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        self.sut.cropPdf = Mock(return_value=b"pdf")
+        cacheDirectory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDirectory, ignore_errors=True)
+        self.sut._renderCache = RenderCache(cacheDirectory)
+        self.render("$x^2$", formats=("pdf",))
+        with patch.object(StageGraph, "add") as add:
+            self.assertEqual(self.render("$x^2$", formats=("png", "pdf")), [b"png", b"pdf"])
+        add.assert_not_called()
+        self.assertEqual(self.sut.cropPdf.call_count, 1)
+
+    def testPixelBudgetLowersDpi(self):
+        self.sut._dviFastPath = False
+        self.sut._maxPixels = 10000
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[0, 0, 720, 720])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        with self.sut.convertExpression("$x^2$", 115, "id") as result:
+            result.get("png")
+        dpi, _, bbox = self.sut.convertPdfToPng.call_args[0][:3]
+        self.assertLess(dpi, 720)
+        self.assertLessEqual(int(bbox[0]) * int(bbox[1]), 10000)
+        self.assertEqual(self.sut.getPixelBudgetStats()["pixel_capped"], 1)
+
+    def testPixelBudgetIsAppliedBeforeRasterisingDvi(self):
+        self.sut._isDviFastPathAvailable = Mock(return_value=True)
+        self.sut._maxPixels = 10000
+        self.sut.pdflatex = Mock()
+        resolutions = []
+        def dvipng(args, **kwargs):
+            # A one by a quarter inch expression
+            dpi = int(args[args.index("-D") + 1])
+            resolutions.append(dpi)
+            with open(args[args.index("-o") + 1], "wb") as f:
+                f.write(PngImage(dpi, dpi // 4, 0, [b"\x00" * dpi] * (dpi // 4)).encode())
+        self.sut._processRunner = Mock()
+        self.sut._processRunner.run = Mock(side_effect=dvipng)
+        with self.sut.convertExpression("$x^2$", 115, "id") as result:
+            width, height = PngImage.getSize(bytes(result.get("png")))
+        self.assertEqual(resolutions[0], LatexConverter.dviProbeDpi)
+        self.assertLess(max(resolutions), 720)
+        self.assertLessEqual(width * height, 10000)
+        self.assertEqual(self.sut.getPixelBudgetStats()["pixel_capped"], 1)
+
+    def testByteBudgetRendersAgain(self):
+        self.sut._dviFastPath = False
+        self.sut._maxPngBytes = 10
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(side_effect=[b"x" * 40, b"x" * 5])
+        with self.sut.convertExpression("$x^2$", 115, "id") as result:
+            self.assertEqual(bytes(result.get("png")), b"x" * 5)
+        self.assertEqual(self.sut.convertPdfToPng.call_args[0][0], 324)
+        self.assertEqual(self.sut.getPixelBudgetStats(), {"pixel_capped": 0, "byte_capped": 1, "pixels_saved": 0})
+
     def testEmptyQuery(self):
         with self.assertRaises(ValueError):
-            self.sut.convertExpression("$$$$", 115, "id").read()
+            self.render("$$$$")
 
         with self.assertRaises(ValueError):
-            self.sut.convertExpression(" %comment", 115, "id").read()
+            self.render(" %comment")
 
     def testIgnoreInternalPreambles(self):
-        self.sut.convertExpression(r"\documentclass{article} \begin{document} \LaTeX \end{document}", 115, "id")
+        self.render(r"\documentclass{article} \begin{document} \LaTeX \end{document}")
 
     def testReturnPdf(self):
-        pdfBinaryData = self.sut.convertExpression("lol", 115, "id", True)[1].read()
+        _, pdfBinaryData = self.render("lol", formats=("png", "pdf"))
         with open('resources/test/cropped.pdf', "rb") as f:
             correctBinaryData = f.read()
         self.assertAlmostEqual(len(pdfBinaryData), len(correctBinaryData), delta=50)
+
+    def testConvertExpressionAsync(self):
+        image = Mock()
+        self.sut.convertExpression = Mock(return_value=image)
+        result = asyncio.run(self.sut.convertExpressionAsync("$x^2$", 115, "id", ("png", "pdf")))
+        self.assertEqual(result, image)
+        self.sut.convertExpression.assert_called_with("$x^2$", 115, "id", ("png", "pdf"))
+        # The event loop gets the artifacts ready, it never renders itself
+        self.assertEqual([call[0][0] for call in image.get.call_args_list], ["png", "pdf"])
+        image.close.assert_not_called()
+
+    def testReturnPdfMeasuresBoundingBoxOnce(self):
+        self.sut.measureBoundingBox = Mock(wraps=self.sut.measureBoundingBox)
+        self.render("lol", formats=("png", "pdf"))
+        self.assertEqual(self.sut.measureBoundingBox.call_count, 1)
+
+    def testArtifactsAreProducedOnDemand(self):
+        self.sut._dviFastPath = False
+        self.sut.compile = Mock()
+        self.sut.measureBoundingBox = Mock(return_value=[10, 10, 50, 30])
+        self.sut.convertPdfToPng = Mock(return_value=b"png")
+        self.sut.cropPdf = Mock(return_value=b"pdf")
+        with self.sut.convertExpression("$x^2$", 115, "id") as result:
+            # Nothing is rendered before the first access
+            self.sut.compile.assert_not_called()
+            self.assertEqual(result.getTimings(), {})
+            self.assertIsInstance(result.get("png"), memoryview)
+            self.sut.cropPdf.assert_not_called()
+            self.assertEqual(bytes(result.get("pdf")), b"pdf")
+            self.assertEqual(set(result.getTimings()), {"png", "pdf"})
+        # The PDF produced later reuses the compilation and the bounding box of the PNG
+        self.assertEqual(self.sut.compile.call_count, 1)
+        self.assertEqual(self.sut.measureBoundingBox.call_count, 1)
+        self.assertEqual(os.listdir(self.buildDirectory), [])
        
     #def testPrivacySettings(self):
     #    self.sut.logger.debug("Started pdflatex")
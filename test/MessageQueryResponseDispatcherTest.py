@@ -12,7 +12,10 @@ class MessageQueryResponseDispatcherTest(unittest.TestCase):
     def setUp(self):
         self.latexConverter = Mock()
         self.bot = Mock()
-        self.sut = MessageQueryResponseDispatcher(self.bot, self.latexConverter, ResourceManager())
+        self.userOptionsManager = Mock()
+        self.userOptionsManager.getOutputFormatOption = Mock(return_value="png")
+        self.sut = MessageQueryResponseDispatcher(self.bot, self.latexConverter, ResourceManager(),
+                                                  userOptionsManager=self.userOptionsManager)
     
     def testRespondToMessageQuery(self):
         
@@ -24,11 +27,28 @@ class MessageQueryResponseDispatcherTest(unittest.TestCase):
         
         bot = Mock()
         bot.sendPhoto = Mock()
-        self.latexConverter.convertExpression = Mock(return_value=(Mock(), Mock()))
+        self.latexConverter.convertExpression = Mock(return_value=MagicMock())
         
         self.sut.respondToMessageQuery(message)
         
         self.bot.sendPhoto.assert_called_with(message.from_user.id, ANY)
+
+    def testRespondWithSvg(self):
+        message = Mock()
+        message.from_user.id = 115
+        message.chat.id = 115
+        message.text="$x^2$"
+        self.userOptionsManager.getOutputFormatOption = Mock(return_value="svg")
+        result = MagicMock()
+        result.__enter__.return_value.open = Mock(return_value="svg")
+        self.latexConverter.convertExpression = Mock(return_value=result)
+
+        self.sut.respondToMessageQuery(message)
+
+        self.assertEqual(self.latexConverter.convertExpression.call_args[1]["formats"], ("svg",))
+        result.__enter__.return_value.open.assert_called_with("svg")
+        self.bot.sendDocument.assert_called_with(115, "svg", filename="expression.svg")
+        self.bot.sendPhoto.assert_not_called()
                 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import Mock, patch
+import tempfile
+import shutil
+import os
+import time
+from threading import Thread
+
+from src.FormatCache import FormatCache
+from src.PdflatexWorkerPool import PdflatexWorkerPool
+
+class PdflatexWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.formatCache = FormatCache(os.path.join(self.directory, "formats"))
+        self.sut = PdflatexWorkerPool(self.formatCache, size=1, maxAge=60, workingDirectory=self.directory)
+
+    def tearDown(self):
+        self.sut.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testFallbackWithoutWorkers(self):
+        self.assertFalse(self.sut.compile("unknown_format", "\\begin{document}x\\end{document}",
+                                          os.path.join(self.directory, "expression")))
+        self.assertEqual(self.sut.getStats()["fallbacks"], 1)
+
+    def testUnavailableInOtherProcesses(self):
+        self.sut._ownerPid = -1
+        self.assertFalse(self.sut.isAvailable())
+
+    def testRecycleUnhealthyWorkers(self):
+        worker = Mock()
+        worker.isHealthy = Mock(return_value=False)
+        self.sut._idleWorkers["format"] = [worker]
+        self.sut._fill = Mock()
+        self.assertIsNone(self.sut._acquire("format"))
+        worker.dispose.assert_called_once_with()
+        self.assertEqual(self.sut.getStats()["recycled"], 1)
+
+    def testConcurrentFillsDoNotOvershoot(self):
+        self.sut._idleWorkers["format"] = []
+        def spawn(*args):
+            time.sleep(0.05)
+            return Mock()
+        with patch("src.PdflatexWorkerPool.PdflatexWorker", side_effect=spawn) as worker:
+            threads = [Thread(target=self.sut._fill, args=("format",)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(worker.call_count, 1)
+        self.assertEqual(self.sut.getStats()["idle"], 1)
+
+    def testFailedSpawnReleasesItsSlot(self):
+        self.sut._idleWorkers["format"] = []
+        with patch("src.PdflatexWorkerPool.PdflatexWorker", side_effect=[OSError("fifo"), Mock()]) as worker:
+            self.sut._fill("format")
+            self.sut._fill("format")
+        self.assertEqual(worker.call_count, 2)
+        self.assertEqual(self.sut.getStats()["idle"], 1)
+
+    @unittest.skipIf(shutil.which("pdflatex") is None, "pdflatex is not installed")
+    def testCompile(self):
+        with open("resources/default_preamble.txt", "r") as f:
+            formatName = self.formatCache.getOrBuildFormat(f.read())
+        self.sut.warm(formatName)
+        outputPrefix = os.path.join(self.directory, "expression")
+        self.assertTrue(self.sut.compile(formatName, "\\begin{document}$x^2$\\end{document}", outputPrefix))
+        self.assertTrue(os.path.exists(outputPrefix + ".pdf"))
+
+        with self.assertRaises(ValueError):
+            self.sut.compile(formatName, "\\begin{document}$\\asdasd$\\end{document}", outputPrefix)
+
+if __name__ == '__main__':
+    unittest.main()
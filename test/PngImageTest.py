@@ -0,0 +1,47 @@
+import unittest
+import struct
+import zlib
+
+from src.PngImage import PngImage
+
+class PngImageTest(unittest.TestCase):
+
+    def makePalettePng(self, rows, bitDepth, palette, transparency=None):
+        chunks = [(b"IHDR", struct.pack(">IIBBBBB", 3, len(rows), bitDepth, 3, 0, 0, 0)), (b"PLTE", palette)]
+        if transparency is not None:
+            chunks.append((b"tRNS", transparency))
+        chunks.append((b"IDAT", zlib.compress(b"".join(b"\x00" + row for row in rows))))
+        chunks.append((b"IEND", b""))
+        return PngImage.signature + b"".join(struct.pack(">I", len(chunk)) + chunkType + chunk +
+                                             struct.pack(">I", zlib.crc32(chunkType + chunk))
+                                             for chunkType, chunk in chunks)
+
+    def testGetSize(self):
+        with open("resources/test/xsquared.png", "rb") as f:
+            self.assertEqual(PngImage.getSize(f.read()), (100, 90))
+        with self.assertRaises(ValueError):
+            PngImage.getSize(b"GIF89a")
+
+    def testPadKeepsPixels(self):
+        with open("resources/test/xsquared.png", "rb") as f:
+            image = PngImage.decode(f.read())
+        padded = PngImage.decode(image.pad(2, 3, 4, 5).encode())
+        self.assertEqual((padded.width, padded.height), (106, 98))
+        self.assertEqual(padded.rows[0], b"\xff" * 4 * 106)
+        for idx, row in enumerate(image.rows):
+            self.assertEqual(padded.rows[idx + 3][8:8 + 400], row)
+
+    def testPadPaletteImage(self):
+        # Two rows of three 4-bit indices into a palette of black and grey
+        data = self.makePalettePng([b"\x01\x00", b"\x10\x10"], 4, b"\x00\x00\x00\x80\x80\x80")
+        padded = PngImage.decode(PngImage.decode(data).pad(1, 0, 0, 1).encode())
+        self.assertEqual(padded.palette, b"\x00\x00\x00\x80\x80\x80\xff\xff\xff")
+        self.assertEqual([bytes(row) for row in padded.rows], [b"\x02\x00\x01\x00", b"\x02\x01\x00\x01", b"\x02\x02\x02\x02"])
+
+    def testPadTransparentPaletteImage(self):
+        data = self.makePalettePng([b"\x00\x01\x00"], 8, b"\xff\xff\xff\x00\x00\x00", b"\x00")
+        padded = PngImage.decode(data).pad(1, 0, 1, 0, transparent=True)
+        self.assertEqual(bytes(padded.rows[0]), b"\x00\x00\x01\x00\x00")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
 import unittest
 from unittest.mock import Mock
+import os
+import shutil
+import tempfile
+from subprocess import CalledProcessError
 from src.PreambleManager import PreambleManager
 from src.ResourceManager import ResourceManager
 
@@ -7,7 +11,12 @@ class PreambleManagerTest(unittest.TestCase):
 
     def setUp(self):
         self.resourceManager = ResourceManager()
-        self.sut = PreambleManager(self.resourceManager)
+        self.directory = tempfile.mkdtemp()
+        self.sut = PreambleManager(self.resourceManager, os.path.join(self.directory, "preambles.pkl"),
+                                   databaseFile=os.path.join(self.directory, "test.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
 
     def testValidatePreamble(self):
         self.assertEqual(self.sut.validatePreamble(self.sut.getDefaultPreamble()), (True, ""))
@@ -20,6 +29,16 @@ class PreambleManagerTest(unittest.TestCase):
         message = self.resourceManager.getString("preamble_too_long")%self.resourceManager.getNumber("max_preamble_length")
         self.assertEqual(self.sut.validatePreamble(too_long_preamble), (False, message))
         
+    def testKilledValidationIsAnswered(self):
+        self.sut._processRunner = Mock()
+        for returnCode in (-9, 1):
+            # Neither a killed run nor one that left no log escapes as an exception
+            self.sut._processRunner.run = Mock(side_effect=CalledProcessError(returnCode, ["pdflatex"]))
+            valid, message = self.sut.validatePreamble("\\documentclass{article}")
+            self.assertFalse(valid)
+            self.assertTrue(message.startswith(self.resourceManager.getString("preamble_invalid")))
+            self.assertIn("resource limits", message)
+
 if __name__ == '__main__':
     unittest.main()
     
@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import Mock
+import tempfile
+import shutil
+import os
+
+from src.PreambleTiers import PreambleTiers
+
+class PreambleTiersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        packageSources = {"physics": "\\DeclareDocumentCommand\\dv{ o m g }{}\n\\DeclareDocumentCommand\\Re{}{}\n",
+                          "lipsum": "\\NewDocumentCommand \\lipsum { o }{}\n",
+                          "lastpage": "\\def\\lastpage@putlabel{}\n"}
+        for package, source in packageSources.items():
+            with open(os.path.join(self.directory, package + ".sty"), "w") as f:
+                f.write(source)
+        preambleManager = Mock()
+        preambleManager.getDefaultPreamble = Mock(return_value="\\documentclass{article}\n\\usepackage{amsmath}\n"
+                                                  "\\usepackage{lastpage}\n\\usepackage{physics}\n\\usepackage{lipsum}\n")
+        preambleManager.getMinimalPreamble = Mock(return_value="\\documentclass{article}\n\\usepackage{amsmath}\n")
+        self.sut = PreambleTiers(preambleManager, enabled=True)
+        self.sut._findPackageFile = lambda package: os.path.join(self.directory, package + ".sty")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testMinimalTierFirst(self):
+        tiers = self.sut.getTiers("$x^2$")
+        self.assertEqual([tier for tier, _ in tiers], ["minimal", "default"])
+        self.assertNotIn("physics", tiers[0][1])
+
+    def testPackagesForUsedCommands(self):
+        tiers = self.sut.getTiers("$\\dv{f}{x} + \\Re z$")
+        self.assertEqual(tiers[0][0], "packages")
+        self.assertIn("\\usepackage{physics}", tiers[0][1])
+        self.assertNotIn("lipsum", tiers[0][1])
+        tiers = self.sut.getTiers("page 1 of \\pageref{LastPage}")
+        self.assertIn("\\usepackage{lastpage}", tiers[0][1])
+
+    def testLearnFromUndefinedControlSequence(self):
+        error = "! Undefined control sequence.\n\\lipsum@par ->\\lipsum\n"
+        self.assertTrue(self.sut.isMissingDefinition(error))
+        self.sut.learn(error)
+        self.assertEqual(self.sut._learned, {"\\lipsum": "lipsum"})
+        self.assertFalse(self.sut.isMissingDefinition("! Missing $ inserted.\n"))
+
+    def testTyposAreNotEscalated(self):
+        error = "! Undefined control sequence.\nl.4 $\\frca\n"
+        self.assertFalse(self.sut.isMissingDefinition(error))
+        self.sut.learn(error)
+        self.assertEqual([tier for tier, _ in self.sut.getTiers("$\\frca{1}{2}$")], ["minimal", "default"])
+        self.assertFalse(self.sut.isMissingDefinition("! LaTeX Error: Environment mystery undefined.\n"))
+
+    def testUnreadablePackageDisablesLeanPreamble(self):
+        self.sut._findPackageFile = lambda package: None
+        self.assertEqual([tier for tier, _ in self.sut.getTiers("$x^2$")], ["default"])
+
+    def testStats(self):
+        self.sut.recordCompile("minimal", 0.2, False)
+        self.sut.recordCompile("minimal", 0.4, True)
+        stats = self.sut.getStats()["minimal"]
+        self.assertEqual(stats["compiles"], 2)
+        self.assertEqual(stats["escalations"], 1)
+        self.assertAlmostEqual(stats["avg_seconds"], 0.3)
+
+if __name__ == '__main__':
+    unittest.main()
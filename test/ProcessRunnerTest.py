@@ -0,0 +1,89 @@
+import unittest
+import os
+import sys
+from subprocess import CalledProcessError, TimeoutExpired, PIPE
+from threading import Event, Timer
+from time import time
+
+from src.ProcessRunner import ProcessRunner, RenderCancelledError, OutputLimitExceeded
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class ProcessRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = ProcessRunner()
+
+    def testRun(self):
+        self.assertEqual(self.sut.run([sys.executable, "-c", "print('lol')"]).strip(), b"lol")
+
+    def testRunFailure(self):
+        with self.assertRaises(CalledProcessError) as context:
+            self.sut.run([sys.executable, "-c", "print('lol'); exit(3)"])
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.output.strip(), b"lol")
+
+    def testRunWithInputAndSeparateErrors(self):
+        script = "import sys; sys.stderr.write('message'); sys.stdout.write(sys.stdin.read().upper())"
+        self.assertEqual(self.sut.run([sys.executable, "-c", script], input=b"lol", stderr=PIPE), b"LOL")
+
+    def testRunFailureWithSeparateErrors(self):
+        with self.assertRaises(CalledProcessError) as context:
+            self.sut.run([sys.executable, "-c", "import sys; sys.stderr.write('error'); exit(3)"], stderr=PIPE)
+        self.assertEqual(context.exception.output, b"")
+        self.assertEqual(context.exception.stderr, b"error")
+
+    def testTimeout(self):
+        start = time()
+        with self.assertRaises(TimeoutExpired):
+            self.sut.run([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.2)
+        self.assertLess(time() - start, 5)
+
+    def testCancel(self):
+        cancelEvent = Event()
+        Timer(0.2, cancelEvent.set).start()
+        start = time()
+        with self.assertRaises(RenderCancelledError):
+            self.sut.run([sys.executable, "-c", "import time; time.sleep(10)"], cancelEvent=cancelEvent)
+        self.assertLess(time() - start, 5)
+
+    def testOutputLimit(self):
+        sut = ProcessRunner(maxOutputBytes=1024 * 1024)
+        with self.assertRaises(OutputLimitExceeded):
+            sut.run([sys.executable, "-c", "import sys\nwhile True: sys.stdout.write('x' * 65536)"], timeout=10)
+
+    @unittest.skipUnless(hasattr(resource, "prlimit"), "needs prlimit")
+    def testCpuLimit(self):
+        sut = ProcessRunner(cpuSeconds=1)
+        start = time()
+        with self.assertRaises(CalledProcessError) as context:
+            sut.run([sys.executable, "-c", "while True: pass"], timeout=10)
+        self.assertLess(context.exception.returncode, 0)
+        self.assertLess(time() - start, 5)
+
+    @unittest.skipUnless(hasattr(resource, "prlimit"), "needs prlimit")
+    def testMemoryLimit(self):
+        sut = ProcessRunner(memoryBytes=256 * 1024 * 1024)
+        with self.assertRaises(CalledProcessError) as context:
+            sut.run([sys.executable, "-c", "x = bytearray(1024 * 1024 * 1024)"])
+        self.assertIn(b"MemoryError", context.exception.output)
+
+    @unittest.skipUnless(os.name == "posix", "needs process groups")
+    def testTimeoutKillsProcessGroup(self):
+        # The child leaves a grandchild behind that would otherwise outlive the timeout
+        script = "import subprocess, sys, time; subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(10)']); time.sleep(10)"
+        start = time()
+        with self.assertRaises(TimeoutExpired):
+            self.sut.run([sys.executable, "-c", script], timeout=0.5)
+        self.assertLess(time() - start, 5)
+
+    def testTexEnvironment(self):
+        environment = ProcessRunner.getTexEnvironment({"PATH": "/bin"})
+        self.assertEqual(environment["PATH"], "/bin")
+        self.assertEqual(environment["extra_mem_top"], "0")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+from src.RenderCache import RenderCache
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDirectory = tempfile.mkdtemp()
+        self.sut = RenderCache(self.cacheDirectory, maxMemoryBytes=10, maxDiskBytes=100, maxAge=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDirectory, ignore_errors=True)
+
+    def testMakeKey(self):
+        self.assertEqual(RenderCache.makeKey("$x^2$", 300), RenderCache.makeKey("$x^2$", 300))
+        self.assertNotEqual(RenderCache.makeKey("$x^2$", 300), RenderCache.makeKey("$x^2$", 301))
+        self.assertNotEqual(RenderCache.makeKey("a", "b"), RenderCache.makeKey("ab", ""))
+
+    def testMemoryHit(self):
+        self.sut.put("key", b"12345")
+        self.assertEqual(self.sut.get("key"), b"12345")
+        self.assertEqual(self.sut.get("other"), None)
+        stats = self.sut.getStats()
+        self.assertEqual(stats["memory_hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def testDiskHitAfterMemoryEviction(self):
+        self.sut.put("first", b"123456")
+        self.sut.put("second", b"123456")
+        self.assertEqual(self.sut.getStats()["memory_evictions"], 1)
+        self.assertEqual(self.sut.get("first"), b"123456")
+        self.assertEqual(self.sut.getStats()["disk_hits"], 1)
+
+    def testDiskSurvivesNewInstance(self):
+        self.sut.put("key", b"12345")
+        other = RenderCache(self.cacheDirectory, maxMemoryBytes=10, maxDiskBytes=100, maxAge=60)
+        self.assertEqual(other.get("key"), b"12345")
+        self.assertEqual(other.getStats()["disk_bytes"], 5)
+
+    def testDiskEviction(self):
+        sut = RenderCache(self.cacheDirectory, maxMemoryBytes=0, maxDiskBytes=100, maxAge=60)
+        for idx in range(5):
+            sut.put("key%d" % idx, b"x" * 30)
+            old = time.time() - 10 * (5 - idx)
+            os.utime(os.path.join(self.cacheDirectory, "key%d" % idx), (old, old))
+        self.assertEqual(sut.get("key0"), None)
+        self.assertEqual(sut.get("key4"), b"x" * 30)
+        self.assertLessEqual(sut.getStats()["disk_bytes"], 100)
+        self.assertGreater(sut.getStats()["disk_evictions"], 0)
+
+    def testRewrittenEntriesAreCountedOnce(self):
+        sut = RenderCache(self.cacheDirectory, maxMemoryBytes=0, maxDiskBytes=100, maxAge=60)
+        sut.put("other", b"y" * 30)
+        for _ in range(5):
+            sut.put("key", b"x" * 40)
+        self.assertEqual(sut.getStats()["disk_bytes"], 70)
+        self.assertEqual(sut.getStats()["disk_evictions"], 0)
+        self.assertEqual(sut.get("other"), b"y" * 30)
+
+    def testExpiration(self):
+        self.sut = RenderCache(self.cacheDirectory, maxMemoryBytes=0, maxDiskBytes=100, maxAge=60)
+        self.sut.put("key", b"12345")
+        old = time.time() - 120
+        os.utime(os.path.join(self.cacheDirectory, "key"), (old, old))
+        self.assertEqual(self.sut.get("key"), None)
+        self.assertEqual(self.sut.getStats()["expirations"], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.cacheDirectory, "key")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+from functools import partial
+from unittest.mock import Mock
+import gc
+import os
+import shutil
+import tempfile
+import time
+from threading import Event, Thread
+
+from src.BuildDirectories import BuildDirectories
+from src.RenderCache import RenderCache
+from src.RenderResult import RenderResult
+from src.RenderWorkspace import RenderWorkspaces
+from src.SingleFlight import SingleFlight
+
+class RenderResultTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootDirectory = tempfile.mkdtemp()
+        self.cacheDirectory = tempfile.mkdtemp()
+        self.buildDirectories = BuildDirectories(self.rootDirectory, janitorInterval=0)
+        self.renderCache = RenderCache(self.cacheDirectory)
+        self.produce = Mock(side_effect=self.write)
+        self.singleFlight = SingleFlight()
+        self.workspaces = RenderWorkspaces(self.buildDirectories, self.singleFlight)
+        self.sut = self.makeResult()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDirectory, ignore_errors=True)
+        shutil.rmtree(self.cacheDirectory, ignore_errors=True)
+
+    def makeResult(self, cacheKeys=None, renderCache=True):
+        workspace = self.workspaces.acquire("source", "id")
+        return RenderResult(self.produce, cacheKeys or {"png": "key.png", "pdf": "key.pdf"},
+                            self.renderCache if renderCache else None, workspace,
+                            partial(self.workspaces.release, "source", workspace), self.singleFlight)
+
+    def write(self, result, artifact):
+        with open(os.path.join(result.getDirectory(), "expression." + artifact), "wb") as f:
+            f.write(artifact.encode())
+        return artifact.encode()
+
+    def testArtifactsAreProducedOnce(self):
+        self.assertEqual(bytes(self.sut.get("png")), b"png")
+        self.assertEqual(self.sut.open("png").read(), b"png")
+        self.produce.assert_called_once_with(self.sut, "png")
+        self.assertEqual(set(self.sut.getTimings()), {"png"})
+        with self.assertRaises(ValueError):
+            self.sut.get("svg")
+
+    def testArtifactsComeFromCache(self):
+        self.sut.get("pdf")
+        other = self.makeResult()
+        self.assertTrue(other.isAvailable("pdf"))
+        self.assertFalse(other.isAvailable("png"))
+        self.assertEqual(bytes(other.get("pdf")), b"pdf")
+        self.assertEqual(self.produce.call_count, 1)
+
+    def testStoredArtifactsAreCachedOnce(self):
+        self.renderCache.put = Mock(wraps=self.renderCache.put)
+        self.sut.store("pdf", b"pdf")
+        self.sut.close()
+        self.assertTrue(self.makeResult().isAvailable("pdf"))
+        # A stage that finishes while somebody waits for it has already cached its artifact
+        self.produce.side_effect = lambda result, artifact: result.store(artifact, b"png") or b"png"
+        self.assertEqual(bytes(self.makeResult().get("png")), b"png")
+        self.assertEqual(self.renderCache.put.call_count, 2)
+
+    def testConcurrentResultsProduceOnce(self):
+        started = Event()
+        def produce(result, artifact):
+            started.set()
+            deadline = time.time() + 5
+            while self.singleFlight.getStats()["followers"] == 0 and time.time() < deadline:
+                time.sleep(0.005)
+            return b"png"
+        self.produce.side_effect = produce
+        first, second = [self.makeResult({"png": "key.png"}, renderCache=False) for _ in range(2)]
+        leader = Thread(target=first.get, args=("png",))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(bytes(second.get("png")), b"png")
+        leader.join()
+        self.produce.assert_called_once_with(first, "png")
+
+    def testIntermediatesAreSharedBySource(self):
+        compile = Mock(return_value="expression.pdf")
+        other = self.makeResult({"png": "other.png"})
+        self.assertEqual(self.sut.getIntermediate("pdf", compile), "expression.pdf")
+        self.assertEqual(other.getIntermediate("pdf", compile), "expression.pdf")
+        self.assertEqual(other.getDirectory(), self.sut.getDirectory())
+        compile.assert_called_once_with()
+
+    def testCloseRemovesDirectory(self):
+        other = self.makeResult()
+        with self.sut:
+            self.sut.get("png")
+            self.assertEqual(len(os.listdir(self.rootDirectory)), 1)
+        # The directory stays as long as another result renders the same source
+        self.assertEqual(len(os.listdir(self.rootDirectory)), 1)
+        other.get("pdf")
+        # Results dropped without close() clean up after themselves
+        self.produce.reset_mock()
+        del other
+        gc.collect()
+        self.assertEqual(os.listdir(self.rootDirectory), [])
+        self.assertEqual(self.workspaces.getActiveCount(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
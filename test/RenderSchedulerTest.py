@@ -0,0 +1,75 @@
+import unittest
+from threading import Event
+from time import sleep
+
+from src.RenderScheduler import RenderScheduler
+
+class RenderSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = RenderScheduler(workers=1, maxQueueSize=4, maxQueuedPerUser=3)
+        self.executed = []
+        self.allDone = Event()
+
+    def blockWorker(self):
+        self.release = Event()
+        started = Event()
+        def job():
+            started.set()
+            self.release.wait()
+        self.sut.submit("blocker", job)
+        started.wait(1)
+
+    def record(self, name, last=False):
+        self.executed.append(name)
+        if last:
+            self.allDone.set()
+
+    def testFairness(self):
+        self.blockWorker()
+        self.assertTrue(self.sut.submit("heavy", self.record, "heavy1"))
+        self.assertTrue(self.sut.submit("heavy", self.record, "heavy2"))
+        self.assertTrue(self.sut.submit("heavy", self.record, "heavy3", True))
+        self.assertTrue(self.sut.submit("light", self.record, "light1"))
+        self.release.set()
+        self.assertTrue(self.allDone.wait(1))
+        self.assertEqual(self.executed, ["heavy1", "light1", "heavy2", "heavy3"])
+
+    def testBackpressure(self):
+        self.blockWorker()
+        for idx in range(3):
+            self.assertTrue(self.sut.submit("heavy", self.record, idx))
+        self.assertFalse(self.sut.submit("heavy", self.record, "per user limit"))
+        self.assertTrue(self.sut.submit("light", self.record, "light"))
+        self.assertFalse(self.sut.submit("other", self.record, "queue limit"))
+        stats = self.sut.getStats()
+        self.assertEqual(stats["rejected"], 2)
+        self.assertEqual(stats["queue_depth"], 4)
+        self.release.set()
+
+    def testNewerJobReplacesQueuedOnes(self):
+        self.blockWorker()
+        self.assertTrue(self.sut.submit("typist", self.record, "chosen"))
+        for idx in range(5):
+            self.assertTrue(self.sut.submit("typist", self.record, "query%d" % idx, idx == 4, replaceKey="inline"))
+        stats = self.sut.getStats()
+        self.assertEqual(stats["superseded"], 4)
+        self.assertEqual(stats["queue_depth"], 2)
+        self.release.set()
+        self.assertTrue(self.allDone.wait(1))
+        self.assertEqual(self.executed, ["chosen", "query4"])
+
+    def testFailingJobDoesNotKillWorker(self):
+        def fail():
+            raise RuntimeError("fail")
+        self.sut.submit(1, fail)
+        self.sut.submit(1, self.record, "after", True)
+        self.assertTrue(self.allDone.wait(1))
+        sleep(0.05)
+        stats = self.sut.getStats()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["completed"], 1)
+        self.assertGreaterEqual(stats["wait_time_max"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
 import unittest
+import tempfile
+import shutil
+import json
+import time
+import os
 from src.ResourceManager import ResourceManager
 
 class ResourceManagerTest(unittest.TestCase):
@@ -11,3 +16,36 @@ class ResourceManagerTest(unittest.TestCase):
         
     def testGetString(self):
         self.assertEqual(self.sut.getNumber("max_preamble_length"), 4000)
+
+    def testSourcesOnlyReferenceExistingResources(self):
+        self.sut.validate()
+
+    def testMissingResourceFailsValidation(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "Module.py"), "w") as f:
+                f.write('rm.getString("no_such_string")\nrm.getNumber("max_preamble_length")\n')
+            with self.assertRaisesRegex(ValueError, "no_such_string"):
+                ResourceManager(sourceDirectory=directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def testHotReload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            stringsFile = os.path.join(directory, "strings.json")
+            with open(stringsFile, "w") as f:
+                json.dump({"greeting": "Hi"}, f)
+            sut = ResourceManager(stringsFile, hotReload=True, sourceDirectory=None)
+            sut._reloadInterval = 0
+            self.assertEqual(sut.getString("greeting"), "Hi")
+            with open(stringsFile, "w") as f:
+                json.dump({"greeting": "Hello"}, f)
+            os.utime(stringsFile, (time.time() + 10, time.time() + 10))
+            self.assertEqual(sut.getString("greeting"), "Hello")
+            with open(stringsFile, "w") as f:
+                f.write("{broken")
+            os.utime(stringsFile, (time.time() + 20, time.time() + 20))
+            self.assertEqual(sut.getString("greeting"), "Hello")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,81 @@
+import unittest
+import time
+from threading import Event, Thread
+from unittest.mock import Mock
+
+from src.ProcessRunner import RenderCancelledError
+from src.SingleFlight import SingleFlight
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sut = SingleFlight()
+        self.started = Event()
+        self.release = Event()
+
+    def blocking(self, result):
+        def function():
+            self.started.set()
+            self.release.wait(5)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        return function
+
+    def startLeader(self, function, results):
+        def lead():
+            try:
+                results.append(self.sut.do("key", function))
+            except BaseException as err:
+                results.append(err)
+        leader = Thread(target=lead)
+        leader.start()
+        self.assertTrue(self.started.wait(5))
+        return leader
+
+    def releaseWhenFollowing(self, followers=1):
+        def release():
+            deadline = time.time() + 5
+            while self.sut.getStats()["followers"] < followers and time.time() < deadline:
+                time.sleep(0.005)
+            self.release.set()
+        Thread(target=release).start()
+
+    def testFollowersShareTheResult(self):
+        results = []
+        leader = self.startLeader(self.blocking("image"), results)
+        follower = Mock(return_value="other")
+        self.releaseWhenFollowing()
+        self.assertEqual(self.sut.do("key", follower), "image")
+        leader.join()
+        self.assertEqual(results, ["image"])
+        follower.assert_not_called()
+        self.assertEqual(self.sut.getStats(), {"leaders": 1, "followers": 1, "retries": 0, "in_flight": 0})
+
+    def testFollowersGetTheError(self):
+        leader = self.startLeader(self.blocking(ValueError("! Missing $ inserted.")), [])
+        self.releaseWhenFollowing()
+        with self.assertRaisesRegex(ValueError, "Missing"):
+            self.sut.do("key", Mock())
+        leader.join()
+
+    def testFollowerRetriesWhenLeaderIsCancelled(self):
+        leader = self.startLeader(self.blocking(RenderCancelledError("compile")), [])
+        self.releaseWhenFollowing()
+        self.assertEqual(self.sut.do("key", Mock(return_value="image")), "image")
+        leader.join()
+        self.assertEqual(self.sut.getStats()["retries"], 1)
+
+    def testCancelledFollowerStopsWaiting(self):
+        results = []
+        leader = self.startLeader(self.blocking("image"), results)
+        cancelEvent = Event()
+        cancelEvent.set()
+        with self.assertRaises(RenderCancelledError):
+            self.sut.do("key", Mock(), cancelEvent)
+        self.release.set()
+        leader.join()
+        self.assertEqual(results, ["image"])
+
+if __name__ == '__main__':
+    unittest.main()
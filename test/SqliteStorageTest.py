@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import shutil
+import pickle
+import os
+from multiprocessing import Process
+
+from src.SqliteStorage import SqliteStorage
+
+def putFromOtherProcess(databaseFile):
+    SqliteStorage(databaseFile, "users").put(116, "other process")
+
+class SqliteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databaseFile = os.path.join(self.directory, "test.sqlite")
+        self.sut = SqliteStorage(self.databaseFile, "users")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testPutAndGet(self):
+        self.sut.put(115, {"dpi": 300})
+        self.assertEqual(self.sut.get(115), {"dpi": 300})
+        self.assertTrue(self.sut.contains(115))
+        with self.assertRaises(KeyError):
+            self.sut.get("115")
+        self.sut.delete(115)
+        self.assertFalse(self.sut.contains(115))
+
+    def testKeysKeepTheirType(self):
+        self.sut.put(115, 1)
+        self.sut.put("115", 2)
+        self.assertEqual(sorted(self.sut.keys(), key=str), [115, "115"])
+        self.assertEqual(self.sut.get("115"), 2)
+
+    def testVersionChangesWithWrites(self):
+        version = self.sut.getVersion()
+        self.assertEqual(self.sut.getVersion(), version)
+        other = SqliteStorage(self.databaseFile, "users")
+        other.put(115, "value")
+        self.assertNotEqual(self.sut.getVersion(), version)
+        version = self.sut.getVersion()
+        SqliteStorage(self.databaseFile, "preambles").put(115, "value")
+        self.assertEqual(self.sut.getVersion(), version)
+
+    def testMigrationRunsOnce(self):
+        pickleFile = os.path.join(self.directory, "users.pkl")
+        with open(pickleFile, "wb") as f:
+            pickle.dump({115: "old", 116: "old"}, f)
+        self.sut.put(115, "new")
+        storage = SqliteStorage(self.databaseFile, "users", pickleFile)
+        self.assertEqual(storage.get(115), "new")
+        self.assertEqual(storage.get(116), "old")
+
+        storage.delete(116)
+        storage = SqliteStorage(self.databaseFile, "users", pickleFile)
+        self.assertFalse(storage.contains(116))
+
+    def testConcurrentProcesses(self):
+        process = Process(target=putFromOtherProcess, args=[self.databaseFile])
+        process.start()
+        process.join()
+        self.assertEqual(self.sut.get(116), "other process")
+
+if __name__ == '__main__':
+    unittest.main()
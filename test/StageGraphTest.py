@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Event
+
+from src.StageGraph import StageGraph
+
+class StageGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.sut = StageGraph(self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def testDependenciesRunFirst(self):
+        order = []
+        self.sut.add("compile", lambda: order.append("compile"))
+        self.sut.add("bbox", lambda: order.append("bbox"), ["compile"])
+        self.sut.add("png", lambda: order.append("png") or "image", ["bbox"])
+        self.assertEqual(self.sut.run()["png"], "image")
+        self.assertEqual(order, ["compile", "bbox", "png"])
+
+    def testIndependentStagesRunConcurrently(self):
+        # Each stage waits for the other one, sequential execution would break the barrier
+        barrier = Barrier(2, timeout=5)
+        self.sut.add("compile", Mock())
+        self.sut.add("png", barrier.wait, ["compile"])
+        self.sut.add("crop", barrier.wait, ["compile"])
+        self.sut.run()
+        self.assertFalse(barrier.broken)
+
+    def testErrorSkipsDependentStages(self):
+        crop = Mock()
+        self.sut.add("compile", Mock(side_effect=ValueError("! Missing $ inserted.")))
+        self.sut.add("crop", crop, ["compile"])
+        with self.assertRaisesRegex(ValueError, "Missing"):
+            self.sut.run()
+        crop.assert_not_called()
+        self.assertEqual(self.sut.getCompleted(), [])
+
+    def testWaitReturnsBeforeOtherStagesFinish(self):
+        release = Event()
+        self.sut.add("compile", Mock())
+        self.sut.add("png", Mock(return_value="image"), ["compile"])
+        self.sut.add("crop", release.wait, ["compile"])
+        self.assertEqual(self.sut.wait("png"), "image")
+        self.assertNotIn("crop", self.sut.getCompleted())
+        release.set()
+        self.assertTrue(self.sut.wait("crop"))
+
+    def testHooksSurroundAllStages(self):
+        release = Event()
+        onStart = Mock()
+        onDone = Mock()
+        self.sut = StageGraph(self.executor, onStart, onDone)
+        def crop():
+            release.wait(5)
+            raise ValueError("gs")
+        self.sut.add("compile", Mock())
+        self.sut.add("png", Mock(return_value="image"), ["compile"])
+        self.sut.add("crop", crop, ["compile"])
+        self.assertEqual(self.sut.wait("png"), "image")
+        onStart.assert_called_once_with()
+        # Nobody waits for the crop, the graph is done when it has failed
+        onDone.assert_not_called()
+        release.set()
+        self.executor.shutdown()
+        onDone.assert_called_once_with()
+
+    def testUnknownDependency(self):
+        with self.assertRaises(ValueError):
+            self.sut.add("png", Mock(), ["bbox"])
+
+if __name__ == '__main__':
+    unittest.main()
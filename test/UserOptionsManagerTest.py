@@ -1,15 +1,26 @@
 import unittest
+import os
 import pickle
+import shutil
+import tempfile
 
 from src.UserOptionsManager import UserOptionsManager
 
 class UserOptionsManagerTest(unittest.TestCase):
     
     def setUp(self):
-        testFile = "/tmp/testUsers.pkl"
-        with open(testFile, "w+b") as f:
+        self.directory = tempfile.mkdtemp()
+        self.testFile = os.path.join(self.directory, "testOptions.pkl")
+        self.databaseFile = os.path.join(self.directory, "test.sqlite")
+        with open(self.testFile, "w+b") as f:
             pickle.dump({"115":{'show_code_in_caption': False}}, f)
-        self.sut = UserOptionsManager(testFile)
+        self.sut = UserOptionsManager(self.testFile, self.databaseFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testMigratesOptionsFromPickle(self):
+        self.assertEqual(self.sut.getUserOptions("115"), {'show_code_in_caption': False})
         
     def test(self):
         self.sut.setUserOptions("115", self.sut.getDefaultUserOptions())
@@ -22,3 +33,20 @@ class UserOptionsManagerTest(unittest.TestCase):
     def testGetDpiOption(self):
         dpi = self.sut.getDpiOption("115")
         self.assertEqual(dpi, 300)
+
+    def testOutputFormatOption(self):
+        self.assertEqual(self.sut.getOutputFormatOption("115"), "png")
+        self.sut.setOutputFormatOption("118", "svg")
+        self.assertEqual(self.sut.getOutputFormatOption("118"), "svg")
+
+    def testCachedOptionsFollowWrites(self):
+        self.sut.setDpiOption("117", 300)
+        self.assertEqual(self.sut.getDpiOption("117"), 300)
+        other = UserOptionsManager(self.testFile, self.databaseFile)
+        other.setDpiOption("117", 500)
+        self.assertEqual(self.sut.getDpiOption("117"), 500)
+
+    def testCachedOptionsAreNotShared(self):
+        self.sut.setDpiOption("117", 300)
+        self.sut.getUserOptions("117")["dpi"] = 1000
+        self.assertEqual(self.sut.getDpiOption("117"), 300)
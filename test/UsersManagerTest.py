@@ -1,16 +1,23 @@
 import unittest
+import os
 import pickle
+import shutil
+import tempfile
 
 from src.UsersManager import UsersManager
 
 class UserOptionsManagerTest(unittest.TestCase):
     
     def setUp(self):
-        testFile = "/tmp/testUsers.pkl"
+        self.directory = tempfile.mkdtemp()
+        testFile = os.path.join(self.directory, "testUsers.pkl")
         with open(testFile, "w+b") as f:
             pickle.dump({"":None}, f)
             
-        self.sut = UsersManager(testFile)
+        self.sut = UsersManager(testFile, os.path.join(self.directory, "test.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
         
     def test(self):
         self.sut.setUser("115", {})